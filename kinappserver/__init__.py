@@ -38,6 +38,7 @@ print("kin horizon: %s" % config.STELLAR_HORIZON_URL)
 myenv = kin.Environment('CUSTOM', config.STELLAR_HORIZON_URL, config.STELLAR_NETWORK)
 app.kin_sdk = kin.KinClient(myenv)
 app.kin_account = app.kin_sdk.kin_account(base_seed, channel_seeds, "kit")
+app.kin_channels_count = len(channel_seeds)
 log.info('Kin account status: %s' % app.kin_account.get_status())
 
 
@@ -95,6 +96,7 @@ app.redis.setex('temp-key', 1, 'temp-value')
 app.rq_fast = Queue('kinappserver-%s-fast' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=200)
 app.rq_slow = Queue('kinappserver-%s-slow' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=7200)
 app.rq_push = Queue('kinappserver-%s-push' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=7200)
+app.rq_reward = Queue('kinappserver-%s-reward' % config.DEPLOYMENT_ENV, connection=redis.Redis(host=config.REDIS_ENDPOINT, port=config.REDIS_PORT, db=0), default_timeout=200)
 
 #push: init the amqplib: two instances, one for beta and one for release TODO get rid of this eventually
 app.amqp_publisher_beta = AmqpPublisher()
@@ -125,6 +127,10 @@ state = 'enabled' if config.P2P_TRANSFERS_ENABLED else 'disabled'
 log.info('p2p transfers: %s' % state)
 log.info('replenish blackhawk cards enabled: %s' % config.BLACKHAWK_PURCHASES_ENABLED)
 
+# drain the rewards sent from our own account before exiting
+from .reward_pool import install_sigterm_handler
+install_sigterm_handler()
+
 # get the firebase service-account from ssm
 service_account_file_path = ssm.write_service_account()
 
@@ -9,17 +9,33 @@ messages.
 Implementation details:
 - The pool is initialized upon the first call to publish().
 - The size of the pool is configurable via the CHANNEL_POOL_SIZE parameter.
+- Free channels are kept in a queue: acquiring a channel blocks until one is
+released, or until CHANNEL_WAIT_TIMEOUT_SECS pass.
 - Ideally, the pool can be torn-down with the tear_down() function.
-- If the connection is lost, the pool should re-establish one and recreate the
-channels.
+- The connection is watched by a background supervisor thread, which
+re-establishes it (and recreates the channels) when it is lost. Publishing
+never checks the connection itself.
+- The time spent waiting for a channel and the pool's utilization are reported
+to statsd.
+- Multi-token sends go through publish_many(), which stripes the messages over
+several channels and retries only the messages that weren't confirmed.
 
 """
 
+import logging as log
 from json import dumps
-from threading import RLock
-from time import sleep
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event, Thread
+from time import time
 from datetime import datetime
 from amqpstorm import Connection
+from datadog import statsd
+
+
+class ChannelPoolTimeout(Exception):
+    """No channel was released within the timeout."""
+    pass
 
 
 class AmqpPublisher:
@@ -41,8 +57,14 @@ class AmqpPublisher:
                        'HEARTBEAT': '',
                        'APP_ID': '',
                        'TTL': '',
-                       'CHANNEL_POOL_SIZE': 10}
+                       'ENV': '',
+                       'CHANNEL_POOL_SIZE': 10,
+                       'CHANNEL_WAIT_TIMEOUT_SECS': 5,
+                       'PUBLISH_PARALLELISM': 4,
+                       'SUPERVISOR_INTERVAL_SECS': 1}
         self._channels_manager = None
+        self._channels_manager_lock = Lock()
+        self._executor = None
         self._inited = False
 
     def get_config(self):
@@ -68,22 +90,29 @@ class AmqpPublisher:
         self.ESHU_CONFIG['HEARTBEAT'] = heartbeat
         self.ESHU_CONFIG['APP_ID'] = app_id + '-' + env
         self.ESHU_CONFIG['TTL'] = ttl
+        self.ESHU_CONFIG['ENV'] = env
         self.inited = True
         return True
 
     def send_apns_voip(self, routing_key, payload, tokens):
         """Send the given payload to the given tokens - as voip apns."""
-        self.internal_send_apns(routing_key, payload, tokens, True, self.ESHU_CONFIG['TTL'])
+        return self.internal_send_apns(routing_key, payload, tokens, True, self.ESHU_CONFIG['TTL'])
 
     def send_apns(self, routing_key, payload, tokens):
         """Send the given payload to the given tokens - as apns."""
-        self.internal_send_apns(routing_key, payload, tokens, False, self.ESHU_CONFIG['TTL'])
+        return self.internal_send_apns(routing_key, payload, tokens, False, self.ESHU_CONFIG['TTL'])
 
     def send_gcm(self, routing_key, payload, tokens, dry_run, ttl):
-        """Send a gcm message to the given tokens with the given payload, ttl"""
-        for token in tokens:
-            message = {'app_id': self.ESHU_CONFIG['APP_ID'],
-                       'data': {
+        """Send a gcm message to the given tokens with the given payload, ttl. returns a list with the success of each token"""
+        return self.publish_many(routing_key, [self.gcm_message(token, payload, dry_run, ttl) for token in tokens])
+
+    def internal_send_apns(self, routing_key, payload, tokens, is_voip, ttl):
+        return self.publish_many(routing_key, [self.apns_message(token, payload, is_voip, ttl) for token in tokens])
+
+    def gcm_message(self, token, payload, dry_run, ttl):
+        """Return the serialized gcm message for the given token."""
+        return dumps({'app_id': self.ESHU_CONFIG['APP_ID'],
+                      'data': {
                             'gcm': {
                                     'to': token,
                                     'dry_run': dry_run,
@@ -91,20 +120,83 @@ class AmqpPublisher:
                                     'data': payload
                                    }
                             }
-                        }
-            self.publish(routing_key, dumps(message))
+                      })
+
+    def apns_message(self, token, payload, is_voip, ttl=None):
+        """Return the serialized apns message for the given token."""
+        return dumps({'app_id': self.ESHU_CONFIG['APP_ID'],
+            'data': {
+                'ttl': ttl if ttl is not None else self.ESHU_CONFIG['TTL'],
+                'apns': {
+                    'device_token': token,
+                    'voip': is_voip,
+                    'data': payload
+                }}})
+
+    def get_channels_manager(self):
+        """Return the pool, initializing it on first use."""
+        if self._channels_manager is None:
+            with self._channels_manager_lock:
+                if self._channels_manager is None:
+                    self._channels_manager = ChannelsManager(self.ESHU_CONFIG)
+        return self._channels_manager
+
+    def get_executor(self):
+        """Return the threads that publish the stripes of a batch, creating them on first use."""
+        if self._executor is None:
+            with self._channels_manager_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.ESHU_CONFIG['PUBLISH_PARALLELISM'])
+        return self._executor
+
+    def publish_many(self, routing_key, payloads, retry=True):
+        """Publish all the given payloads. returns a list with the success of each payload.
+
+        The batch is striped over up to PUBLISH_PARALLELISM channels, each publishing its stripe
+        and collecting the confirms, so the confirms of the stripes are awaited concurrently.
+        Only the failed payloads are retried.
+        """
+        if not self.inited:
+            log.error('cant publish payloads: lib not yet inited')
+            return [False] * len(payloads)
+        if not payloads:
+            return []
+
+        self.get_channels_manager()
+        results = [False] * len(payloads)
+        stripes = min(self.ESHU_CONFIG['PUBLISH_PARALLELISM'], len(payloads))
+        futures = [self.get_executor().submit(self.publish_stripe, routing_key, payloads, list(range(i, len(payloads), stripes)), results)
+                   for i in range(stripes)]
+        for future in futures:
+            future.result()
+
+        failed = [i for i, success in enumerate(results) if not success]
+        if failed:
+            statsd.increment('amqp-publish-failed', len(failed), tags=self._channels_manager.tags())
+            if retry:
+                print('amqp_publisher: attempting to re-send %s messages...' % len(failed))
+                retried = self.publish_many(routing_key, [payloads[i] for i in failed], retry=False)
+                for i, success in zip(failed, retried):
+                    results[i] = success
+        return results
+
+    def publish_stripe(self, routing_key, payloads, indices, results):
+        """Publish the payloads at the given indices over a single channel, marking the confirmed ones in results."""
+        try:
+            channel = self._channels_manager.get_channel()
+        except ChannelPoolTimeout as e:
+            log.error('amqp_publisher: cant publish %s messages - %s' % (len(indices), e))
+            return
 
-    def internal_send_apns(self, routing_key, payload, tokens, is_voip, ttl):
-        for token in tokens:
-            message = dumps({'app_id': self.ESHU_CONFIG['APP_ID'],
-                'data': {
-                    'ttl': ttl,
-                    'apns': {
-                        'device_token': token,
-                        'voip': is_voip,
-                        'data': payload
-                    }}})
-            self.publish(routing_key, message)
+        for i in indices:
+            try:
+                results[i] = channel.publish(payloads[i], routing_key) is not False
+            except Exception as e:
+                print('amqp_publisher: failed to publish message to amqp. exception: %s' % e)
+                # the channel is gone - the rest of the stripe is left for the retry
+                self._channels_manager.release_channel(channel, broken=True)
+                return
+        self._channels_manager.release_channel(channel)
 
     def publish(self, routing_key, payload, retry=True):
         """Publish the given payload."""
@@ -112,148 +204,195 @@ class AmqpPublisher:
             log.error('cant publish payload: lib not yet inited')
             return
 
-        if self._channels_manager is None:
-            self._channels_manager = ChannelsManager(self.ESHU_CONFIG)
+        self.get_channels_manager()
 
-        channel = self._channels_manager.get_channel()
+        try:
+            channel = self._channels_manager.get_channel()
+        except ChannelPoolTimeout as e:
+            log.error('amqp_publisher: dropping message - %s' % e)
+            return
 
         try:
             # Publish a message to the queue.
             channel.publish(payload, routing_key)
         except Exception as e:
             print('amqp_publisher: failed to publish message to amqp. exception: %s' % e)
-            self._channels_manager.release_channel(channel)
-            print('amqp_publisher: attempting to re-establish connection...')
-            self._channels_manager.establish_connection()
+            self._channels_manager.release_channel(channel, broken=True)
             if retry:
                 print('amqp_publisher: attempting to re-send message...')
                 self.publish(routing_key, payload, retry=False)
         else:
             self._channels_manager.release_channel(channel)
 
+    def tear_down(self):
+        """Close the pool, if it was ever initialized."""
+        if self._channels_manager is not None:
+            self._channels_manager.tear_down()
+
 
 class Channel:
     """Channel object."""
 
-    _busy = False
     _index = -1
+    _generation = -1
     _exchange_name = None
     _channel = None
     _config = None
     _app_id = None
 
-    def __init__(self, connection, index, exchange_name, app_id):
+    def __init__(self, connection, index, generation, exchange_name, app_id):
         """Ctor for this channel."""
         self._index = index
+        self._generation = generation
         self._exchange_name = exchange_name
-        self._busy = False
         self._app_id = app_id
         self._channel = connection.channel()
         #self._channel.queue.declare(ESHU_CONFIG['QUEUE_NAME'], durable=True)
         self._channel.confirm_deliveries()
 
-    def acquire(self):
-        """Acquire this channel."""
-        self._busy = True
-
-    def release(self):
-        """Release this channel."""
-        self._busy = False
-
-    def is_busy(self):
-        """Return True if the channel is taken."""
-        return self._busy
+    def generation(self):
+        """Return the generation of the connection this channel was created on."""
+        return self._generation
 
     def publish(self, payload, routing_key):
-        """Publish the given payload via this channel."""
-
-        # If connection is blocked, wait before trying to publish again.
-        #while self._channel.is_blocked:
-        #    time.sleep(WAIT_BLOCKED)
-        #    continue
+        """Publish the given payload via this channel. returns False if the broker didn't confirm it."""
 
         # Set a bunch of message-level properties
         props = {'app_id': self._app_id, 'content_encoding': 'UTF-8', 'content_type': 'text/plain', 'timestamp': datetime.utcnow()}
 
-        self._channel.basic.publish(body=payload, routing_key=routing_key, exchange=self._exchange_name, properties=props)
+        return self._channel.basic.publish(body=payload, routing_key=routing_key, exchange=self._exchange_name, properties=props)
 
     def close(self):
         """Close the channel."""
-        self._channel.close()
+        try:
+            self._channel.close()
+        except Exception as e:
+            print('amqp_publisher: failed to close channel %s. exception: %s' % (self._index, e))
 
 
 class ChannelsManager:
-    """Manages AMQP channels over a single connection."""
+    """Manages AMQP channels over a single connection.
 
-    IDLE = 0.01
-    _channels = []
-    _connection = None
-    _lock = RLock()
-    _config = None
+    Free channels wait in a queue. Each (re)connection starts a new generation - channels of an
+    older generation are closed when they are released rather than returned to the queue.
+    """
+
+    RECONNECT_BACKOFF_SECS = 5
 
     def __init__(self, config):
-        """Init the connection and channels."""
+        """Init the connection and channels, and start the supervisor."""
         self._config = config
-        self._channels = []
+        self._size = config['CHANNEL_POOL_SIZE']
+        self._free = Queue()
         self._connection = None
-        self._lock = RLock()
+        self._generation = 0
+        self._lock = Lock()  # guards (re)connections - never taken when acquiring a channel
+        self._reconnect_needed = Event()
+        self._stopped = Event()
+        self._tags = ['app:kinit,env:%s' % config['ENV']]
 
-        self.init_pool()
+        self.establish_connection()
 
-    def init_pool(self):
-        """Set up a connection and channels if the connection is closed/doesn't exist.
-
-        Does nothing if the connection is already up.
-        """
-        if self._connection and self._connection.is_open:
-            return
-        elif self._connection and self._connection.is_opening:
-            while self._connection.is_opening:
-                sleep(ChannelsManager.IDLE)
-            return
-        else:
-            # create/recreate the connection and overwrite the channels
-            self.establish_connection()
+        self._supervisor = Thread(target=self.supervise, name='amqp-supervisor')
+        self._supervisor.daemon = True
+        self._supervisor.start()
 
     def establish_connection(self):
-        self._connection = Connection(self._config['ADDRESS'],
-                                      self._config['USER'],
-                                      self._config['PASSWORD'],
-                                      virtual_host=self._config['VIRTUAL_HOST'],
-                                      heartbeat=self._config['HEARTBEAT'])
-        # clear previous channels if they exist
-        for channel in self._channels:
-            channel.close()
-        # create new channels
-        self._channels = []
-        for i in range(self._config['CHANNEL_POOL_SIZE']):
-            print('creating an amqpl channel...')
-            self._channels.append(Channel(self._connection, i, self._config['EXCHANGE_NAME'], self._config['APP_ID']))
-
-    def get_channel(self):
-        """Acquire a channel from the pool. Blocks if none are available."""
-        while True:
-            with self._lock:
-
-                self.init_pool()  # does nothing if the pool exists. recreates it on error
-
-                for channel in self._channels:
-                    if not channel.is_busy():
-                        channel.acquire()
-                        return channel
-            sleep(ChannelsManager.IDLE)
-
-    def release_channel(self, channel):
-        """Release the given channel back to the pool."""
+        """Create a new connection and replace all the channels with channels over it."""
         with self._lock:
-            for c in self._channels:
-                if c == channel:
-                    channel.release()
-                    return True
+            connection = Connection(self._config['ADDRESS'],
+                                    self._config['USER'],
+                                    self._config['PASSWORD'],
+                                    virtual_host=self._config['VIRTUAL_HOST'],
+                                    heartbeat=self._config['HEARTBEAT'])
+            self._generation = self._generation + 1
+            channels = []
+            for i in range(self._size):
+                print('creating an amqpl channel...')
+                channels.append(Channel(connection, i, self._generation, self._config['EXCHANGE_NAME'], self._config['APP_ID']))
+
+            # drop the free channels of the previous connection. busy ones are dropped on release
+            while True:
+                try:
+                    self._free.get_nowait().close()
+                except Empty:
+                    break
+
+            old_connection = self._connection
+            self._connection = connection
+            for channel in channels:
+                self._free.put(channel)
+
+        if old_connection is not None:
+            try:
+                old_connection.close()
+            except Exception as e:
+                print('amqp_publisher: failed to close the previous connection. exception: %s' % e)
+        statsd.increment('amqp-reconnect', tags=self._tags)
+
+    def supervise(self):
+        """Background loop: re-establish the connection whenever it's lost or a publish failed."""
+        while not self._stopped.is_set():
+            self._reconnect_needed.wait(self._config['SUPERVISOR_INTERVAL_SECS'])
+            if self._stopped.is_set():
+                return
+            if self._connection is not None and self._connection.is_open and not self._reconnect_needed.is_set():
+                continue
+            self._reconnect_needed.clear()
+            print('amqp_publisher: the connection is down. reconnecting...')
+            try:
+                self.establish_connection()
+            except Exception as e:
+                print('amqp_publisher: failed to reconnect. exception: %s' % e)
+                self._reconnect_needed.set()
+                self._stopped.wait(ChannelsManager.RECONNECT_BACKOFF_SECS)
+
+    def tags(self):
+        """Return the statsd tags of this pool."""
+        return self._tags
+
+    def get_channel(self, timeout=None):
+        """Acquire a channel from the pool. Blocks until one is available, or raises ChannelPoolTimeout."""
+        start = time()
+        try:
+            channel = self._free.get(timeout=timeout or self._config['CHANNEL_WAIT_TIMEOUT_SECS'])
+        except Empty:
+            statsd.increment('amqp-channel-timeout', tags=self._tags)
+            raise ChannelPoolTimeout('no amqp channel was released within the timeout')
+        statsd.timing('amqp-channel-wait', (time() - start) * 1000, tags=self._tags)
+        statsd.gauge('amqp-pool-utilization', float(self._size - self._free.qsize()) / self._size, tags=self._tags)
+        return channel
+
+    def release_channel(self, channel, broken=False):
+        """Release the given channel back to the pool.
+
+        A broken channel is replaced with a new one. If that fails too, the supervisor is asked to reconnect.
+        """
+        if channel.generation() != self._generation:
+            # the connection was re-established while this channel was busy. its replacement is already in the pool
+            channel.close()
             return False
 
-    def tear_down(self):
-        """Close all channels in the pool and the connection."""
-        for channel in self._channels:
+        if broken:
             channel.close()
-        self._connection.close()
\ No newline at end of file
+            try:
+                channel = Channel(self._connection, channel._index, channel.generation(), self._config['EXCHANGE_NAME'], self._config['APP_ID'])
+            except Exception as e:
+                print('amqp_publisher: failed to replace a broken channel. exception: %s' % e)
+                self._reconnect_needed.set()
+                return False
+
+        self._free.put(channel)
+        return True
+
+    def tear_down(self):
+        """Stop the supervisor, and close all channels in the pool and the connection."""
+        self._stopped.set()
+        self._reconnect_needed.set()
+        while True:
+            try:
+                self._free.get_nowait().close()
+            except Empty:
+                break
+        if self._connection is not None:
+            self._connection.close()
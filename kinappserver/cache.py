@@ -0,0 +1,293 @@
+"""a two-tier cache: a bounded, per-worker lru in front of redis.
+
+values are stored in redis as json (zlib-compressed when large). entries can carry tags
+(for example 'user:<user_id>' or 'catalog:tasks'): every tag has a version counter in redis
+and an entry is only valid while the versions of its tags match the versions it was written
+with. invalidating a tag is a single INCR, and it drops the tag's entries in all the workers -
+including their local lru copies, which are re-validated against the tag versions on every read.
+the versions also include a random redis 'epoch', so flushing redis drops the local copies too.
+a tag's version expires CACHE_TAG_TTL_SECS after the last entry was written with it (or after its last
+invalidation), so it never expires before its entries do.
+
+keys that are overwritten in place (rather than invalidated by tags) must be used with
+local=False, as other workers have no way of noticing the overwrite.
+"""
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from uuid import uuid4
+import logging as log
+
+import redis_lock
+
+from kinappserver import app, config
+from kinappserver.utils import increment_metric, timing_metric
+
+TAG_VERSION_KEY = 'cache-tag:%s'
+EPOCH_KEY = 'cache-epoch'
+EPOCH_FIELD = '_epoch'
+LOCK_NAME = 'cache:%s'
+PLAIN_PREFIX = b'j'
+COMPRESSED_PREFIX = b'z'
+
+
+class LRU(object):
+    """a thread-safe, bounded lru of serialized entries"""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return item
+
+    def set(self, key, expires_at, tag_versions, data):
+        with self.lock:
+            self.items[key] = (expires_at, tag_versions, data)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+local_cache = LRU(config.CACHE_LOCAL_MAX_ITEMS)
+
+
+def namespace_of(key):
+    """the part of the key before the first colon - used to tag the metrics"""
+    return key.split(':', 1)[0]
+
+
+def encode(envelope):
+    data = json.dumps(envelope).encode()
+    if len(data) >= config.CACHE_COMPRESS_MIN_BYTES:
+        return COMPRESSED_PREFIX + zlib.compress(data)
+    return PLAIN_PREFIX + data
+
+
+def decode(raw):
+    """returns the envelope stored in redis"""
+    if raw[:1] == COMPRESSED_PREFIX:
+        return json.loads(zlib.decompress(raw[1:]).decode())
+    if raw[:1] == PLAIN_PREFIX:
+        return json.loads(raw[1:].decode())
+    # plain json, written before this cache was deployed. it can go once those entries expired
+    return {'v': json.loads(raw.decode()), 't': {}, 'e': None}
+
+
+def get_many(keys, tags=(), local=True):
+    """returns a tuple of (dict of the found keys and their values, the current versions of the given tags).
+
+    pass the versions on to set_many when storing values computed after this call.
+    """
+    start = time.time()
+    tags = list(tags)
+    found = {}
+    local_entries = {key: local_cache.get(key) for key in keys} if local else {}
+    remote_keys = [key for key in keys if local_entries.get(key) is None]
+
+    try:
+        tag_versions, values = read_versions(tags, remote_keys)
+    except Exception as e:
+        log.error('cache: failed to read keys %s. e: %s' % (keys, e))
+        increment_metric('cache-error')
+        return {}, None
+
+    for key, entry in local_entries.items():
+        if entry is None:
+            continue
+        if entry[1] == tag_versions:
+            found[key] = json.loads(entry[2])
+            increment_metric('cache-hit', tags_str='cache:%s,tier:local' % namespace_of(key))
+        else:
+            local_cache.delete(key)
+            remote_keys.append(key)  # the tags changed - so did the redis entry. count as a miss
+
+    for key, raw in zip(remote_keys, values):
+        if raw is None:
+            continue
+        try:
+            envelope = decode(raw)
+        except Exception as e:
+            log.error('cache: cant decode the value of key %s. e: %s' % (key, e))
+            continue
+        if envelope['t'] != tag_versions and (envelope['t'] or tags):
+            continue  # written before one of its tags was invalidated. untagged legacy entries are valid when no tags were asked for
+        found[key] = envelope['v']
+        increment_metric('cache-hit', tags_str='cache:%s,tier:redis' % namespace_of(key))
+        if local and envelope['e']:
+            local_cache.set(key, envelope['e'], tag_versions, json.dumps(envelope['v']))
+
+    for key in keys:
+        if key not in found:
+            increment_metric('cache-miss', tags_str='cache:%s' % namespace_of(key))
+
+    timing_metric('cache-get-latency', (time.time() - start) * 1000)
+    return found, tag_versions
+
+
+def get(key, tags=(), local=True):
+    """returns the cached value for the given key, or None"""
+    return get_many([key], tags, local)[0].get(key)
+
+
+def set_many(values, ttl, tags=(), tag_versions=None, local=True):
+    """stores the given dict of keys and values.
+
+    tag_versions should be the versions returned by the get_many call that preceded the computation
+    of the values, so that an invalidation that happens in the meantime isn't lost.
+    """
+    if not values:
+        return False
+    tags = list(tags)
+    ttl = min(int(ttl), config.CACHE_TAG_TTL_SECS)  # entries must never outlive their tag versions
+    try:
+        if tag_versions is None:
+            tag_versions = get_tag_versions(tags)
+        expires_at = time.time() + ttl
+        pipe = app.redis.pipeline(transaction=False)
+        # keep the tags alive at least as long as the entries. a tag that expired (and so restarted from 0)
+        # since its version was read would make the entries valid again after later invalidations - drop them
+        for tag in tags:
+            pipe.expire(TAG_VERSION_KEY % tag, config.CACHE_TAG_TTL_SECS)
+        for key, value in values.items():
+            pipe.setex(key, ttl, encode({'v': value, 't': tag_versions, 'e': expires_at}))
+        refreshed = pipe.execute()[:len(tags)]
+        if any(tag_versions.get(tag, 0) and not alive for tag, alive in zip(tags, refreshed)):
+            app.redis.delete(*values.keys())
+            increment_metric('cache-expired-tag')
+            return False
+    except Exception as e:
+        log.error('cache: failed to write keys %s. e: %s' % (list(values.keys()), e))
+        increment_metric('cache-error')
+        return False
+
+    if local:
+        for key, value in values.items():
+            local_cache.set(key, expires_at, tag_versions, json.dumps(value))
+    else:
+        for key in values:
+            local_cache.delete(key)
+    return True
+
+
+def set(key, value, ttl, tags=(), tag_versions=None, local=True):
+    """stores the given value under the given key"""
+    if value is None:
+        log.error('cache: refusing to store None value for key %s' % key)
+        return False
+    return set_many({key: value}, ttl, tags, tag_versions, local)
+
+
+def delete(key):
+    """deletes the given key. this only reaches the local lru of the calling worker - see the module doc"""
+    local_cache.delete(key)
+    try:
+        app.redis.delete(key)
+        return True
+    except Exception as e:
+        log.error('cache: failed to delete key %s. e: %s' % (key, e))
+        return False
+
+
+def get_or_compute(key, compute_func, ttl, tags=(), local=True):
+    """returns the cached value for the given key, computing (and storing) it on a miss.
+
+    only one worker computes a missing key at a time - the others wait for its result.
+    """
+    found, tag_versions = get_many([key], tags, local)
+    if key in found:
+        return found[key]
+
+    lock = redis_lock.Lock(app.redis, LOCK_NAME % key, expire=config.CACHE_LOCK_EXPIRE_SECS)
+    try:
+        acquired = lock.acquire(blocking=False)
+    except Exception as e:
+        log.error('cache: cant acquire the lock for key %s. e: %s' % (key, e))
+        return compute_func()
+
+    if not acquired:
+        # another worker is computing this key. wait for it and use its result
+        increment_metric('cache-wait', tags_str='cache:%s' % namespace_of(key))
+        try:
+            if lock.acquire(timeout=config.CACHE_LOCK_WAIT_SECS):
+                lock.release()
+                found, tag_versions = get_many([key], tags, local)
+                if key in found:
+                    return found[key]
+        except Exception as e:
+            log.error('cache: failed waiting for key %s. e: %s' % (key, e))
+        value = compute_func()
+        set(key, value, ttl, tags, tag_versions, local)
+        return value
+
+    try:
+        start = time.time()
+        value = compute_func()
+        timing_metric('cache-compute-latency', (time.time() - start) * 1000, tags_str='cache:%s' % namespace_of(key))
+        set(key, value, ttl, tags, tag_versions, local)
+        return value
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            log.warning('cache: failed to release the lock for key %s. e: %s' % (key, e))
+
+
+def read_versions(tags, keys=()):
+    """reads the current versions of the given tags and the raw values of the given keys in a single MGET.
+
+    returns a tuple of (dict of the versions, list of the raw values).
+    """
+    tags = list(tags)
+    values = app.redis.mget([EPOCH_KEY] + [TAG_VERSION_KEY % tag for tag in tags] + list(keys))
+    epoch = values[0].decode() if values[0] is not None else create_epoch()
+    versions = {tag: int(version or 0) for tag, version in zip(tags, values[1:len(tags) + 1])}
+    versions[EPOCH_FIELD] = epoch
+    return versions, values[len(tags) + 1:]
+
+
+def create_epoch():
+    """sets a new epoch, unless another worker beat us to it. returns the current epoch"""
+    epoch = uuid4().hex
+    if app.redis.set(EPOCH_KEY, epoch, nx=True):
+        return epoch
+    return app.redis.get(EPOCH_KEY).decode()
+
+
+def get_tag_versions(tags):
+    """returns a dict with the current version of each of the given tags"""
+    return read_versions(tags)[0]
+
+
+def invalidate_tags(*tags):
+    """invalidates all the entries tagged with any of the given tags, in all the workers"""
+    try:
+        pipe = app.redis.pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(TAG_VERSION_KEY % tag)
+            pipe.expire(TAG_VERSION_KEY % tag, config.CACHE_TAG_TTL_SECS)
+        pipe.execute()
+        increment_metric('cache-invalidate', len(tags))
+        return True
+    except Exception as e:
+        log.error('cache: failed to invalidate tags %s. e: %s' % (tags, e))
+        return False
@@ -56,6 +56,14 @@ TRUEX_PARTNER_HASH = ''
 TRUEX_CALLBACK_SECRET = ''
 
 PAYMENT_SERVICE_URL = 'https://kin3stage.payments.kinitapp.com:4998'
+# the payment service client: per-call timeouts, retries and a circuit breaker
+PAYMENT_SERVICE_POOL_SIZE = 50
+PAYMENT_SERVICE_CONNECT_TIMEOUT_SECS = 2
+PAYMENT_SERVICE_READ_TIMEOUT_SECS = 10
+PAYMENT_SERVICE_RETRIES = 2
+PAYMENT_SERVICE_RETRY_BACKOFF_SECS = 0.2
+PAYMENT_SERVICE_BREAKER_MAX_FAILURES = 5
+PAYMENT_SERVICE_BREAKER_RESET_SECS = 30
 API_SERVER_URL = 'https://stage.kinitapp.com'
 
 BLOCK_ONBOARDING_IOS_VERSION = '0.1'
@@ -84,12 +92,61 @@ OFFER_LIMIT_TIME_RANGE = 30  #days
 OFFER_RATE_LIMIT_MIN_IOS_VERSION = '1.2.1'
 OFFER_RATE_LIMIT_MIN_ANDROID_VERSION = '1.4.1'
 
-USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY = "USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_%s_%s"
-USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_PREFIX = "USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_%s*"
+# the two-tier cache (see kinappserver/cache.py)
+CACHE_LOCAL_MAX_ITEMS = 5000  # per worker
+CACHE_COMPRESS_MIN_BYTES = 1024
+CACHE_TAG_TTL_SECS = 24 * 60 * 60  # cached entries never outlive this
+CACHE_LOCK_EXPIRE_SECS = 10
+CACHE_LOCK_WAIT_SECS = 5
+
+USER_TASKS_CACHE_TTL_SECS = 30 * 60
+PAYMENT_MEMO_CACHE_TTL_SECS = 30 * 60
+
+# the legacy completed tasks are copied into the completed_task table in batches of this many users
+COMPLETED_TASKS_BACKFILL_BATCH_SIZE = 1000
+
+# engagement push candidates are streamed from the db, and their tasks checked, in chunks of this size
+ENGAGEMENT_PUSH_CHUNK_SIZE = 5000
+# engagement pushes are sent by rq jobs of this many users each, in batches, at a global rate
+ENGAGEMENT_PUSH_JOB_CHUNK_SIZE = 1000
+ENGAGEMENT_PUSH_BATCH_SIZE = 100
+ENGAGEMENT_PUSH_RATE_PER_SEC = 200
+ENGAGEMENT_PUSH_TOKEN_BUCKET_REDIS_KEY = 'engagement-push-token-bucket'
+
+# pushes sent from the request path are queued in-process and published by a background flusher
+PUSH_OUTBOX_MAX_SIZE = 10000
+PUSH_OUTBOX_BATCH_SIZE = 100
+PUSH_OUTBOX_FLUSH_INTERVAL_SECS = 0.5
+PUSH_OUTBOX_MAX_ATTEMPTS = 3
+PUSH_OUTBOX_REDIS_KEY = 'push-outbox'
+
+# task rewards are paid by jobs on the reward rq queue. failed jobs are retried with an exponential backoff
+REWARD_JOB_MAX_ATTEMPTS = 5
+REWARD_JOB_RETRY_BACKOFF_SECS = 30
+
+# task payments without a tx are re-submitted by the reconciliation job
+RECONCILE_GRACE_SECS = 10 * 60
+RECONCILE_RETRY_INTERVAL_SECS = 30 * 60
+RECONCILE_MAX_ATTEMPTS = 3
+RECONCILE_BATCH_SIZE = 1000
+RECONCILE_LOOKBACK_SECS = 2 * 24 * 60 * 60
+RECONCILE_LOCK_EXPIRE_SECS = 10 * 60
+
+# payments to the offer addresses are pre-fetched by the payment listener (see kinappserver/payment_listener.py)
+OFFER_PAYMENT_CACHE_TTL_SECS = 30 * 60
+PAYMENT_LISTENER_REFRESH_SECS = 60
+PAYMENT_LISTENER_RESTART_SECS = 5
+
+# rewards sent directly from our kin account run on a pool with a thread per channel seed (see kinappserver/reward_pool.py)
+REWARD_POOL_MAX_PENDING = 100
+REWARD_POOL_DRAIN_TIMEOUT_SECS = 20
+
+# free goods can be pre-staged in redis lists, so booking takes a single LPOP (see allocate_good)
+GOODS_PRESTAGING_ENABLED = False
+GOODS_PRESTAGING_MAX_POPS = 10
+
+TASK_CATALOG_VERSION_REDIS_KEY = 'TASK_CATALOG_VERSION'
 
-USER_CATEGORIES_CACHE_REDIS_KEY = 'USER_CATEGORIES_CACHE_REDIS_KEY_%s'
-
-USER_LOCKED_OFFERS_REDIS_KEY = 'REDIS_USER_BLOCKED_OFFERS_LIST_%s'
 ZENDESK_API_TOKEN = "this gets overwritten by the tester code. it acutally uses a temp postgress db on the local disc"
 
 MIGRATION_SERVICE_URL = "http://localhost:8000" # tunnle
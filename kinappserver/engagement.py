@@ -0,0 +1,178 @@
+"""rate-controlled dispatch of engagement push notifications.
+
+the selected users are split into chunks, and each chunk is sent by its own rq job - so the
+campaign is spread over all the push workers. the total send rate is enforced across the
+workers with a token bucket in redis. each campaign's progress is kept in a redis hash.
+"""
+import time
+import logging as log
+from uuid import uuid4
+
+from kinappserver import app, config
+from kinappserver.utils import OS_IOS, OS_ANDROID, increment_metric, gauge_metric
+
+CAMPAIGN_PROGRESS_KEY = 'engagement-progress:%s'
+CAMPAIGN_PROGRESS_TTL_SECS = 7 * 24 * 60 * 60
+
+# refills the bucket according to the time that passed since the last call, then takes the requested
+# tokens if there are enough of them. returns the number of seconds to wait before trying again (0 on success).
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local state = redis.call('hmget', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class TokenBucket(object):
+    """a token bucket shared by all the workers, refilled at rate tokens per second"""
+
+    def __init__(self, key, rate, capacity):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), self.rate)
+        self.script = app.redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, count, now=None):
+        """takes count tokens if possible. returns the number of seconds to wait before retrying, or 0 on success"""
+        now = time.time() if now is None else now
+        return float(self.script(keys=[self.key], args=[self.rate, self.capacity, min(count, self.capacity), now]))
+
+    def acquire(self, count):
+        """blocks until count tokens are taken. returns the number of seconds spent waiting"""
+        waited = 0
+        while True:
+            wait = self.try_acquire(count)
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited = waited + wait
+
+
+def get_push_token_bucket():
+    return TokenBucket(config.ENGAGEMENT_PUSH_TOKEN_BUCKET_REDIS_KEY, config.ENGAGEMENT_PUSH_RATE_PER_SEC, config.ENGAGEMENT_PUSH_BATCH_SIZE)
+
+
+def dispatch_engagement_push(scheme, user_ids, dry_run, campaign_id=None):
+    """splits the given user_ids (a dict of os_type: [user_ids]) into chunks and enqueues a job for each chunk.
+
+    returns the id of the campaign (generated if not given), which can be used to follow its progress.
+    """
+    campaign_id = campaign_id or uuid4().hex
+    all_user_ids = [str(user_id) for user_id in user_ids[OS_IOS]] + [str(user_id) for user_id in user_ids[OS_ANDROID]]
+    chunks = [all_user_ids[i:i + config.ENGAGEMENT_PUSH_JOB_CHUNK_SIZE] for i in range(0, len(all_user_ids), config.ENGAGEMENT_PUSH_JOB_CHUNK_SIZE)]
+
+    key = CAMPAIGN_PROGRESS_KEY % campaign_id
+    pipe = app.redis.pipeline()
+    pipe.hmset(key, {'scheme': scheme, 'dry_run': int(dry_run), 'total': len(all_user_ids), 'chunks': len(chunks),
+                     'started_at': time.time(), 'sent': 0, 'no_token': 0, 'failed': 0, 'chunks_done': 0})
+    pipe.expire(key, CAMPAIGN_PROGRESS_TTL_SECS)
+    pipe.execute()
+
+    for chunk in chunks:
+        if config.DEPLOYMENT_ENV == 'test':
+            # there are no rq workers in tests - send right away
+            send_engagement_push_chunk(campaign_id, scheme, chunk, dry_run)
+            continue
+        app.rq_push.enqueue_call(func=send_engagement_push_chunk, args=(campaign_id, scheme, chunk, dry_run))
+
+    log.info('engage-push: campaign %s (scheme: %s, dry run: %s) - enqueued %s users in %s chunks' % (campaign_id, scheme, dry_run, len(all_user_ids), len(chunks)))
+    return campaign_id
+
+
+def send_engagement_push_chunk(campaign_id, scheme, user_ids, dry_run):
+    """sends the engagement push to the given chunk of user_ids. should be called in the worker"""
+    from kinappserver.models import get_users_push_data
+    from kinappserver.push import engagement_payload_apns, engagement_payload_gcm, push_send_apns_batch, push_send_gcm_batch
+
+    push_data = get_users_push_data(user_ids)
+
+    # users that share the os and the push env get the same payload
+    tokens_by_target = {}
+    no_token = 0
+    for user_id in user_ids:
+        os_type, token, push_env = push_data.get(str(user_id), (None, None, None))
+        if not token:
+            log.error('engage-push: cant push to user %s: no push token' % user_id)
+            no_token = no_token + 1
+            continue
+        tokens_by_target.setdefault((os_type, push_env), []).append(token)
+
+    bucket = get_push_token_bucket()
+    sent, failed, waited = 0, 0, 0
+    for (os_type, push_env), tokens in tokens_by_target.items():
+        for i in range(0, len(tokens), config.ENGAGEMENT_PUSH_BATCH_SIZE):
+            batch = tokens[i:i + config.ENGAGEMENT_PUSH_BATCH_SIZE]
+            if dry_run:
+                sent = sent + len(batch)
+                continue
+            try:
+                waited = waited + bucket.acquire(len(batch))
+                if os_type == OS_IOS:
+                    results = push_send_apns_batch(batch, engagement_payload_apns(scheme), push_env)
+                else:
+                    results = push_send_gcm_batch(batch, engagement_payload_gcm(scheme), push_env)
+            except Exception as e:
+                log.error('engage-push: campaign %s - failed to send a batch of %s pushes. e: %s' % (campaign_id, len(batch), e))
+                failed = failed + len(batch)
+            else:
+                # results is None when the push was skipped (e.g. on test env)
+                batch_sent = len(batch) if results is None else results.count(True)
+                sent = sent + batch_sent
+                failed = failed + len(batch) - batch_sent
+                increment_metric('sent_eng_push_%s' % scheme, batch_sent)
+
+    gauge_metric('engagement-push-rate-limit-wait', waited)
+    report_progress(campaign_id, sent, no_token, failed)
+
+
+def report_progress(campaign_id, sent, no_token, failed):
+    """adds the results of a chunk to the campaign's progress and logs it"""
+    key = CAMPAIGN_PROGRESS_KEY % campaign_id
+    pipe = app.redis.pipeline()
+    pipe.hincrby(key, 'sent', sent)
+    pipe.hincrby(key, 'no_token', no_token)
+    pipe.hincrby(key, 'failed', failed)
+    pipe.hincrby(key, 'chunks_done', 1)
+    pipe.execute()
+
+    progress = get_progress(campaign_id)
+    if progress:
+        log.info('engage-push: campaign %s - %s/%s users done, eta: %s secs' % (campaign_id, progress['done'], progress['total'], progress['eta_secs']))
+
+
+def get_progress(campaign_id):
+    """returns the progress of the given campaign, or None if there is no such campaign"""
+    progress = {k.decode(): v.decode() for k, v in app.redis.hgetall(CAMPAIGN_PROGRESS_KEY % campaign_id).items()}
+    if not progress:
+        return None
+
+    for field in ('total', 'chunks', 'sent', 'no_token', 'failed', 'chunks_done', 'dry_run'):
+        progress[field] = int(progress[field])
+    progress['dry_run'] = bool(progress['dry_run'])
+    progress['started_at'] = float(progress['started_at'])
+    progress['done'] = progress['sent'] + progress['no_token'] + progress['failed']
+
+    # estimate the time left by the rate so far
+    elapsed = time.time() - progress['started_at']
+    remaining = progress['total'] - progress['done']
+    if remaining <= 0:
+        progress['eta_secs'] = 0
+    elif progress['done'] > 0 and elapsed > 0:
+        progress['eta_secs'] = int(remaining / (progress['done'] / elapsed))
+    else:
+        progress['eta_secs'] = None
+    return progress
@@ -0,0 +1,155 @@
+"""per-offer inventory counters, and the pre-staged free goods, kept in redis.
+
+every offer has a redis hash with the number of its available, allocated (booked but not paid for)
+and redeemed goods. the counters are moved by the goods model right after it commits a change, so
+listing the offers costs no inventory queries. postgres remains the source of truth: a missing hash
+is loaded from the db on first read, and reconcile_inventory (called by cron) overwrites the counters
+that drifted.
+"""
+import logging as log
+
+from kinappserver import app
+from kinappserver.utils import increment_metric, gauge_metric
+
+INVENTORY_KEY = 'inventory:%s'
+FIELDS = ('available', 'allocated', 'redeemed')
+
+# moves the counters of an offer by the given deltas - but only if they were loaded already. a partial
+# hash would pass for the full counters, so a missing one is left for the next read to load from the db.
+MOVE_GOODS_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 1, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+move_goods_script = None
+
+
+def move_goods(offer_id, **deltas):
+    """atomically moves the counters of the given offer, for example move_goods(offer_id, available=-1, allocated=1)"""
+    global move_goods_script
+    try:
+        if move_goods_script is None:
+            move_goods_script = app.redis.register_script(MOVE_GOODS_SCRIPT)
+        args = []
+        for field, delta in deltas.items():
+            args.extend([field, delta])
+        move_goods_script(keys=[INVENTORY_KEY % offer_id], args=args)
+    except Exception as e:
+        # the reconciler will fix the counters
+        increment_metric('inventory-counter-error')
+        log.error('failed to move the inventory counters of offer %s by %s: %s' % (offer_id, deltas, e))
+
+
+def write_counters(counters):
+    """overwrites the counters of the given offers - a dict of offer_id: {field: value}"""
+    pipe = app.redis.pipeline()
+    for offer_id, offer_counters in counters.items():
+        pipe.hmset(INVENTORY_KEY % offer_id, {field: offer_counters.get(field, 0) for field in FIELDS})
+    pipe.execute()
+
+
+def get_inventory(offer_ids):
+    """returns a dict of offer_id: {'available', 'allocated', 'redeemed'} for the given offers"""
+    from kinappserver.models.good import count_goods_by_offer
+    offer_ids = [str(offer_id) for offer_id in offer_ids]
+    if not offer_ids:
+        return {}
+
+    pipe = app.redis.pipeline()
+    for offer_id in offer_ids:
+        pipe.hgetall(INVENTORY_KEY % offer_id)
+    inventory = {}
+    missing = []
+    for offer_id, counters in zip(offer_ids, pipe.execute()):
+        if counters:
+            inventory[offer_id] = {field.decode(): int(value) for field, value in counters.items()}
+        else:
+            missing.append(offer_id)
+
+    if missing:
+        loaded = count_goods_by_offer(missing)
+        loaded = {offer_id: loaded.get(offer_id, {field: 0 for field in FIELDS}) for offer_id in missing}
+        write_counters(loaded)
+        inventory.update(loaded)
+        increment_metric('inventory-counters-loaded', len(missing))
+    return inventory
+
+
+def get_available_goods(offer_ids):
+    """returns a dict of offer_id: the number of available goods"""
+    return {offer_id: counters['available'] for offer_id, counters in get_inventory(offer_ids).items()}
+
+
+def reconcile_inventory():
+    """overwrites the counters that differ from the counts in the db. returns a dict of the offers that drifted and their db counts"""
+    from kinappserver.models.good import count_goods_by_offer
+    from kinappserver.models.offer import Offer
+    offer_ids = [str(offer_id) for (offer_id,) in Offer.query.with_entities(Offer.offer_id).all()]
+    counts = count_goods_by_offer(offer_ids)
+    counts = {offer_id: counts.get(offer_id, {field: 0 for field in FIELDS}) for offer_id in offer_ids}
+
+    pipe = app.redis.pipeline()
+    for offer_id in offer_ids:
+        pipe.hgetall(INVENTORY_KEY % offer_id)
+    drifted = {}
+    for offer_id, counters in zip(offer_ids, pipe.execute()):
+        counters = {field.decode(): int(value) for field, value in counters.items()}
+        if counters != counts[offer_id]:
+            if counters:
+                log.warning('inventory: the counters of offer %s drifted: %s, should be %s' % (offer_id, counters, counts[offer_id]))
+            drifted[offer_id] = counts[offer_id]
+
+    if drifted:
+        write_counters(drifted)
+    gauge_metric('inventory-drifted-offers', len(drifted))
+    return drifted
+
+
+# the sids of an offer's free goods can be pre-staged in a redis list, so booking a good is a single LPOP
+# (plus recording the allocation in the db) rather than a search for a free row. see allocate_good.
+STAGED_GOODS_KEY = 'staged-goods:%s'
+
+
+def stage_goods(offer_id, sids):
+    """adds the given free goods to the offer's staged list"""
+    if sids:
+        app.redis.rpush(STAGED_GOODS_KEY % offer_id, *sids)
+
+
+def pop_staged_good(offer_id):
+    """takes a sid off the offer's staged list, or returns None if it is empty"""
+    sid = app.redis.lpop(STAGED_GOODS_KEY % offer_id)
+    return int(sid) if sid is not None else None
+
+
+def restage_goods(free_sids_by_offer):
+    """makes the staged lists match the given dict of offer_id: set of free sids.
+
+    sids taken off a list by a booker that died before recording the allocation are stranded - free
+    in the db, but no longer staged. they are pushed back, and sids that are no longer free are removed.
+    returns a tuple of the number of (restaged, removed) sids.
+    """
+    from kinappserver.models.offer import Offer
+    offer_ids = set(free_sids_by_offer.keys()) | {str(offer_id) for (offer_id,) in Offer.query.with_entities(Offer.offer_id).all()}
+    restaged = removed = 0
+    for offer_id in offer_ids:
+        free_sids = free_sids_by_offer.get(offer_id, set())
+        staged_sids = {int(sid) for sid in app.redis.lrange(STAGED_GOODS_KEY % offer_id, 0, -1)}
+        stranded = free_sids - staged_sids
+        stale = staged_sids - free_sids
+        pipe = app.redis.pipeline()
+        if stranded:
+            pipe.rpush(STAGED_GOODS_KEY % offer_id, *sorted(stranded))
+        for sid in stale:
+            pipe.lrem(STAGED_GOODS_KEY % offer_id, 0, sid)
+        pipe.execute()
+        restaged = restaged + len(stranded)
+        removed = removed + len(stale)
+
+    gauge_metric('staged-goods-restaged', restaged)
+    gauge_metric('staged-goods-removed', removed)
+    return restaged, removed
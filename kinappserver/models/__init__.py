@@ -1,7 +1,11 @@
 from .transaction import *
+from .user_balance import *
+from .completed_task import *
+from .task_payment import *
 from .user import *
 from .task2 import *
 from .offer import *
+from .offer_purchase import *
 from .order import *
 from .good import *
 from .p2p_transaction import *
@@ -14,6 +18,7 @@ from .backup import *
 from .email_template import *
 from .truex_blacklisted_user import *
 from .blacklisted_phone_numbers import *
+from .user_context import *
 from .system_config import *
 from .category import *
 from .app_discovery import *
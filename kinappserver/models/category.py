@@ -2,6 +2,10 @@ from kinappserver import db
 from kinappserver.utils import InvalidUsage, test_image
 import logging as log
 
+# the cache key of the user's categories
+USER_CATEGORIES_CACHE_KEY = 'categories:%s'
+
+
 class Category(db.Model):
     """Categories group tasks with similar type/topics.
        supported_os, specifies on which platform the category is supported and should be displayed.
@@ -132,28 +136,22 @@ def get_categories_for_user(user_id):
     """
 
     import time
-    from kinappserver import utils, config
+    from kinappserver import utils, config, cache
     from .user import user_exists, get_user_os_type
     from .task2 import count_immediate_tasks
 
     if not user_exists(user_id):
         raise InvalidUsage('no such user_id %s' % user_id)
 
-    cached_results = utils.read_json_from_cache(
-        config.USER_CATEGORIES_CACHE_REDIS_KEY % user_id)
-
-    if cached_results is not None:
-        log.info("user_id: %s - get_categories_for_user - cache found!" % user_id)
-        return sorted([cat for cat in cached_results.values()], key=lambda p: p['id'])
-    else:
+    def compute_categories():
         os_type = get_user_os_type(user_id)
         all_cats = list_categories(os_type)
         immediate_tasks = count_immediate_tasks(user_id)
         for cat_id in all_cats.keys():
             all_cats[cat_id]['available_tasks_count'] = immediate_tasks[cat_id]
+        return all_cats
 
-        # write to cache
-        utils.write_json_to_cache(
-            config.USER_CATEGORIES_CACHE_REDIS_KEY % user_id, all_cats)
-
-        return sorted([cat for cat in all_cats.values()], key=lambda p: p['id'])
+    # only one worker computes the categories of a user at a time
+    all_cats = cache.get_or_compute(USER_CATEGORIES_CACHE_KEY % user_id, compute_categories, config.USER_TASKS_CACHE_TTL_SECS,
+                                    tags=[utils.USER_CACHE_TAG % user_id, utils.TASKS_CATALOG_CACHE_TAG])
+    return sorted([cat for cat in all_cats.values()], key=lambda p: p['id'])
@@ -0,0 +1,145 @@
+import logging as log
+
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db, config, app
+from kinappserver.utils import invalidate_user_cache
+
+# set once the legacy completed tasks of all the users were copied. until then, the legacy tasks of every user
+# are copied on first use - a user with rows in completed_task was copied (or had its tasks replaced) already
+BACKFILLED_KEY = 'completed-tasks-backfilled'
+
+# the legacy completed tasks of a user, as rows of (user_id, task_id, category_id, completed_at)
+LEGACY_COMPLETED_TASKS_SQL = '''select uad.user_id, json_array_elements_text(cats.value), cats.key, uad.update_at
+                                from user_app_data uad,
+                                     json_each(case when json_typeof(uad.completed_tasks_dict) = 'object' then uad.completed_tasks_dict else '{}' end) cats'''
+
+
+class CompletedTask(db.Model):
+    """a single task completed by a user - one row per (user_id, task_id).
+
+       this replaces user_app_data.completed_tasks_dict: completing a task is a single insert
+       rather than a rewrite of the user's whole history, so concurrent submissions cant
+       overwrite each other.
+    """
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=True, nullable=False)
+    task_id = db.Column(db.String(40), nullable=False, primary_key=True)
+    category_id = db.Column(db.String(40), nullable=False, primary_key=False)
+    completed_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now())
+
+    def __repr__(self):
+        return '<user_id: %s, task_id: %s, category_id: %s, completed_at: %s>' % (self.user_id, self.task_id, self.category_id, self.completed_at)
+
+
+_backfilled = False
+
+
+def is_backfilled():
+    """returns True once the legacy completed tasks of all the users were copied"""
+    global _backfilled
+    if not _backfilled:
+        # it never goes back - so only check redis until it is set
+        _backfilled = bool(app.redis.exists(BACKFILLED_KEY))
+    return _backfilled
+
+
+def copy_legacy_completed_tasks(user_ids):
+    """copies the legacy completed tasks of the given users that have no completed tasks yet. a no-op after the backfill"""
+    if is_backfilled():
+        return
+    db.engine.execute('''insert into completed_task (user_id, task_id, category_id, completed_at)
+                         %s
+                         where uad.user_id = any(%%s::uuid[]) and not exists (select 1 from completed_task ct where ct.user_id = uad.user_id)
+                         on conflict do nothing;''' % LEGACY_COMPLETED_TASKS_SQL, ([str(user_id) for user_id in user_ids],))
+
+
+def add_completed_task(user_id, cat_id, task_id):
+    """marks the given task as completed by the user. returns False if it was already marked"""
+    copy_legacy_completed_tasks([user_id])
+    res = db.engine.execute('''insert into completed_task (user_id, task_id, category_id, completed_at) values (%s, %s, %s, now()) on conflict do nothing;''', (str(user_id), str(task_id), str(cat_id)))
+    return res.rowcount == 1
+
+
+def remove_completed_task(user_id, task_id):
+    """un-marks the given task. returns False if the task wasn't marked as completed"""
+    copy_legacy_completed_tasks([user_id])
+    res = db.engine.execute('''delete from completed_task where user_id=%s and task_id=%s;''', (str(user_id), str(task_id)))
+    invalidate_user_cache(user_id)
+    return res.rowcount == 1
+
+
+def get_completed_tasks(user_id):
+    """returns the user's completed tasks as a dict of cat_id: set of task_ids"""
+    copy_legacy_completed_tasks([user_id])
+    completed_tasks = {}
+    res = db.engine.execute('''select category_id, task_id from completed_task where user_id=%s;''', (str(user_id),))
+    for cat_id, task_id in res.fetchall():
+        completed_tasks.setdefault(cat_id, set()).add(task_id)
+    return completed_tasks
+
+
+def get_completed_tasks_for_users(user_ids):
+    """returns the completed tasks of each of the given users, as a dict of user_id: {cat_id: set of task_ids}"""
+    copy_legacy_completed_tasks(user_ids)
+    completed_tasks = {str(user_id): {} for user_id in user_ids}
+    res = db.engine.execute('''select user_id, category_id, task_id from completed_task where user_id = any(%s::uuid[]);''', ([str(user_id) for user_id in user_ids],))
+    for user_id, cat_id, task_id in res.fetchall():
+        completed_tasks[str(user_id)].setdefault(cat_id, set()).add(task_id)
+    return completed_tasks
+
+
+def count_completed_tasks(user_id):
+    """returns the total number of tasks completed by the user"""
+    copy_legacy_completed_tasks([user_id])
+    return db.engine.execute('''select count(*) from completed_task where user_id=%s;''', (str(user_id),)).scalar()
+
+
+def set_completed_tasks(user_id, completed_tasks_dict):
+    """replaces the user's completed tasks with the given dict of cat_id: [task_ids]. drops the user's cached tasks"""
+    rows = [(str(user_id), str(task_id), str(cat_id)) for cat_id in completed_tasks_dict for task_id in completed_tasks_dict[cat_id]]
+    with db.engine.begin() as conn:
+        conn.execute('''delete from completed_task where user_id=%s;''', (str(user_id),))
+        if rows:
+            conn.execute('''insert into completed_task (user_id, task_id, category_id, completed_at) values (%s, %s, %s, now()) on conflict do nothing;''', rows)
+    invalidate_user_cache(user_id)
+
+
+def copy_completed_tasks(from_user_id, to_user_id):
+    """replaces to_user_id's completed tasks with those of from_user_id"""
+    copy_legacy_completed_tasks([from_user_id])
+    with db.engine.begin() as conn:
+        conn.execute('''delete from completed_task where user_id=%s;''', (str(to_user_id),))
+        conn.execute('''insert into completed_task (user_id, task_id, category_id, completed_at) select %s, task_id, category_id, completed_at from completed_task where user_id=%s;''', (str(to_user_id), str(from_user_id)))
+    invalidate_user_cache(to_user_id)
+
+
+# copies the legacy completed tasks of the next batch of users (by user_id) that weren't copied yet, and returns the
+# batch's last user_id and the number of copied tasks. each batch is a single, short transaction
+BACKFILL_COMPLETED_TASKS_BATCH_SQL = '''with batch as (select user_id from user_app_data where user_id > %%s order by user_id limit %%s),
+                                     copied as (insert into completed_task (user_id, task_id, category_id, completed_at)
+                                                %s
+                                                where uad.user_id in (select user_id from batch)
+                                                and not exists (select 1 from completed_task ct where ct.user_id = uad.user_id)
+                                                on conflict do nothing returning 1)
+                                     select (select user_id from batch order by user_id desc limit 1), (select count(*) from copied);''' % LEGACY_COMPLETED_TASKS_SQL
+
+
+def backfill_completed_tasks():
+    """copies the completed tasks of all users from the legacy user_app_data.completed_tasks_dict column.
+
+    the users are copied in batches of COMPLETED_TASKS_BACKFILL_BATCH_SIZE, in user_id order. once done, the
+    legacy tasks are no longer copied on first use. safe to run more than once - users that were already copied are skipped.
+    """
+    copied = 0
+    last_user_id = '00000000-0000-0000-0000-000000000000'
+    while True:
+        # a statement starting with 'with' isn't detected as a write - ask for the commit explicitly
+        last_user_id, batch_copied = db.engine.execution_options(autocommit=True).execute(
+            BACKFILL_COMPLETED_TASKS_BATCH_SQL, (str(last_user_id), config.COMPLETED_TASKS_BACKFILL_BATCH_SIZE)).fetchone()
+        if last_user_id is None:
+            break
+        copied = copied + batch_copied
+        log.info('backfill_completed_tasks: copied %s completed tasks so far, up to user_id %s' % (copied, last_user_id))
+    app.redis.set(BACKFILLED_KEY, 1)
+    log.info('backfill_completed_tasks: copied %s completed tasks' % copied)
+    return copied
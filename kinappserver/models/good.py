@@ -1,8 +1,11 @@
+import time
 import arrow
 import logging as log
+from sqlalchemy import text
 from kinappserver import db
-from kinappserver.utils import InternalError
+from kinappserver.utils import InternalError, increment_metric, timing_metric
 from kinappserver import config
+from kinappserver.inventory import move_goods, get_inventory, get_available_goods, stage_goods, pop_staged_good, restage_goods
 from sqlalchemy_utils import UUIDType, ArrowType
 
 from .offer import Offer
@@ -57,6 +60,9 @@ def create_good(offer_id, good_type, value, extra_info=None):
         log.error('failed to create a new good. e:%s' % e)
         raise InternalError('failed to create a new good')
     else:
+        move_goods(offer_id, available=1)
+        if config.GOODS_PRESTAGING_ENABLED:
+            stage_goods(offer_id, [good.sid])
         return True
 
 
@@ -72,12 +78,24 @@ def list_all_goods():
 def list_inventory():
     """for each offer_id, generate a dict with the number of total goods and unallocated ones"""
     res = {}
-    offers = Offer.query.order_by(Offer.offer_id).all()
-    for offer in offers:
-        res[offer.offer_id] = {'total': count_total_goods(offer.offer_id), 'unallocated': count_available_goods(offer.offer_id)}
+    offer_ids = [offer_id for (offer_id,) in Offer.query.with_entities(Offer.offer_id).order_by(Offer.offer_id).all()]
+    for offer_id, counters in get_inventory(offer_ids).items():
+        res[offer_id] = {'total': sum(counters.values()), 'unallocated': counters['available']}
     return res
 
 
+def count_goods_by_offer(offer_ids):
+    """returns a dict of offer_id: {'available', 'allocated', 'redeemed'} with the number of goods in each state.
+       offers without any goods are omitted"""
+    results = db.engine.execute('''select offer_id,
+                                         count(*) filter (where order_id is null),
+                                         count(*) filter (where order_id is not null and tx_hash is null),
+                                         count(*) filter (where tx_hash is not null)
+                                  from good where offer_id = any(%s) group by offer_id;''', ([str(offer_id) for offer_id in offer_ids],))
+    return {offer_id: {'available': available, 'allocated': allocated, 'redeemed': redeemed}
+            for offer_id, available, allocated, redeemed in results.fetchall()}
+
+
 def count_total_goods(offer_id):
     offer_id = int(offer_id)  # sanitize input
     results = db.engine.execute("select count(sid) from good where good.offer_id=\'%s\';" % str(offer_id))  # safe
@@ -91,27 +109,65 @@ def count_available_goods(offer_id):
     return(results.fetchone()[0])
 
 
+# allocates a free good of the offer to the order, and returns its sid - or nothing if there are no free goods
+ALLOCATE_GOOD_SQL = '''update good set order_id=%s, updated_at=now()
+                         where sid=(select sid from good where offer_id=%s and order_id is null limit 1 for update skip locked)
+                         and order_id is null returning sid;'''
+
+
 def allocate_good(offer_id, order_id):
     """find and allocate a good to an order.
        returns the good sid on success or None if no goods are available"""
 
     #TODO ensure the order hasn't expired?
 
+    if config.GOODS_PRESTAGING_ENABLED:
+        sid = allocate_staged_good(offer_id, order_id)
+        if sid:
+            move_goods(offer_id, available=-1, allocated=1)
+            return sid
+
     try:
-        # lock the line until the commit is complete
-        good = db.session.query(Good).filter(Good.offer_id==offer_id).filter(Good.order_id == None).with_for_update().first()
-        if not good:
-            return None
-        good.order_id = order_id
-        db.session.add(good)
-        db.session.commit()
-        db.session.flush()
+        # a single statement, so it holds the row lock until it commits - also with an autocommit engine.
+        # concurrent bookers skip the locked rows rather than queue on them, and the guard never takes an allocated good
+        res = db.engine.execute(ALLOCATE_GOOD_SQL, (order_id, str(offer_id)))
+        row = res.fetchone()
     except Exception as e:
-        db.session.rollback()
         log.error('failed to allocate good with order_id: %s. exception: %s' % (order_id, e))
         raise InternalError('cant allocate good for order_id: %s' % order_id)
-    else:
-        return good.sid
+    if not row:
+        return None
+    move_goods(offer_id, available=-1, allocated=1)
+    return row[0]
+
+
+def allocate_staged_good(offer_id, order_id):
+    """allocates a good off the offer's staged list. returns the good sid, or None if there are no staged goods.
+
+       the list might hold goods that were since allocated by the db search - the update only takes free ones.
+    """
+    for _ in range(config.GOODS_PRESTAGING_MAX_POPS):
+        sid = pop_staged_good(offer_id)
+        if sid is None:
+            return None
+        try:
+            res = db.engine.execute('''update good set order_id=%s, updated_at=now() where sid=%s and order_id is null returning sid;''', (order_id, sid))
+            if res.fetchone():
+                return sid
+        except Exception as e:
+            # put it back for another booker - or for the reconciler to sort out
+            stage_goods(offer_id, [sid])
+            log.error('failed to allocate staged good %s with order_id: %s. exception: %s' % (sid, order_id, e))
+            raise InternalError('cant allocate good for order_id: %s' % order_id)
+    return None
+
+
+def restage_free_goods():
+    """re-stages the free goods that aren't staged, and un-stages the ones that were allocated. returns (restaged, removed)"""
+    free_sids_by_offer = {}
+    for offer_id, sid in db.engine.execute('''select offer_id, sid from good where order_id is null;''').fetchall():
+        free_sids_by_offer.setdefault(offer_id, set()).add(sid)
+    return restage_goods(free_sids_by_offer)
 
 
 def finalize_good(order_id, tx_hash):
@@ -126,6 +182,7 @@ def finalize_good(order_id, tx_hash):
         else:
             good_res['type'] = good.good_type
             good_res['value'] = good.value
+            offer_id = good.offer_id
             good.tx_hash = tx_hash
             db.session.add(good)
             db.session.commit()
@@ -135,6 +192,7 @@ def finalize_good(order_id, tx_hash):
         log.error('failed to finalize good with order_id: %s. exception: %s' % (order_id, e))
         raise InternalError('cant finalize good for order_id: %s' % order_id)
     else:
+        move_goods(offer_id, allocated=-1, redeemed=1)
         return True, good_res
 
 
@@ -143,6 +201,8 @@ def release_good(order_id):
     try:
         # lock the line until the commit is compelete
         good = db.session.query(Good).filter(Good.order_id == order_id).with_for_update().one()
+        offer_id = good.offer_id
+        sid = good.sid
         good.order_id = None
         db.session.add(good)
         db.session.commit()
@@ -152,30 +212,61 @@ def release_good(order_id):
         db.session.rollback()
         return False
     else:
+        move_goods(offer_id, allocated=-1, available=1)
+        if config.GOODS_PRESTAGING_ENABLED:
+            stage_goods(offer_id, [sid])
         return True
 
 
+# there are no migrations - the index is added to existing order tables by the job that uses it
+ORDER_CREATED_AT_INDEX_SQL = '''create index %s if not exists ix_order_created_at on "order" (created_at);'''
+
+# deletes the expired orders, and releases the goods that they allocated and that were never paid for
+RELEASE_EXPIRED_ORDERS_SQL = '''with expired as (delete from "order" where created_at < (now() at time zone 'utc') - %s * interval '1 second'
+                                                returning order_id)
+                                update good set order_id = null, updated_at = now() from expired
+                                where good.order_id = expired.order_id and good.tx_hash is null
+                                returning good.offer_id, good.sid;'''
+
+# releases the unpaid goods whose order is gone - for example, because creating the order failed after the allocation
+RELEASE_ORPHANED_GOODS_SQL = '''update good set order_id = null, updated_at = now()
+                                where order_id is not null and tx_hash is null and updated_at < now() - %s * interval '1 second'
+                                and not exists (select 1 from "order" o where o.order_id = good.order_id)
+                                returning offer_id, sid;'''
+
+
 def release_unclaimed_goods():
-    """traverse the list of goods and release those associated with expired goods
-        
+    """deletes the expired orders and releases the goods associated with them, with a couple of set-based statements
+
        this should be called by cron every minute or so
     """
     print('releasing unclaimed goods...')
-    released = 0
-    goods = db.session.query(Good).filter(Good.tx_hash == None).filter(Good.order_id != None).all()
-    for good in goods:
-        from .order import has_expired # don't move me to prevent cyclical deps
-        if has_expired(good.order_id):
-            release_good(good.order_id)
-            released = released + 1
+    start = time.time()
+    concurrently = 'concurrently' if config.DEPLOYMENT_ENV in ['prod', 'stage'] else ''
+    db.engine.execute(ORDER_CREATED_AT_INDEX_SQL % concurrently)
+
+    released = []
+    for statement in (RELEASE_EXPIRED_ORDERS_SQL, RELEASE_ORPHANED_GOODS_SQL):
+        # a statement starting with 'with' isn't detected as a write - ask for the commit explicitly
+        released.extend(db.engine.execute(text(statement % int(config.ORDER_EXPIRATION_SECS)).execution_options(autocommit=True)).fetchall())
+
+    released_by_offer = {}
+    for offer_id, sid in released:
+        released_by_offer.setdefault(offer_id, []).append(sid)
+    for offer_id, sids in released_by_offer.items():
+        move_goods(offer_id, allocated=-len(sids), available=len(sids))
+        if config.GOODS_PRESTAGING_ENABLED:
+            stage_goods(offer_id, sids)
 
-    log.info('released %s goods' % released)
-    return released
+    timing_metric('release-unclaimed-goods-duration', (time.time() - start) * 1000)
+    increment_metric('expired-goods-released', len(released))
+    log.info('released %s goods in %.3f secs' % (len(released), time.time() - start))
+    return len(released)
 
 
 def goods_avilable(offer_id):
     """returns true if the given offer_id has avilable goods"""
-    return db.session.query(Good).filter(Good.offer_id == offer_id).filter(Good.order_id == None).count()>0
+    return get_available_goods([offer_id]).get(str(offer_id), 0) > 0
 
 
 def get_redeemed_items(tx_hases):
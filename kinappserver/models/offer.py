@@ -1,7 +1,6 @@
 from kinappserver import db, config, utils
 from kinappserver.utils import InvalidUsage, test_image, OS_ANDROID, OS_IOS
 import logging as log
-from datetime import datetime, timedelta
 
 class Offer(db.Model):
     """the Offer class represent a single offer"""
@@ -140,7 +139,7 @@ def get_offers_for_user(user_id):
     import time
     from distutils.version import LooseVersion
     from .user import get_user_app_data, get_user_os_type, get_user_inapp_balance
-    from .good import goods_avilable
+    from kinappserver.inventory import get_available_goods
 
     all_offers = Offer.query.filter_by(is_active=True).order_by(Offer.kin_cost.asc()).all()
 
@@ -154,7 +153,8 @@ def get_offers_for_user(user_id):
     end = time.time()
     log.info("## GETTING user_balance MID PTIME: %s", end - start)
 
-    # filter out offers with no goods
+    # filter out offers with no goods. the counters of all the offers are read at once, from redis
+    available_goods = get_available_goods([offer.offer_id for offer in all_offers])
     available_offers = []
     unavailable_offers = []
     for offer in all_offers:
@@ -163,7 +163,7 @@ def get_offers_for_user(user_id):
             # we may want to add it again in the future, in which case we will have
             # to handle it being on top of the list + appear only for versions that support it.
             continue
-        elif not goods_avilable(offer.offer_id):
+        elif available_goods.get(str(offer.offer_id), 0) <= 0:
             offer.unavailable_reason = 'Sold out\nCheck back again soon'
             unavailable_offers.append(offer)
         elif str(offer.offer_id) in locked_offers_ids:
@@ -223,36 +223,20 @@ def get_offer_details(offer_id):
     return {'title': offer.title, 'desc': offer.desc, 'provider': offer.provider_data}
 
 
-def set_locked_offers(user_id, days):
-    """ scan the db for offers bought in the last {days} and update USER_LOCKED_OFFERS_REDIS_KEY"""
-    log.info("user_id: %s - not cache - set_locked_offers! " % user_id)
-    date_days_from_now = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-    offers_bought_in_time_range = db.engine.execute("select tx_info, update_at from public.transaction "
-                                                    "where user_id='%s' and incoming_tx=true "
-                                                    "and update_at > ('%s'::date);" % (user_id, date_days_from_now)).fetchall()
-    # extract data from result
-    offers_bought_in_time_range_ids = [item[0]['offer_id'] for item in offers_bought_in_time_range]
-    offers_bought_in_time_range_timestamp = [item[1].strftime('%m/%d/%Y') for item in offers_bought_in_time_range]
-    # build locked_offers_ids array
-    locked_offers_ids = dict(zip(offers_bought_in_time_range_ids, offers_bought_in_time_range_timestamp))
-    # write to cache
-    utils.write_json_to_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id, locked_offers_ids)
-    log.info("user_id: %s - locked_offers_ids: %s" % (user_id, locked_offers_ids))
-    return locked_offers_ids.keys()
+def get_offers_details(offer_ids):
+    """return a dict of offer_id: the offer's details (see get_offer_details) for the given offer_ids, with a single query"""
+    offer_ids = {str(offer_id) for offer_id in offer_ids}
+    if not offer_ids:
+        return {}
+    details = {offer.offer_id: {'title': offer.title, 'desc': offer.desc, 'provider': offer.provider_data}
+               for offer in Offer.query.filter(Offer.offer_id.in_(offer_ids)).all()}
+    for offer_id in offer_ids - set(details.keys()):
+        log.error('cant find offer with id %s. using default text' % offer_id)
+        details[offer_id] = {'title': 'unknown offer', 'desc': '', 'provider': {}}
+    return details
 
 
 def get_locked_offers(user_id, days):
-    """return list of locked offers"""
-    # first check if we have a cached result.
-    locked_offers_ids = utils.read_json_from_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id)
-    if locked_offers_ids is not None:
-        log.info("user_id: %s - get_locked_offers - cache found!" % user_id)
-        # we need to check if offer's timestamp is old enough to be unlocked
-        locked_offers_ids = {k: v for k, v in locked_offers_ids.items() if datetime.strptime(v, '%m/%d/%Y') + timedelta(days=days) > datetime.now()}
-        # update cache
-        utils.write_json_to_cache(config.USER_LOCKED_OFFERS_REDIS_KEY % user_id, locked_offers_ids)
-        log.info("user_id: %s - locked_offers_ids: %s" % (user_id, locked_offers_ids))
-        return locked_offers_ids.keys()
-    else:
-        # cache not available, query the db store and return the result
-        return set_locked_offers(user_id, days)
+    """return the set of offers the user can't buy, as the user already bought them in the last {days}"""
+    from .offer_purchase import get_offers_purchased_since
+    return get_offers_purchased_since(user_id, days)
@@ -0,0 +1,50 @@
+import logging as log
+
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db
+
+
+class OfferPurchase(db.Model):
+    """an offer bought by a user - one row per paid order, written by process_order.
+
+       the offer rate limits are checked with an indexed range query on this table, rather
+       than by scanning the user's incoming txs by date.
+    """
+    tx_hash = db.Column(db.String(100), nullable=False, primary_key=True)
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=False, nullable=False)
+    offer_id = db.Column(db.String(40), nullable=False, primary_key=False)
+    purchased_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), nullable=False)
+
+    __table_args__ = (db.Index('ix_offer_purchase_user_id_purchased_at', 'user_id', 'purchased_at'),)
+
+    def __repr__(self):
+        return '<tx_hash: %s, user_id: %s, offer_id: %s, purchased_at: %s>' % (self.tx_hash, self.user_id, self.offer_id, self.purchased_at)
+
+
+def record_offer_purchase(user_id, offer_id, tx_hash):
+    """records that the user bought the given offer. returns False if the purchase was already recorded"""
+    res = db.engine.execute('''insert into offer_purchase (tx_hash, user_id, offer_id, purchased_at) values (%s, %s, %s, now()) on conflict do nothing;''',
+                            (tx_hash, str(user_id), str(offer_id)))
+    return res.rowcount == 1
+
+
+def get_offers_purchased_since(user_id, days):
+    """returns the set of offer_ids the user bought in the last {days}"""
+    results = db.engine.execute('''select distinct offer_id from offer_purchase where user_id=%s and purchased_at > now() - %s * interval '1 day';''',
+                                (str(user_id), int(days)))
+    return {offer_id for (offer_id,) in results.fetchall()}
+
+
+def backfill_offer_purchases(days):
+    """records the purchases of the last {days} from the incoming txs. returns the number of recorded purchases"""
+    res = db.engine.execute('''insert into offer_purchase (tx_hash, user_id, offer_id, purchased_at)
+                               select tx_hash, user_id, tx_info->>'offer_id', update_at from transaction
+                               where incoming_tx=true and tx_info->>'offer_id' is not null and update_at > now() - %s * interval '1 day'
+                               on conflict do nothing;''', (int(days),))
+    log.info('backfilled %s offer purchases' % res.rowcount)
+    return res.rowcount
+
+
+def delete_user_offer_purchases(user_id):
+    db.engine.execute('''delete from offer_purchase where user_id=%s;''', (str(user_id),))
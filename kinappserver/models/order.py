@@ -20,7 +20,7 @@ class Order(db.Model):
     user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=False, nullable=False)
     kin_amount = db.Column(db.Integer(), nullable=False, primary_key=False)
     address = db.Column(db.String(80), nullable=False, primary_key=False)
-    created_at = db.Column(ArrowType)
+    created_at = db.Column(ArrowType, index=True)
 
     def __repr__(self):
         return '<order_id: %s, offer_id: %s, user_id: %s, kin_amount: %s, created_at: %s>' % (self.order_id, self.offer_id, self.user_id, self.kin_amount, self.created_at)
@@ -101,16 +101,10 @@ def get_orders_for_user(user_id):
 
        returns a dict with the order-id as its key and the order object as value
     """
-    orders = Order.query.filter_by(user_id=user_id).all()
-    active_orders = {}
-    now = arrow.utcnow()
-    for order in orders:
-        # filter out expired orders
-        if (now - order.created_at).total_seconds() <= config.ORDER_EXPIRATION_SECS:
-            active_orders[str(order.order_id)] = order
-    return active_orders
-
-    #TODO cleanup old, un-used orders
+    # expired orders are filtered out - and deleted by release_unclaimed_goods
+    oldest_active = arrow.utcnow().shift(seconds=-config.ORDER_EXPIRATION_SECS)
+    orders = Order.query.filter_by(user_id=user_id).filter(Order.created_at >= oldest_active).all()
+    return {str(order.order_id): order for order in orders}
 
 
 def get_order_by_memo(memo):
@@ -170,7 +164,7 @@ def process_order(user_id, tx_hash):
     except Exception as e:
         log.error('failed to delete order %s' % order.order_id)
 
-    # update locked_offers
-    from kinappserver.models.offer import set_locked_offers
-    set_locked_offers(user_id, config.OFFER_LIMIT_TIME_RANGE)
+    # the purchase locks the offer for this user for a while
+    from .offer_purchase import record_offer_purchase
+    record_offer_purchase(user_id, order.offer_id, tx_hash)
     return True, goods
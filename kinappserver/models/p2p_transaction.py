@@ -21,6 +21,9 @@ class P2PTransaction(db.Model):
     receiver_address = db.Column('receiver_address', db.String(60), nullable=False, unique=False)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (db.Index('ix_p2_p_transaction_sender_user_id_update_at', 'sender_user_id', 'update_at', 'tx_hash'),
+                      db.Index('ix_p2_p_transaction_receiver_user_id_update_at', 'receiver_user_id', 'update_at', 'tx_hash'))
+
     def __repr__(self):
         return '<p2ptx_hash: %s, sender_user_id: %s, receiver_user_id: %s, ' \
                'amount: %s, sender_address: %s, receiver_address: %s, update_at: %s>' % (self.tx_hash, self.sender_user_id, self.receiver_user_id,
@@ -33,7 +36,7 @@ def list_p2p_transactions_for_user_id(user_id, max_txs=None):
     receiver_txs = P2PTransaction.query.filter(P2PTransaction.receiver_user_id == user_id).order_by(desc(P2PTransaction.update_at)).all()
     # join and trim the amount of txs
     txs = receiver_txs + sender_txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
+    txs = txs[:max_txs] if max_txs and max_txs < len(txs) else txs
     return txs
 
 
@@ -1,19 +1,30 @@
 
 from sqlalchemy_utils import UUIDType, ArrowType
 import arrow
+import copy
 import logging as log
 import json
 from ast import literal_eval
+from bisect import bisect_right
+from collections import namedtuple
+from distutils.version import LooseVersion
+from flask import g, has_request_context
 
 from kinappserver import db, config, app
 from kinappserver.models.task import Task
 from kinappserver.push import send_please_upgrade_push
-from kinappserver.utils import InvalidUsage, InternalError, seconds_to_local_nth_midnight, OS_ANDROID, OS_IOS, DEFAULT_MIN_CLIENT_VERSION, test_image, test_url, get_country_code_by_ip, increment_metric, commit_json_changed_to_orm
+from kinappserver.utils import InvalidUsage, InternalError, seconds_to_local_nth_midnight, OS_ANDROID, OS_IOS, DEFAULT_MIN_CLIENT_VERSION, test_image, test_url, get_country_code_by_ip, increment_metric, commit_json_changed_to_orm, USER_CACHE_TAG, TASKS_CATALOG_CACHE_TAG
+from kinappserver import cache
 from kinappserver.models import store_next_task_results_ts, get_next_task_results_ts, get_user_os_type, get_user_app_data, get_unenc_phone_number_by_user_id
 from .truex_blacklisted_user import is_user_id_blacklisted_for_truex
+from .completed_task import add_completed_task, remove_completed_task, get_completed_tasks
 
 TASK_TYPE_TRUEX = 'truex'
 
+# cache keys of the user's next tasks - one per category, and the ids of all the categories
+NEXT_TASKS_CACHE_KEY = 'tasks:%s:%s'
+NEXT_TASKS_CAT_IDS_CACHE_KEY = 'tasks-cat-ids:%s'
+
 
 class UserTaskResults(db.Model):
     """
@@ -50,9 +61,8 @@ def calculate_timeshift(user_id, delay_days=1):
     return seconds_to_midnight
 
 
-# TODO add cache
 def get_cat_id_for_task_id(task_id):
-    return get_task_by_id(task_id)['cat_id']
+    return get_task_catalog()['tasks'][str(task_id)]['cat_id']
 
 
 def store_task_results(user_id, task_id, results):
@@ -82,26 +92,14 @@ def store_task_results(user_id, task_id, results):
             increment_metric('overwrite-task-results')
 
         # write down the completed task-id
-        from kinappserver.models import UserAppData
-        user_app_data = UserAppData.query.filter_by(user_id=user_id).first()
-        if user_app_data is None:
-            log.error('cant retrieve user app data for user:%s' % user_id)
-            raise InternalError('cant retrieve user app data for user:%s' % user_id)
-
         cat_id = get_cat_id_for_task_id(task_id)
         if not cat_id:
             log.error('cant find cat_id for task_id %s' % task_id)
             raise InternalError('cant find cat_id for task_id %s' % task_id)
 
-        if cat_id in user_app_data.completed_tasks_dict:
-            if task_id not in user_app_data.completed_tasks_dict[cat_id]:
-                user_app_data.completed_tasks_dict[cat_id].append(task_id)
-        else:
-            user_app_data.completed_tasks_dict[cat_id] = [task_id]
-
-        commit_json_changed_to_orm(user_app_data, ['completed_tasks_dict'])
+        add_completed_task(user_id, cat_id, task_id)
 
-        log.info('wrote user_app_data.completed_tasks for userid: %s' % user_id)
+        log.info('wrote completed task %s for userid: %s' % (task_id, user_id))
 
         # calculate the next valid submission time, and store it:
         delay_days = None
@@ -204,44 +202,31 @@ def next_task_id_for_category(os_type, app_ver, completed_tasks, cat_id, user_id
      if the next task_id requires an upgrade, send push and return an empty set
      if no task can be matched return an empty set
      """
-    if not completed_tasks:
-        remove_previous_tasks_clause = ''
-    else:
-        completed_tasks_for_cat_id = completed_tasks.get(cat_id, None)
-        if not completed_tasks_for_cat_id:
-            remove_previous_tasks_clause = ''
-        else:
-            # oh man, this is ugly: convert ['0','1'] to ["\'0\'", ...] and then to "\'0\',\'1\',\'2\'"
-            completed_tasks_for_cat_id = ["\'%s\'" % id for id in completed_tasks_for_cat_id]
-            remove_previous_tasks_clause = '''and task2.task_id not in (%s)''' % (",".join(completed_tasks_for_cat_id))
-    # get ALL the unsolved task_ids for the category
-    stmt = '''SELECT task2.task_id FROM task2 WHERE task2.category_id='%s' %s order by task2.position, task2.task_start_date;''' % (cat_id, remove_previous_tasks_clause)
-    res = db.engine.execute(stmt)
-    unsolved_task_ids = [item[0] for item in res.fetchall()]
-    log.info('unsolved tasks for cat_id %s: %s' % (cat_id, unsolved_task_ids))
+    completed_task_ids = completed_tasks.get(cat_id, []) if completed_tasks else []
+    truex_blacklisted_task_ids = get_truex_blacklisted_task_ids()
+    client_version = LooseVersion(app_ver)
+    now = arrow.utcnow()
 
     # go over all the yet-unsolved tasks and get the first valid one
-    for task_id in unsolved_task_ids:
-        task = get_task_by_id(task_id)
+    for entry in get_unsolved_task_entries_for_category(cat_id, completed_task_ids):
+        task_id = entry.task_id
 
         # skip inactive ad-hoc tasks
-        if not is_task_active(task_id):
+        if not is_task_entry_active(entry, now):
             log.info('skipping task_id %s - inactive ad-hoc task' % task_id)
             continue
 
         # skip truex and truex-related tasks
-        if should_skip_task(user_id, task_id, None, user_country_code):
-            # we're skipping this task
-            # log.info('skipping truex-related task_id %s for user %s' % (task_id, user_id))
+        if entry.is_truex or task_id in truex_blacklisted_task_ids:
             continue
 
         # skip country-blocked tasks
-        if user_country_code in task['excluded_country_codes']:
+        if user_country_code in entry.excluded_country_codes:
             # we're skipping this task
             log.info('skipping task_id %s for user %s with country-code %s' % (task_id, user_id, user_country_code))
             continue
 
-        if not can_client_support_task(os_type, app_ver, task):
+        if client_version < get_task_entry_min_client_version(entry, os_type):
             log.info('next_task_id_for_category no available tasks for user_id %s in cat_id %s because task %s needs '
                      'higher version' % (user_id, cat_id, task_id))
             if send_push:
@@ -265,42 +250,76 @@ def get_next_tasks_for_user(user_id, source_ip=None, cat_ids=[], send_push=True,
     - if the next task (in each category) requires upgrade, the function will send a push message to inform the user (with a cooldown).
     """
 
-    from kinappserver.utils import write_json_to_cache, read_json_from_cache
-    
     log.info('in get_next_tasks_for_user %s, source_ip: %s, cat_ids:%s, send_push:%s' % (user_id, source_ip, cat_ids, send_push))
     
-    cached_results = None
+    cached_results, tag_versions = None, None
     if use_cache:
         # return cached result if we have it
-        cached_results = read_json_from_cache(config.USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY % (user_id, str(cat_ids)))
+        cached_results, tag_versions = read_next_tasks_from_cache(user_id, cat_ids)
     
     if cached_results is not None:
         log.info("user_id: %s - get_next_tasks_for_user - cache found!" % user_id)
         return cached_results
     else:
-        tasks_per_category = {}
-        user_app_data = get_user_app_data(user_id)
-        os_type = get_user_os_type(user_id)
+        # load everything we need about the user once, rather than once per category
+        from .user import get_user_and_app_data, get_next_task_memos
+        user, user_app_data = get_user_and_app_data(user_id)
+        completed_tasks = get_completed_tasks(user_id)
+        os_type = user.os_type
         app_ver = user_app_data.app_ver
+        user_country_code = get_country_code_by_ip(source_ip)
+        next_task_ts_dict = user_app_data.next_task_ts_dict or {}
+
+        tasks_per_category = {}
         from .category import get_all_cat_ids
         for cat_id in cat_ids or get_all_cat_ids():
-            task_ids = next_task_id_for_category(os_type, app_ver, user_app_data.completed_tasks_dict, cat_id, user_id, get_country_code_by_ip(source_ip), send_push)  # returns just one task in a list or empty list
+            task_ids = next_task_id_for_category(os_type, app_ver, completed_tasks, cat_id, user_id, user_country_code, send_push)  # returns just one task in a list or empty list
             tasks_per_category[cat_id] = [get_task_by_id(task_id) for task_id in task_ids]
-            # plant the memo and start date in the first task of the category:
-            from .user import get_next_task_memo
-            from .user import get_next_task_results_ts
-            if len(tasks_per_category[cat_id]) > 0:
-                tasks_per_category[cat_id][0]['memo'] = get_next_task_memo(user_id, cat_id)
-                tasks_per_category[cat_id][0]['start_date'] = get_next_task_results_ts(user_id, cat_id)
+
+        # plant the memo and start date in the first task of each category:
+        memos = get_next_task_memos(user_app_data, [cat_id for cat_id in tasks_per_category if len(tasks_per_category[cat_id]) > 0])
+        for cat_id in memos:
+            tasks_per_category[cat_id][0]['memo'] = memos[cat_id]
+            tasks_per_category[cat_id][0]['start_date'] = next_task_ts_dict.get(cat_id, 0)
 
         # store result in cache
         if use_cache:
-            write_json_to_cache(config.USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY % (
-                user_id, str(cat_ids)), tasks_per_category)
+            write_next_tasks_to_cache(user_id, cat_ids, tasks_per_category, tag_versions)
 
         return tasks_per_category
 
 
+def next_tasks_cache_tags(user_id):
+    """the cached next tasks change when the user submits a task or when the task catalog changes"""
+    return [USER_CACHE_TAG % user_id, TASKS_CATALOG_CACHE_TAG]
+
+
+def read_next_tasks_from_cache(user_id, cat_ids):
+    """returns a tuple of (the cached next tasks for the given cat_ids (or all categories) or None if any of them is missing,
+    the cache tag versions to write the next tasks with)
+    """
+    tags = next_tasks_cache_tags(user_id)
+    if not cat_ids:
+        found, tag_versions = cache.get_many([NEXT_TASKS_CAT_IDS_CACHE_KEY % user_id], tags)
+        cat_ids = found.get(NEXT_TASKS_CAT_IDS_CACHE_KEY % user_id)
+        if cat_ids is None:
+            return None, tag_versions
+
+    keys = [NEXT_TASKS_CACHE_KEY % (user_id, cat_id) for cat_id in cat_ids]
+    found, tag_versions = cache.get_many(keys, tags)
+    if any(key not in found for key in keys):
+        return None, tag_versions
+    return {cat_id: found[key] for cat_id, key in zip(cat_ids, keys)}, tag_versions
+
+
+def write_next_tasks_to_cache(user_id, cat_ids, tasks_per_category, tag_versions=None):
+    """caches the next tasks - one key per category. if all the categories were resolved, also remember their ids"""
+    values = {NEXT_TASKS_CACHE_KEY % (user_id, cat_id): tasks for cat_id, tasks in tasks_per_category.items()}
+    if not cat_ids:
+        values[NEXT_TASKS_CAT_IDS_CACHE_KEY % user_id] = list(tasks_per_category.keys())
+    cache.set_many(values, config.USER_TASKS_CACHE_TTL_SECS, next_tasks_cache_tags(user_id), tag_versions)
+
+
 def should_skip_truex_task(user_id, task_id, source_ip=None, country_code=None):
 
     if config.DEBUG:
@@ -345,7 +364,7 @@ def should_skip_task(user_id, task_id, source_ip, country_code=None):
             return True
         else:  # not truex
             # skip special truex-related tasks for users that skipped the truex task
-            if task_id in literal_eval(config.TRUEX_BLACKLISTED_TASKIDS): # and should_skip_truex_task(user_id, task_id, source_ip, country_code):
+            if task_id in get_truex_blacklisted_task_ids(): # and should_skip_truex_task(user_id, task_id, source_ip, country_code):
                 # log.info('skipping blacklisted truex task %s' % task_id)
                 return True
 
@@ -357,7 +376,6 @@ def should_skip_task(user_id, task_id, source_ip, country_code=None):
 
 def can_client_support_task(os_type, app_ver, task):
     """ returns true if the client with the given os_type and app_ver can correctly handle the given task"""
-    from distutils.version import LooseVersion
     if os_type == OS_ANDROID:
         if LooseVersion(app_ver) >= LooseVersion(task.get('min_client_version_android')):
             return True
@@ -370,16 +388,10 @@ def can_client_support_task(os_type, app_ver, task):
     return False
 
 
-def get_task_by_id(task_id, shifted_ts=None):
-    """return the json representation of the task or None if no such task exists"""
-
-    task = Task2.query.filter_by(task_id=task_id).first()
-    if task is None:
-        return None
-
-    # build the json object:
+def task_to_json(task):
+    """build the json representation of the given Task2 row"""
     task_json = {}
-    task_json['id'] = task_id
+    task_json['id'] = task.task_id
     task_json['cat_id'] = task.category_id
     task_json['position'] = task.position
     task_json['title'] = task.title
@@ -394,13 +406,156 @@ def get_task_by_id(task_id, shifted_ts=None):
     task_json['tags'] = task.tags
     task_json['items'] = task.items
     task_json['updated_at'] = arrow.get(task.update_at).timestamp
-    task_json['start_date'] = int(shifted_ts if shifted_ts is not None else arrow.get(0).timestamp)  # return 0 if no shift was requested
+    task_json['start_date'] = arrow.get(0).timestamp
     task_json['task_start_date'] = str(task.task_start_date) if task.task_start_date else None
     task_json['task_expiration_date'] = str(task.task_expiration_date) if task.task_expiration_date else None
     task_json['min_client_version_android'] = task.min_client_version_android or DEFAULT_MIN_CLIENT_VERSION
     task_json['min_client_version_ios'] = task.min_client_version_ios or DEFAULT_MIN_CLIENT_VERSION
     task_json['post_task_actions'] = [] if not task.post_task_actions else task.post_task_actions
+    return task_json
+
+
+# a pre-parsed subset of the task fields, used to pick the next task for a user without hitting the db
+TaskIndexEntry = namedtuple('TaskIndexEntry', ['task_id', 'position', 'delay_days', 'is_truex', 'excluded_country_codes',
+                                               'min_client_version_android', 'min_client_version_ios',
+                                               'task_start_date', 'task_expiration_date'])
+
+
+def task_to_index_entry(task):
+    """build the index entry for the given Task2 row"""
+    return TaskIndexEntry(
+        task_id=task.task_id,
+        position=task.position,
+        delay_days=task.delay_days,
+        is_truex=task.task_type == TASK_TYPE_TRUEX,
+        excluded_country_codes=frozenset(task.excluded_country_codes or []),
+        min_client_version_android=LooseVersion(task.min_client_version_android or DEFAULT_MIN_CLIENT_VERSION),
+        min_client_version_ios=LooseVersion(task.min_client_version_ios or DEFAULT_MIN_CLIENT_VERSION),
+        task_start_date=arrow.get(task.task_start_date) if task.task_start_date else None,
+        task_expiration_date=arrow.get(task.task_expiration_date) if task.task_expiration_date else None)
+
+
+def task_entry_sort_key(entry):
+    """order tasks like 'order by position, task_start_date' does in postgres (nulls last)"""
+    return entry.position, entry.task_start_date is None, entry.task_start_date or 0
+
+
+# an in-process snapshot of the whole task2 table. every worker holds its own copy and
+# reloads it whenever the version stored in redis changes. never mutate it - get_task_by_id
+# hands out copies. the only exception are the run tables, which are built lazily (see get_immediate_runs).
+_task_catalog = None
+
+
+def get_task_catalog_version():
+    """returns the current version of the task catalog, as stored in redis - or None if redis can't be read"""
+    if has_request_context() and 'task_catalog_version' in g:
+        # check redis only once per request - failures included
+        return g.task_catalog_version
+    try:
+        version = int(app.redis.get(config.TASK_CATALOG_VERSION_REDIS_KEY) or 0)
+    except Exception as e:
+        log.error('cant get the task catalog version from redis. e: %s' % e)
+        version = None
+    if has_request_context():
+        g.task_catalog_version = version
+    return version
+
+
+def bump_task_catalog_version():
+    """signals all the workers to reload the task catalog. call this after every change to the task2 table"""
+    global _task_catalog
+    _task_catalog = None
+    try:
+        version = app.redis.incr(config.TASK_CATALOG_VERSION_REDIS_KEY)
+    except Exception as e:
+        log.error('cant bump the task catalog version in redis. e: %s' % e)
+        version = None
+    cache.invalidate_tags(TASKS_CATALOG_CACHE_TAG)
+    if has_request_context():
+        g.pop('task_catalog_version', None)
+    log.info('bumped task catalog version to %s' % version)
+
+
+def load_task_catalog(version):
+    """load all the tasks from the db into a new catalog"""
+    tasks = {}
+    delay_days = {}
+    entries = {}
+    categories = {}
+    for task in Task2.query.all():
+        tasks[task.task_id] = task_to_json(task)
+        delay_days[task.task_id] = task.delay_days
+        entries[task.task_id] = task_to_index_entry(task)
+        categories.setdefault(task.category_id, []).append(entries[task.task_id])
+
+    # each category holds its tasks in the order they should be served
+    category_filters = {}
+    for cat_id in categories:
+        categories[cat_id] = tuple(sorted(categories[cat_id], key=task_entry_sort_key))
+        category_filters[cat_id] = get_category_filters(categories[cat_id])
+
+    log.info('loaded %s tasks into the task catalog (version %s)' % (len(tasks), version))
+    increment_metric('task-catalog-reload')
+    return {'version': version, 'tasks': tasks, 'delay_days': delay_days, 'entries': entries, 'categories': categories,
+            'category_filters': category_filters, 'immediate_runs': {}}
+
+
+def get_category_filters(entries):
+    """returns the things that split the users of a category into buckets that see the same tasks:
+    the distinct min client versions (per os), the excluded country codes and whether there are any ad-hoc tasks
+    """
+    versions = {OS_ANDROID: {}, OS_IOS: {}}
+    excluded_country_codes = set()
+    for entry in entries:
+        versions[OS_ANDROID][entry.min_client_version_android.vstring] = entry.min_client_version_android
+        versions[OS_IOS][entry.min_client_version_ios.vstring] = entry.min_client_version_ios
+        excluded_country_codes.update(entry.excluded_country_codes)
+    return {'version_thresholds': {os_type: tuple(sorted(versions[os_type].values())) for os_type in versions},
+            'excluded_country_codes': frozenset(excluded_country_codes),
+            'has_ad_hoc_tasks': any(entry.position == -1 for entry in entries)}
+
+
+def get_task_catalog():
+    """returns the up-to-date task catalog, reloading it from the db if the version has changed.
+
+    when the version can't be read, the current snapshot is served as is
+    """
+    global _task_catalog
+    version = get_task_catalog_version()
+    catalog = _task_catalog
+    if catalog is None or (version is not None and catalog['version'] != version):
+        catalog = load_task_catalog(version)
+        _task_catalog = catalog
+    return catalog
 
+
+def get_unsolved_task_entries_for_category(cat_id, completed_task_ids):
+    """returns the index entries of the given category that aren't in completed_task_ids, in order"""
+    completed_task_ids = set(completed_task_ids or [])
+    return [entry for entry in get_task_catalog()['categories'].get(cat_id, ()) if entry.task_id not in completed_task_ids]
+
+
+def get_task_entry_min_client_version(entry, os_type):
+    """returns the parsed min client version the given task entry requires from the given os_type"""
+    if os_type == OS_ANDROID:
+        return entry.min_client_version_android
+    return entry.min_client_version_ios
+
+
+def get_truex_blacklisted_task_ids():
+    """returns the set of truex-related task ids that should be skipped"""
+    return set(literal_eval(config.TRUEX_BLACKLISTED_TASKIDS))
+
+
+def get_task_by_id(task_id, shifted_ts=None):
+    """return the json representation of the task or None if no such task exists"""
+    task_json = get_task_catalog()['tasks'].get(str(task_id))
+    if task_json is None:
+        return None
+
+    # callers plant their own fields (memo etc.), also in the nested items - so never hand out the catalog's dicts
+    task_json = copy.deepcopy(task_json)
+    task_json['start_date'] = int(shifted_ts if shifted_ts is not None else arrow.get(0).timestamp)  # return 0 if no shift was requested
     return task_json
 
 
@@ -563,6 +718,7 @@ def add_task(task_json):
 
         db.session.add(task)
         db.session.commit()
+        bump_task_catalog_version()
         log.info('success: added task with id %s, cat_id %s and position %s' % (task_id, category_id, position))
         return True
     except Exception as e:
@@ -579,6 +735,7 @@ def delete_task(task_id):
     task_to_delete = Task2.query.filter_by(task_id=task_id).first()
     db.session.delete(task_to_delete)
     db.session.commit()
+    bump_task_catalog_version()
 
 
 def set_delay_days(delay_days, task_id=None):
@@ -588,38 +745,39 @@ def set_delay_days(delay_days, task_id=None):
 
     where_clause = '' if not task_id else 'where task_id=\'%s\'' % task_id
     db.engine.execute("update task2 set delay_days=%d %s" % (int(delay_days), where_clause))  # safe
+    bump_task_catalog_version()
     return True
 
 
 def get_reward_for_task(task_id):
     """return the amount of kin reward associated with this task"""
-    task = Task2.query.filter_by(task_id=task_id).first()
+    task = get_task_catalog()['tasks'].get(str(task_id))
     if not task:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.price
+    return task['price']
 
 
 def get_task_delay(task_id):
     """return the amount of delay associated with this task"""
-    task = Task2.query.filter_by(task_id=task_id).first()
-    if not task:
+    delay_days = get_task_catalog()['delay_days'].get(str(task_id))
+    if delay_days is None:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.delay_days
+    return delay_days
 
 
 def get_task_type(task_id):
     """get the tasks type"""
-    task = Task2.query.filter_by(task_id=task_id).first()
+    task = get_task_catalog()['tasks'].get(str(task_id))
     if not task:
         raise InternalError('no such task_id: %s' % task_id)
-    return task.task_type
+    return task['type']
 
 
 def get_task_details(task_id):
     """return a dict with some of the given task id's metadata"""
-    task = Task2.query.filter_by(task_id=task_id).first()
+    task = get_task_catalog()['tasks'].get(str(task_id))
     if task:
-        return {'title': task.title, 'desc': task.description, 'provider': task.provider_data}
+        return {'title': task['title'], 'desc': task['desc'], 'provider': task['provider']}
 
     # task wasn't found. Let's try the original task table that has not been migrated
     task = Task.query.filter_by(task_id=task_id).first()
@@ -630,6 +788,28 @@ def get_task_details(task_id):
     return {'title': task.title, 'desc': task.desc, 'provider': task.provider_data}
 
 
+def get_tasks_details(task_ids):
+    """return a dict of task_id: the task's details (see get_task_details) for the given task_ids.
+
+    the tasks are looked up in the task catalog. those that aren't there are fetched from the original task table with a single query
+    """
+    details = {}
+    catalog_tasks = get_task_catalog()['tasks']
+    for task_id in {str(task_id) for task_id in task_ids}:
+        task = catalog_tasks.get(task_id)
+        if task:
+            details[task_id] = {'title': task['title'], 'desc': task['desc'], 'provider': task['provider']}
+
+    missing = {str(task_id) for task_id in task_ids} - set(details.keys())
+    if missing:
+        for task in Task.query.filter(Task.task_id.in_(missing)).all():
+            details[task.task_id] = {'title': task.title, 'desc': task.desc, 'provider': task.provider_data}
+        for task_id in missing - set(details.keys()):
+            log.error('cant find task with task_id %s. using default text' % task_id)
+            details[task_id] = {'title': 'Delayed Kin', 'desc': '', 'provider': {"image_url": "https://cdn.kinitapp.com/brand_img/poll_logo_kin.png", "name": "Kinit Team"}}
+    return details
+
+
 def handle_task_results_resubmission(user_id, task_id):
     """
     This function handles cases where users attempt to re-submit previously submitted results
@@ -705,46 +885,31 @@ def switch_task_ids(task_id1, task_id2):
 
     stmt = '''update task set task_id='%s' where task_id='%s';'''
     db.engine.execute('BEGIN;' + stmt % (temp_task_id, task_id1) + stmt % (task_id1, task_id2) + stmt % (task_id2, temp_task_id) + 'COMMIT;')
+    bump_task_catalog_version()
 
 
 def add_task_to_completed_tasks(user_id, task_id):
-    user_app_data = get_user_app_data(user_id)
-    completed_tasks = user_app_data.completed_tasks_dict
-    from .task2 import get_task_by_id
+    get_user_app_data(user_id)  # throws if there's no such user
     task = get_task_by_id(task_id)
     if not task:
         log.error('cant find task with id %s' % task_id)
         raise InvalidUsage('no such task %s' % task_id)
 
-    cat_id = task['cat_id']
-    if cat_id in completed_tasks and task_id in completed_tasks[cat_id]:
+    if not add_completed_task(user_id, task['cat_id'], task_id):
         log.info('task_id %s already in completed_tasks for user_id %s - ignoring' % (task_id, user_id))
     else:
-        if cat_id not in completed_tasks:
-            completed_tasks[cat_id] = []
-        completed_tasks[cat_id].append(task_id)
-        user_app_data.completed_tasks = completed_tasks
-        commit_json_changed_to_orm(user_app_data, ['completed_tasks_dict'])
-        log.info('completed tasks: %s' % user_app_data.completed_tasks)
+        log.info('completed tasks: %s' % get_completed_tasks(user_id))
         return True
 
 
 def remove_task_from_completed_tasks(user_id, task_id):
-    user_app_data = get_user_app_data(user_id)
-    completed_tasks = user_app_data.completed_tasks_dict
-    log.info('completed tasks: %s' % user_app_data.completed_tasks)
-    from .task2 import get_task_by_id
+    get_user_app_data(user_id)  # throws if there's no such user
     task = get_task_by_id(task_id)
     if not task:
         raise InvalidUsage('no such task %s' % task_id)
 
-    cat_id = task['cat_id']
-    if cat_id not in completed_tasks or task_id not in completed_tasks[cat_id]:
+    if not remove_completed_task(user_id, task_id):
         log.error('task_id %s not in completed_tasks for user_id %s - ignoring' % (task_id, user_id))
-    else:
-        completed_tasks[cat_id].remove(task_id)
-        user_app_data.completed_tasks_dict = completed_tasks
-        commit_json_changed_to_orm(user_app_data, ['completed_tasks_dict'])
 
     return True
 
@@ -761,10 +926,6 @@ def count_immediate_tasks(user_id, only_cat_id=None, send_push=True):
     # 4. the user's last recorded ip address
     immediate_tasks_count = {}
     now = arrow.utcnow()
-    # completed_tasks = user_app_data.completed_tasks_dict
-    # os_type = get_user_os_type(user_id)
-    # app_ver = user_app_data.app_ver
-    # country_code = get_country_code_by_ip(user_app_data.ip_address)
 
     user_next_tasks = get_next_tasks_for_user(user_id, None, [], send_push)
 
@@ -779,6 +940,7 @@ def count_immediate_tasks(user_id, only_cat_id=None, send_push=True):
     else:
         cat_ids = [x for x in user_next_tasks.keys()]  # get all the category ids for this user
 
+    user_data = None
     for cat_id in cat_ids:
         # for each category, determine the number of next available tasks if they exist
         if user_next_tasks[cat_id] == []:
@@ -790,64 +952,119 @@ def count_immediate_tasks(user_id, only_cat_id=None, send_push=True):
             immediate_tasks_count[cat_id] = 0
         else:
             #  the first task in the category is guaranteed to be available - tested in the previous clause
-            # filtered_unsolved_tasks_for_user_and_cat = get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_tasks.get(cat_id, []), os_type, app_ver, country_code, user_id)
-            # immediate_tasks_count_for_cat_id = calculate_immediate_tasks(filtered_unsolved_tasks_for_user_and_cat)
-            #  log.info('counted %s immediate tasks for cat_id %s' % (immediate_tasks_count_for_cat_id, cat_id))
-            # immediate_tasks_count[cat_id] = immediate_tasks_count_for_cat_id
-            immediate_tasks_count[cat_id] = 1
+            if user_data is None:
+                # only load the user if there's anything to count
+                from .user import get_user_and_app_data
+                user, user_app_data = get_user_and_app_data(user_id)
+                user_data = user.os_type, user_app_data.app_ver, get_country_code_by_ip(user_app_data.ip_address), get_completed_tasks(user_id)
+            os_type, app_ver, country_code, completed_tasks = user_data
+            immediate_tasks_count[cat_id] = count_immediate_tasks_for_category(cat_id, completed_tasks.get(cat_id, set()), os_type, app_ver, country_code, user_id)
 
     log.info('count_immediate_tasks for user_id %s - %s' % (user_id, immediate_tasks_count))
     return immediate_tasks_count
 
 
-def get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_task_ids_for_category, os_type, client_version, user_country_code, user_id):
-    """for the given category_id returns list of tasks, in order, with their delay days excluding previously completed tasks"""
-    from distutils.version import LooseVersion
+def count_immediate_tasks_for_category(cat_id, completed_task_ids, os_type, app_ver, country_code, user_id):
+    """returns the number of immediate tasks in the given category, assuming its first unsolved task is available.
 
-    # calculate a sql clause to remove previously submitted tasks, if such exist
-    remove_previous_tasks_clause = ''
-    if completed_task_ids_for_category:
-        completed_tasks_for_cat_id = ["\'%s\'" % id for id in completed_task_ids_for_category]
-        remove_previous_tasks_clause = '''and task2.task_id not in (%s)''' % (",".join(completed_tasks_for_cat_id))
+    users solve the tasks of a category in order, so their completed tasks are usually the first tasks of their bucket's
+    run table - and the count is a single lookup. anything else (ad-hoc tasks, tasks solved out of order) is walked.
+    """
+    filters = get_task_catalog()['category_filters'].get(cat_id)
+    if filters is None:
+        return 0
+    if filters['has_ad_hoc_tasks']:
+        # ad-hoc tasks come and go with time - cant precompute these
+        return calculate_immediate_tasks(get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_task_ids, os_type, app_ver, country_code, user_id))
 
-    stmt = '''select task_id, delay_days, min_client_version_android, min_client_version_ios, excluded_country_codes from Task2 where category_id='%s' %s order by position, task_start_date;''' % (cat_id, remove_previous_tasks_clause)
-    log.info('unsolved tasks sql stmt: %s' % stmt)
-    res = db.engine.execute(stmt)
+    runs = get_immediate_runs(cat_id, os_type, app_ver, country_code)
+    completed_indices = sorted(runs['index'][task_id] for task_id in completed_task_ids if task_id in runs['index'])
+    if completed_indices and completed_indices[-1] != len(completed_indices) - 1:
+        # some tasks were solved out of order
+        return calculate_immediate_tasks([entry for entry in runs['entries'] if entry.task_id not in completed_task_ids])
 
-    # exclude mismatching tasks - client version
-    unsolved_tasks = []
-    if os_type == OS_IOS:
-        client_version_index = 3
-    else:
-        client_version_index = 2
+    position = len(completed_indices)
+    return runs['counts'][position] if position < len(runs['counts']) else 0
+
+
+def has_immediate_tasks(user_id, os_type, app_ver, completed_tasks, next_task_ts_dict, cat_ids, now):
+    """returns True if the user has a task available right now in any of the given categories.
+
+    unlike count_immediate_tasks, this never touches the db or the cache - the caller provides everything.
+    """
+    for cat_id in cat_ids:
+        if int((next_task_ts_dict or {}).get(cat_id) or 0) > now.timestamp:
+            continue  # the user is in cooldown in this category
+        if count_immediate_tasks_for_category(cat_id, completed_tasks.get(cat_id, set()), os_type, app_ver, None, user_id) > 0:
+            return True
+    return False
+
+
+def get_immediate_runs(cat_id, os_type, app_ver, country_code):
+    """returns the run table of the bucket of users of the given os_type, app_ver and country_code in the given category:
+    - entries: the tasks users in this bucket are served, in order
+    - index: the position of each of these tasks
+    - counts: for each position, the number of immediate tasks for a user whose next task is at that position
+
+    the tables are built lazily - once per bucket per catalog version.
+    """
+    catalog = get_task_catalog()
+    filters = catalog['category_filters'][cat_id]
+    thresholds = filters['version_thresholds'][OS_ANDROID if os_type == OS_ANDROID else OS_IOS]
+    version_bucket = bisect_right(thresholds, LooseVersion(app_ver))
+    country_bucket = country_code if country_code in filters['excluded_country_codes'] else None
+    key = (cat_id, os_type == OS_ANDROID, version_bucket, country_bucket, config.TRUEX_BLACKLISTED_TASKIDS)
+
+    runs = catalog['immediate_runs'].get(key)
+    if runs is None:
+        truex_blacklisted_task_ids = get_truex_blacklisted_task_ids()
+        max_version = thresholds[version_bucket - 1] if version_bucket else None
+        entries = tuple(entry for entry in catalog['categories'][cat_id]
+                        if max_version is not None and get_task_entry_min_client_version(entry, os_type) <= max_version
+                        and not entry.is_truex and entry.task_id not in truex_blacklisted_task_ids
+                        and country_bucket not in entry.excluded_country_codes)
+
+        # walk backwards, counting the zero-delay tasks that follow each position
+        counts = [0] * len(entries)
+        zero_delay_run = 0
+        for idx in range(len(entries) - 1, -1, -1):
+            counts[idx] = 1 + zero_delay_run
+            zero_delay_run = zero_delay_run + 1 if entries[idx].delay_days == 0 else 0
+
+        runs = {'entries': entries, 'index': {entry.task_id: idx for idx, entry in enumerate(entries)}, 'counts': tuple(counts)}
+        catalog['immediate_runs'][key] = runs
+    return runs
 
-    for task in [item for item in res.fetchall()]:
-        skip_task = False
-        task_id = task[0]
-        excluded_country_codes = task[4]
+
+def get_all_unsolved_tasks_delay_days_for_category(cat_id, completed_task_ids_for_category, os_type, client_version, user_country_code, user_id):
+    """for the given category_id returns list of tasks, in order, with their delay days excluding previously completed tasks"""
+    truex_blacklisted_task_ids = get_truex_blacklisted_task_ids()
+    client_version = LooseVersion(client_version)
+    now = arrow.utcnow()
+
+    unsolved_tasks = []
+    for entry in get_unsolved_task_entries_for_category(cat_id, completed_task_ids_for_category):
+        task_id = entry.task_id
 
         # filter out ad-hoc tasks that have expired or yet to be active
-        if not is_task_active(task_id):
-            skip_task = True
+        if not is_task_entry_active(entry, now):
+            continue
 
         # filter out truex tasks if the user is in the truex blacklist
-        if should_skip_task(user_id, task_id, None, user_country_code):
-            # log.info('skipping task %s - its either truex or truex-related' % task_id)
-            skip_task = True
+        if entry.is_truex or task_id in truex_blacklisted_task_ids:
+            continue
 
         # filter out tasks that dont match the client's version
-        if LooseVersion(task[client_version_index]) > LooseVersion(client_version):
+        if get_task_entry_min_client_version(entry, os_type) > client_version:
             log.info('detected a task (%s) that doesnt match the users os_type and app_ver. user_id %s' % (task_id, user_id))
-            skip_task = True
+            continue
 
         # filter out tasks that dont match the user's country code
-        if excluded_country_codes not in (None, []) and user_country_code and user_country_code in excluded_country_codes:
+        if user_country_code and user_country_code in entry.excluded_country_codes:
             log.info('detected a task (%s) that cant be served to user because of country code. user_id %s' % (task_id, user_id))
-            # the task is limited to a specific country, and the user's country is different
-            skip_task = True
+            continue
 
-        if not skip_task:
-            unsolved_tasks.append(task)
+        unsolved_tasks.append(entry)
 
     return unsolved_tasks
 
@@ -879,11 +1096,15 @@ def is_task_active(task_id):
     Ad-hoc tasks are active only if their task__start_date has passed
     and theor task_expiration_date has yet to pass
     """
-    task_json = get_task_by_id(task_id)
-    if task_json['position'] != -1:
+    return is_task_entry_active(get_task_catalog()['entries'][str(task_id)], arrow.utcnow())
+
+
+def is_task_entry_active(entry, now):
+    """same as is_task_active, for a task index entry"""
+    if entry.position != -1:
         return True
 
-    if arrow.get(task_json['task_start_date']) < arrow.utcnow() < arrow.get(task_json['task_expiration_date']):
+    if entry.task_start_date < now < entry.task_expiration_date:
         return True
     return False
 
@@ -959,4 +1180,5 @@ def task20_migrate_task(task_id, cat_id, position, delay_days):
 
     db.session.add(task)
     db.session.commit()
+    bump_task_catalog_version()
     return True
@@ -0,0 +1,87 @@
+import logging as log
+
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db, config
+
+# the memo of a payment is stored in the tx's json tx_info. this index lets the txs be matched to payments by memo
+TRANSACTION_MEMO_INDEX_SQL = '''create index %s if not exists ix_transaction_memo on transaction ((tx_info->>'memo'));'''
+
+
+class TaskPayment(db.Model):
+    """a payment requested for a task - one row per memo.
+
+       written by the reward job before it calls the payment service. the payment is done once a
+       transaction with the same memo exists - until then, the reconciliation job re-submits it.
+    """
+    memo = db.Column(db.String(100), nullable=False, primary_key=True)
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=False, nullable=False)
+    task_id = db.Column(db.String(40), nullable=False, primary_key=False)
+    public_address = db.Column(db.String(100), nullable=False, primary_key=False)
+    amount = db.Column(db.Integer(), nullable=False, primary_key=False)
+    send_push = db.Column(db.Boolean, unique=False, default=True)
+    attempts = db.Column(db.Integer(), nullable=False, default=0, server_default='0')
+    abandoned = db.Column(db.Boolean, unique=False, nullable=False, default=False, server_default='false')
+    created_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), index=True)
+    resubmitted_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (db.Index('ix_task_payment_user_id_task_id', 'user_id', 'task_id'),)
+
+    def __repr__(self):
+        return '<memo: %s, user_id: %s, task_id: %s, amount: %s, attempts: %s, created_at: %s>' % (self.memo, self.user_id, self.task_id, self.amount, self.attempts, self.created_at)
+
+
+def record_task_payment(memo, user_id, task_id, public_address, amount, send_push):
+    """records a requested payment. returns False if a payment with this memo was already recorded"""
+    res = db.engine.execute('''insert into task_payment (memo, user_id, task_id, public_address, amount, send_push, attempts, abandoned, created_at)
+                               values (%s, %s, %s, %s, %s, %s, 0, false, now()) on conflict do nothing;''',
+                            (str(memo), str(user_id), str(task_id), public_address, int(amount), bool(send_push)))
+    return res.rowcount == 1
+
+
+def get_task_payment(memo):
+    """returns the payment with the given memo, or None"""
+    return TaskPayment.query.filter_by(memo=str(memo)).first()
+
+
+def has_task_payment(user_id, task_id):
+    """returns True if a payment for the given user and task was requested, and wasn't abandoned"""
+    return db.engine.execute('''select exists(select 1 from task_payment where user_id=%s and task_id=%s and not abandoned);''',
+                             (str(user_id), str(task_id))).scalar()
+
+
+def ensure_transaction_memo_index():
+    """creates the memo index on the transaction table, unless it already exists"""
+    # in autocommit mode the index can be built without blocking writes to the table
+    concurrently = 'concurrently' if config.DEPLOYMENT_ENV in ['prod', 'stage'] else ''
+    db.engine.execute(TRANSACTION_MEMO_INDEX_SQL % concurrently)
+
+
+def get_task_payments_since(watermark, until, limit):
+    """returns up to limit payments created in [watermark, until), oldest first, along with whether each was paid.
+
+    each row is a tuple of (memo, user_id, task_id, public_address, amount, send_push, attempts, abandoned, created_at, resubmitted_at, paid)
+    """
+    res = db.engine.execute('''select p.memo, p.user_id, p.task_id, p.public_address, p.amount, p.send_push, p.attempts, p.abandoned,
+                                      p.created_at, p.resubmitted_at, exists(select 1 from transaction t where t.tx_info->>'memo' = p.memo) as paid
+                               from task_payment p
+                               where p.created_at >= %s and p.created_at < %s
+                               order by p.created_at
+                               limit %s;''', (watermark, until, limit))
+    return res.fetchall()
+
+
+def mark_task_payment_resubmitted(memo, abandon=False):
+    """counts another payment attempt for the given memo, or gives up on it"""
+    if abandon:
+        db.engine.execute('''update task_payment set abandoned=true where memo=%s;''', (memo,))
+        log.error('task payment %s was abandoned after %s attempts' % (memo, config.RECONCILE_MAX_ATTEMPTS))
+    else:
+        db.engine.execute('''update task_payment set attempts=attempts+1, resubmitted_at=now() where memo=%s;''', (memo,))
+
+
+def count_unpaid_task_payments(since, until):
+    """returns the number of payments created in [since, until) without a matching tx"""
+    return db.engine.execute('''select count(*) from task_payment p
+                                where p.created_at >= %s and p.created_at < %s and not p.abandoned
+                                and not exists(select 1 from transaction t where t.tx_info->>'memo' = p.memo);''', (since, until)).scalar()
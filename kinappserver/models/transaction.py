@@ -1,11 +1,13 @@
 """The model for the Kin App Server."""
 import datetime
+import json
 import logging as log
 
 from sqlalchemy_utils import UUIDType
 from sqlalchemy import desc
 
-from kinappserver import db, stellar
+from kinappserver import db, stellar, config
+from .user_balance import UPDATE_LEDGER_CTE
 
 
 class Transaction(db.Model):
@@ -20,33 +22,108 @@ class Transaction(db.Model):
     tx_info = db.Column(db.JSON)
     update_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
 
+    __table_args__ = (db.Index('ix_transaction_user_id_update_at', 'user_id', 'update_at', 'tx_hash'),)
+
     def __repr__(self):
         return '<tx_hash: %s, user_id: %s, amount: %s, remote_address: %s, incoming_tx: %s, tx_info: %s,  update_at: %s>' % (self.tx_hash, self.user_id, self.amount, self.remote_address, self.incoming_tx, self.tx_info, self.update_at)
 
 
 def list_user_transactions(user_id, max_txs=None):
     """returns all txs by this user - or the last x tx if max_txs was passed"""
-    txs = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at)).all()
-    # trim the amount of txs
-    txs = txs[:max_txs] if max_txs and max_txs > len(txs) else txs
-    return txs
+    query = Transaction.query.filter(Transaction.user_id == user_id).order_by(desc(Transaction.update_at))
+    # trim the amount of txs in the db
+    return query.limit(max_txs).all() if max_txs else query.all()
+
+
+# the user's server and p2p txs, newest first. each branch is limited on its own (along its index), so a page
+# never reads more than limit rows of each. the cursor is the (update_at, tx_hash) of the last tx of the previous page.
+USER_HISTORY_SQL = '''select * from (
+    (select 'server' as type, tx_hash, amount, not incoming_tx as client_received, tx_info, update_at, null::integer as receiver_app_sid
+     from transaction where user_id = %(user_id)s {cursor}
+     order by update_at desc, tx_hash desc limit %(limit)s)
+    union all
+    (select 'p2p', tx_hash, amount, receiver_user_id = %(user_id)s, null::json, update_at, receiver_app_sid
+     from p2_p_transaction where sender_user_id = %(user_id)s {cursor}
+     order by update_at desc, tx_hash desc limit %(limit)s)
+    union all
+    (select 'p2p', tx_hash, amount, true, null::json, update_at, receiver_app_sid
+     from p2_p_transaction where receiver_user_id = %(user_id)s and sender_user_id != %(user_id)s {cursor}
+     order by update_at desc, tx_hash desc limit %(limit)s)
+) history order by update_at desc, tx_hash desc limit %(limit)s;'''
+USER_HISTORY_CURSOR_SQL = '''and (update_at, tx_hash) < (timestamp with time zone 'epoch' + %(cursor_micros)s * interval '1 microsecond', %(cursor_tx_hash)s)'''
+
+# there are no migrations - the history indexes are added to existing tables by ensure_user_history_indexes
+USER_HISTORY_INDEXES_SQL = ['''create index %s if not exists ix_transaction_user_id_update_at on transaction (user_id, update_at, tx_hash);''',
+                            '''create index %s if not exists ix_p2_p_transaction_sender_user_id_update_at on p2_p_transaction (sender_user_id, update_at, tx_hash);''',
+                            '''create index %s if not exists ix_p2_p_transaction_receiver_user_id_update_at on p2_p_transaction (receiver_user_id, update_at, tx_hash);''']
+
+
+def ensure_user_history_indexes():
+    """creates the indexes of the tx history queries, unless they already exist"""
+    # in autocommit mode the indexes can be built without blocking writes to the tables
+    concurrently = 'concurrently' if config.DEPLOYMENT_ENV in ['prod', 'stage'] else ''
+    for statement in USER_HISTORY_INDEXES_SQL:
+        db.engine.execute(statement % concurrently)
+
+
+def encode_history_cursor(update_at, tx_hash):
+    """returns the cursor of the page following the given tx"""
+    micros = (update_at - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)) // datetime.timedelta(microseconds=1)
+    return '%s:%s' % (micros, tx_hash)
+
+
+def decode_history_cursor(cursor):
+    """returns the (micros, tx_hash) encoded in the given cursor. raises ValueError on a malformed cursor"""
+    micros, tx_hash = cursor.split(':', 1)
+    return int(micros), tx_hash
+
+
+def list_user_history(user_id, limit, cursor=None):
+    """returns a tuple of (a page of the user's server and p2p txs, newest first, the cursor of the next page or None).
+
+    each tx is a row of (type, tx_hash, amount, client_received, tx_info, update_at, receiver_app_sid)
+    """
+    params = {'user_id': str(user_id), 'limit': int(limit)}
+    cursor_sql = ''
+    if cursor:
+        params['cursor_micros'], params['cursor_tx_hash'] = decode_history_cursor(cursor)
+        cursor_sql = USER_HISTORY_CURSOR_SQL
+    rows = db.engine.execute(USER_HISTORY_SQL.replace('{cursor}', cursor_sql), params).fetchall()
+    next_cursor = encode_history_cursor(rows[-1]['update_at'], rows[-1]['tx_hash']) if len(rows) == int(limit) else None
+    return rows, next_cursor
 
 
 def create_tx(tx_hash, user_id, remote_address, incoming_tx, amount, tx_info):
     try:
-        tx = Transaction()
-        tx.tx_hash = tx_hash
-        tx.user_id = user_id
-        tx.amount = int(amount)
-        tx.incoming_tx = bool(incoming_tx)
-        tx.remote_address = remote_address
-        tx.tx_info = tx_info
-        db.session.add(tx)
-        db.session.commit()
+        create_txs([{'tx_hash': tx_hash, 'user_id': user_id, 'amount': amount, 'incoming_tx': incoming_tx, 'remote_address': remote_address, 'tx_info': tx_info}])
     except Exception as e:
         log.error('cant add tx to db with id %s' % tx_hash)
     else:
-        log.info('created tx with txinfo: %s' % tx.tx_info)
+        log.info('created tx with txinfo: %s' % tx_info)
+
+
+def create_txs(txs):
+    """stores the given txs - a list of dicts with the create_tx args - with a single multi-row insert.
+
+    the users' balances in the user_balance ledger are updated in the same statement.
+    txs that are already stored are ignored. returns the set of tx_hashes that were inserted.
+    """
+    if not txs:
+        return set()
+    values = []
+    params = []
+    for tx in txs:
+        values.append('(%s, %s, %s, %s, %s, %s::json, now())')
+        params.extend([tx['tx_hash'], str(tx['user_id']), int(tx['amount']), bool(tx['incoming_tx']), tx['remote_address'], json.dumps(tx['tx_info'])])
+    # a statement starting with 'with' isn't detected as a write - ask for the commit explicitly
+    res = db.engine.execution_options(autocommit=True).execute('''with inserted as (insert into transaction (tx_hash, user_id, amount, incoming_tx, remote_address, tx_info, update_at)
+                                                                                   values %s on conflict do nothing returning tx_hash, user_id, amount, incoming_tx),
+                                                                  %s
+                                                                  select tx_hash from inserted;''' % (', '.join(values), UPDATE_LEDGER_CTE), tuple(params))
+    inserted = {row[0] for row in res.fetchall()}
+    log.info('created %s txs out of %s' % (len(inserted), len(txs)))
+    return inserted
+
 
 def count_transactions_by_minutes_ago(minutes_ago=1):
     """return the number of failed txs since minutes_ago"""
@@ -12,6 +12,9 @@ import arrow
 import json
 from distutils.version import LooseVersion
 from .backup import get_user_backup_hints_by_enc_phone
+from .completed_task import count_completed_tasks, get_completed_tasks, get_completed_tasks_for_users, set_completed_tasks, copy_completed_tasks
+from .user_balance import get_user_balance, delete_user_balance
+from .offer_purchase import delete_user_offer_purchases
 from time import sleep
 
 DEFAULT_TIME_ZONE = -4
@@ -247,9 +250,8 @@ def update_user_app_version(user_id, app_ver):
 
 
 def get_user_inapp_balance(user_id):
-    spend = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = true;" % user_id).first()['total'] or 0
-    income = db.engine.execute("select sum(amount) as total from public.transaction where user_id ='%s' and incoming_tx = false;" % user_id).first()['total'] or 0
-    return income - spend
+    """returns the user's balance, as kept by the user_balance ledger"""
+    return get_user_balance(user_id)
 
 
 def set_should_solve_captcha(user_id, value=0):
@@ -437,6 +439,28 @@ def get_and_replace_next_task_memo(user_id, task_id, cat_id=None):
     return memo
 
 
+def get_next_task_memos(user_app_data, cat_ids):
+    """returns the next memo for each of the given cat_ids, generating any missing memos in a single commit"""
+    try:
+        if user_app_data.next_task_memo_dict is None:
+            user_app_data.next_task_memo_dict = {}
+        memos = {}
+        missing_memo = False
+        for cat_id in cat_ids:
+            next_memo = user_app_data.next_task_memo_dict.get(cat_id, None)
+            if next_memo is None:  # set a value
+                next_memo = generate_order_id()
+                user_app_data.next_task_memo_dict[cat_id] = next_memo
+                missing_memo = True
+            memos[cat_id] = next_memo
+        if missing_memo:
+            commit_json_changed_to_orm(user_app_data, ['next_task_memo_dict'])
+    except Exception as e:
+        raise InvalidUsage('cant get next memos. exception:%s' % e)
+    else:
+        return memos
+
+
 def generate_and_save_next_task_memo(user_app_data, cat_id):
     """generate a new memo and save it"""
     next_memo = generate_order_id()
@@ -449,8 +473,10 @@ def list_all_users_app_data():
     """returns a dict of all the user-app-data"""
     response = {}
     users = UserAppData.query.order_by(UserAppData.user_id).all()
+    completed_tasks = get_completed_tasks_for_users([user.user_id for user in users])
     for user in users:
-        response[user.user_id] = {'user_id': user.user_id,  'app_ver': user.app_ver, 'update': user.update_at, 'completed_tasks': user.completed_tasks_dict}
+        user_completed_tasks = {cat_id: sorted(task_ids) for cat_id, task_ids in completed_tasks[str(user.user_id)].items()}
+        response[user.user_id] = {'user_id': user.user_id,  'app_ver': user.app_ver, 'update': user.update_at, 'completed_tasks': user_completed_tasks}
     return response
 
 
@@ -461,6 +487,14 @@ def get_user_app_data(user_id):
     return user_app_data
 
 
+def get_user_and_app_data(user_id):
+    """returns both the user and its user_app_data, loaded with a single query"""
+    res = db.session.query(User, UserAppData).filter(User.user_id == UserAppData.user_id).filter(User.user_id == user_id).first()
+    if not res:
+        raise InvalidUsage('no such user_id')
+    return res
+
+
 def get_user_tz(user_id):
     """return the user timezone"""
     return User.query.filter_by(user_id=user_id).one().time_zone
@@ -493,20 +527,31 @@ def get_user_push_data(user_id):
         return user.os_type, user.push_token, push_env
 
 
+def get_users_push_data(user_ids):
+    """returns a dict of user_id: (os_type, token, push_env) for the given user_ids, loaded with a single query"""
+    push_data = {}
+    if not user_ids:
+        return push_data
+    users = db.session.query(User.user_id, User.os_type, User.push_token, User.package_id).filter(User.user_id.in_(user_ids)).all()
+    for user in users:
+        if user.os_type == OS_IOS:
+            push_env = package_id_to_push_env(user.package_id)
+        else:
+            push_env = 'beta'  # android dont send package id and only support 'beta'
+        push_data[str(user.user_id)] = (user.os_type, user.push_token, push_env)
+    return push_data
+
+
 def send_push_tx_completed(user_id, tx_hash, amount, task_id, memo):
-    """send a message indicating that the tx has been successfully completed"""
-    os_type, token, push_env = get_user_push_data(user_id)
-    if token is None:
-        log.error('cant push to user %s: no push token' % user_id)
-        return False
-    if os_type == OS_IOS:
-        from kinappserver.push import tx_completed_push_apns, generate_push_id
-        push_send_apns(token, tx_completed_push_apns(generate_push_id(), str(tx_hash), str(user_id), str(task_id), int(amount), str(memo)), push_env)
-    else:
-        from kinappserver.push import gcm_payload, generate_push_id
-        payload = gcm_payload('tx_completed', generate_push_id(), {'type': 'tx_completed', 'user_id': user_id, 'tx_hash': tx_hash, 'kin': amount, 'task_id': task_id})
-        push_send_gcm(token, payload, push_env)
-    return True
+    """send a message indicating that the tx has been successfully completed. the push is sent by the outbox"""
+    from kinappserver.push_outbox import enqueue_push
+    return enqueue_push('tx_completed', user_id, tx_hash=str(tx_hash), amount=int(amount), task_id=str(task_id), memo=str(memo))
+
+
+def send_pushes_tx_completed(txs):
+    """queues a tx-completed push for each of the given dicts of user_id, tx_hash, amount, task_id and memo"""
+    from kinappserver.push_outbox import enqueue_pushes
+    return enqueue_pushes('tx_completed', [(tx['user_id'], {'tx_hash': str(tx['tx_hash']), 'amount': int(tx['amount']), 'task_id': str(tx['task_id']), 'memo': str(tx['memo'])}) for tx in txs])
 
 
 def send_push_auth_token(user_id, force_send=False):
@@ -622,10 +667,53 @@ def get_next_task_results_ts(user_id, cat_id):
         raise InvalidUsage('cant get task result ts')
 
 
-def get_users_for_engagement_push(scheme):
-    """get user_ids for an engagement scheme"""
+# the version floors for engagement pushes. clients at or below these versions are skipped
+ENGAGEMENT_MIN_VERSION_ANDROID = [1, 4, 0]
+ENGAGEMENT_MIN_VERSION_IOS = [1, 2, 1]
+
+# every pushable user with the (first) reason to skip it, or null if it's a candidate. the reasons are checked
+# in the same order as they are reported.
+ENGAGEMENT_CANDIDATES_SQL = '''select u.user_id as user_id, u.os_type as os_type, uad.app_ver as app_ver, uad.next_task_ts_dict as next_task_ts_dict,
+    case
+        when uad.app_ver is null or substring(uad.app_ver from '^[0-9]+(?:\\.[0-9]+)*') is null then 'old_version'
+        when string_to_array(substring(uad.app_ver from '^[0-9]+(?:\\.[0-9]+)*'), '.')::numeric[] <=
+            (case u.os_type when %(os_android)s then %(min_version_android)s when %(os_ios)s then %(min_version_ios)s end)::numeric[] then 'old_version'
+        when exists (select 1 from public.blacklisted_enc_phone_number b where b.enc_phone_number = u.enc_phone_number) then 'blacklist'
+        when uad.country_iso_code = any(%(blocked_country_codes)s::text[]) then 'country'
+        when uad.update_at::date = %(today)s then 'active_today'
+        when %(scheme)s = 'engage-recent' and uad.update_at::date < %(four_days_ago)s and uad.update_at::date != %(seven_days_ago)s then 'not_active_recently'
+        when %(scheme)s = 'engage-old' and uad.update_at::date <= %(fourteen_days_ago)s then 'active_in_last_two_weeks'
+    end as skip_reason
+    from public.user u inner join user_app_data uad on u.user_id = uad.user_id
+    where u.deactivated = false and u.push_token != ''
+'''
+
+
+def get_engagement_candidates_params(scheme, datetime_today):
+    """returns the parameters of ENGAGEMENT_CANDIDATES_SQL for the given scheme and day"""
     from datetime import datetime, timedelta
-    from .task2 import count_immediate_tasks
+    return {'scheme': scheme,
+            'today': datetime.date(datetime_today),
+            'four_days_ago': datetime.date(datetime_today + timedelta(days=-4)),
+            'seven_days_ago': datetime.date(datetime_today + timedelta(days=-7)),
+            'fourteen_days_ago': datetime.date(datetime_today) + timedelta(days=-14),
+            'os_android': OS_ANDROID,
+            'os_ios': OS_IOS,
+            'min_version_android': ENGAGEMENT_MIN_VERSION_ANDROID,
+            'min_version_ios': ENGAGEMENT_MIN_VERSION_IOS,
+            'blocked_country_codes': list(app.blocked_country_codes)}
+
+
+def get_users_for_engagement_push(scheme):
+    """get user_ids for an engagement scheme.
+
+    everything but task availability is filtered in the db. the remaining candidates are streamed
+    through a server-side cursor and their tasks are checked in chunks, against the task catalog.
+    """
+    from datetime import datetime
+    from .task2 import has_immediate_tasks
+    from .category import get_all_cat_ids
+    from .completed_task import get_completed_tasks_for_users
     import time
     start = time.time()
 
@@ -643,66 +731,48 @@ def get_users_for_engagement_push(scheme):
         raise InvalidUsage('invalid scheme: %s' % scheme)
 
     datetime_today = datetime.today()
-    today = datetime.date(datetime_today)
     log.info('engage-push: in get_users_for_engagement_push with scheme %s, current date: %s' % (scheme, datetime_today))
-    four_days_ago = datetime.date(datetime_today+ timedelta(days=-4))
-    seven_days_ago = datetime.date(datetime_today + timedelta(days=-7))
-    fourteen_days_ago = datetime.date(datetime_today) + timedelta(days=-14)
-    skipped_users = dict(blacklist=[], country=[], active_today=[], not_active_recently=[], active_in_last_two_weeks=[],
-                         no_active_task=[], old_version=[])
-
-    results = db.engine.execute(
-        "select public.user.user_id as user_id, public.user.os_type as os_type, user_app_data.app_ver as app_ver, "
-        "user_app_data.update_at as last_updated, public.user.push_token as push_token from public.user inner "
-        "join user_app_data on public.user.user_id = user_app_data.user_id where public.user.deactivated = \'f\' "
-        "and public.user.push_token != \'\';")
-    all_pushable_users = results.fetchall()
-    end = time.time()
-    diff = end - start
-    log.info("engage-push: num of users to process %d, query took : %s" % (len(all_pushable_users), diff))
-    for user in all_pushable_users:
-        try:
-            from .blacklisted_phone_numbers import is_userid_blacklisted
-
-            if user.os_type == OS_ANDROID and LooseVersion(user.app_ver) <= LooseVersion("1.4.0"):
-                skipped_users['old_version'].append(user.user_id)
-                continue
-            elif user.os_type == OS_IOS and LooseVersion(user.app_ver) <= LooseVersion("1.2.1"):
-                skipped_users['old_version'].append(user.user_id)
-                continue
-            elif is_userid_blacklisted(user.user_id):
-                skipped_users['blacklist'].append(user.user_id)
-                continue
-            elif should_block_user_by_country_code(user.user_id):
-                skipped_users['country'].append(user.user_id)
-                continue
-
-            last_active_date = datetime.date(user.last_updated)
-
-            if today == last_active_date:
-                skipped_users['active_today'].append(user.user_id)
-                continue
-            elif scheme == 'engage-recent' and four_days_ago > last_active_date != seven_days_ago:
-                skipped_users['not_active_recently'].append(user.user_id)
-                continue
-            elif scheme == 'engage-old' and fourteen_days_ago >= last_active_date:
-                skipped_users['active_in_last_two_weeks'].append(user.user_id)
-                continue
-
-            immediate_tasks = count_immediate_tasks(user.user_id, None, False)
-
-            if sum(int(item) for item in immediate_tasks.keys()) == 0:
-                skipped_users['no_active_task'].append(user.user_id)
-                continue
-
-            if user.os_type == OS_IOS:
-                user_ids[OS_IOS].append(user.user_id)
-            else:
-                user_ids[OS_ANDROID].append(user.user_id)
-
-        except Exception as e:
-            log.error('engage-push: caught exception trying to calculate push for user %s. e:%s' % (user.user_id, e))
-            continue
+    params = get_engagement_candidates_params(scheme, datetime_today)
+    skipped_users = dict(blacklist=0, country=0, active_today=0, not_active_recently=0, active_in_last_two_weeks=0,
+                         no_active_task=0, old_version=0)
+
+    # the skip-reason breakdown is counted in the db
+    results = db.engine.execute('select skip_reason, count(*) from (%s) candidates group by skip_reason;' % ENGAGEMENT_CANDIDATES_SQL, params)
+    for skip_reason, count in results.fetchall():
+        if skip_reason is not None:
+            skipped_users[skip_reason] = count
+    log.info("engage-push: counted skipped users in %s secs" % (time.time() - start))
+
+    cat_ids = get_all_cat_ids()
+    now = arrow.utcnow()
+    processed = 0
+    with db.engine.connect() as conn:
+        # stream the candidates rather than loading all of them into memory
+        results = conn.execution_options(stream_results=True).execute(
+            'select * from (%s) candidates where skip_reason is null;' % ENGAGEMENT_CANDIDATES_SQL, params)
+        while True:
+            users = results.fetchmany(config.ENGAGEMENT_PUSH_CHUNK_SIZE)
+            if not users:
+                break
+            completed_tasks = get_completed_tasks_for_users([user.user_id for user in users])
+            for user in users:
+                try:
+                    if not has_immediate_tasks(user.user_id, user.os_type, user.app_ver, completed_tasks[str(user.user_id)], user.next_task_ts_dict, cat_ids, now):
+                        skipped_users['no_active_task'] += 1
+                        continue
+
+                    if user.os_type == OS_IOS:
+                        user_ids[OS_IOS].append(user.user_id)
+                    else:
+                        user_ids[OS_ANDROID].append(user.user_id)
+
+                except Exception as e:
+                    log.error('engage-push: caught exception trying to calculate push for user %s. e:%s' % (user.user_id, e))
+                    continue
+
+            processed = processed + len(users)
+            increment_metric('engagement-candidates-processed', len(users), tags_str='scheme:%s' % scheme)
+            log.info('engage-push: processed %s candidates so far' % processed)
 
     now = arrow.utcnow().shift(seconds=60).timestamp  # add a small time shift to account for calculation time
 
@@ -716,18 +786,23 @@ def get_users_for_engagement_push(scheme):
              "\nengage-push:   %d last time active more than 4 days ago and not exactly week ago"
              "\nengage-push:   %d last time active was in the last 2 weeks"
              "\nengage-push:   %d no active task"
-             % (len(skipped_users['old_version']),
-                len(skipped_users['blacklist']),
-                len(skipped_users['country']),
-                len(skipped_users['active_today']),
-                len(skipped_users['not_active_recently']),
-                len(skipped_users['active_in_last_two_weeks']),
-                len(skipped_users['no_active_task'])))
+             % (skipped_users['old_version'],
+                skipped_users['blacklist'],
+                skipped_users['country'],
+                skipped_users['active_today'],
+                skipped_users['not_active_recently'],
+                skipped_users['active_in_last_two_weeks'],
+                skipped_users['no_active_task']))
+    for skip_reason, count in skipped_users.items():
+        gauge_metric('engagement-skipped-users', count, tags_str='scheme:%s,reason:%s' % (scheme, skip_reason))
     log.info("engage-push: will send push notifications to %d android users, %d ios users"
              % (len(user_ids[OS_ANDROID]), len(user_ids[OS_IOS])))
     log.info("engage-push: will send to the following user_ids: %s" % user_ids)
     end = time.time()
     log.info("engage-push: %s total time it took: %s", now, end - start)
+    gauge_metric('engagement-selection-secs', end - start, tags_str='scheme:%s' % scheme)
+    if end > start:
+        gauge_metric('engagement-selection-users-per-sec', processed / (end - start), tags_str='scheme:%s' % scheme)
     log.info("------------------------------------------------------------------------ ")
     return user_ids
 
@@ -917,8 +992,9 @@ def deactivate_by_enc_phone_number(enc_phone_number, new_user_id, activate_user=
                 # deactivate and copy task_history and next_task_ts
                 db.engine.execute("update public.user set deactivated=true where enc_phone_number='%s' and user_id='%s'" % (enc_phone_number, user_id_to_deactivate))
 
-                completed_tasks_query = "update user_app_data set completed_tasks_dict = Q.col1, next_task_ts_dict = Q.col2 from (select completed_tasks_dict as col1, next_task_ts_dict as col2 from user_app_data where user_id='%s') as Q where user_app_data.user_id = '%s'" % (user_id_to_deactivate, UUID(new_user_id))
-                db.engine.execute(completed_tasks_query)
+                next_task_ts_query = "update user_app_data set next_task_ts_dict = Q.col1 from (select next_task_ts_dict as col1 from user_app_data where user_id='%s') as Q where user_app_data.user_id = '%s'" % (user_id_to_deactivate, UUID(new_user_id))
+                db.engine.execute(next_task_ts_query)
+                copy_completed_tasks(user_id_to_deactivate, UUID(new_user_id))
 
                 # also delete the new user's history and plant the old user's history instead
                 db.engine.execute("delete from public.user_task_results where user_id='%s'" % UUID(new_user_id))
@@ -954,8 +1030,10 @@ def nuke_user_data(phone_number, nuke_all=False):
     for user_id in user_ids:
         db.engine.execute("delete from good where tx_hash in (select tx_hash from transaction where user_id='%s')" % user_id)
         db.engine.execute("delete from public.transaction where user_id='%s'" % user_id)
+        delete_user_balance(user_id)
+        delete_user_offer_purchases(user_id)
         db.engine.execute("delete from public.user_task_results where user_id='%s'" % user_id)
-        db.engine.execute('''update public.user_app_data set completed_tasks_dict='{}'::json where user_id=\'%s\'''' % user_id)
+        db.engine.execute("delete from public.completed_task where user_id='%s'" % user_id)
         db.engine.execute('''update public.user_app_data set next_task_memo_dict='{}'::json where user_id=\'%s\'''' % user_id)
         db.engine.execute('''update public.user_app_data set next_task_ts_dict='{}'::json where user_id=\'%s\'''' % user_id)
 
@@ -977,7 +1055,7 @@ def get_user_config(user_id):
         if not user_app_data:
             log.warning('could not customize user config. disabling p2p txs for this user')
             global_config['p2p_enabled'] = False
-        elif len(user_app_data.completed_tasks_dict.values()) < config.P2P_MIN_TASKS:
+        elif count_completed_tasks(user_id) < config.P2P_MIN_TASKS:
             global_config['p2p_enabled'] = False
 
     # turn off phone verification for older clients:
@@ -1034,7 +1112,7 @@ def get_user_report(user_id):
         user_report['onboarded'] = str(user.onboarded)
         user_report['public_address'] = user.public_address
         user_report['deactivated'] = str(user.deactivated)
-        user_report['completed_tasks'] = user_app_data.completed_tasks_dict
+        user_report['completed_tasks'] = {cat_id: list(task_ids) for cat_id, task_ids in get_completed_tasks(user_id).items()}
         user_report['next_task_ts'] = user_app_data.next_task_ts_dict
         user_report['next_task_memo'] = user_app_data.next_task_memo_dict
         user_report['last_app_launch'] = user_app_data.update_at
@@ -1234,6 +1312,7 @@ def delete_all_user_data(user_id, are_u_sure=False):
     delete_p2p_txs_received = '''delete from p2_p_transaction where receiver_user_id='%s';'''
     delete_phone_backup_hints = '''delete from phone_backup_hints where enc_phone_number in (select enc_phone_number from public.user where user_id='%s');'''
     delete_task_results = '''delete from public.user_task_results where user_id='%s';'''
+    delete_completed_tasks = '''delete from public.completed_task where user_id='%s';'''
     delete_auth_token = '''delete from public.push_auth_token where user_id='%s';'''
     delete_app_data = '''delete from public.user_app_data where user_id='%s';'''
     delete_user = '''delete from public.user where user_id='%s';'''
@@ -1257,6 +1336,8 @@ def delete_all_user_data(user_id, are_u_sure=False):
         db.engine.execute(delete_user_orders % uid)
         log.info('deleting txs...')
         db.engine.execute(delete_user_transactions % uid)
+        delete_user_balance(uid)
+        delete_user_offer_purchases(uid)
         log.info('deleting p2p txs...')
         db.engine.execute(delete_p2p_txs_sent % uid)
         db.engine.execute(delete_p2p_txs_received % uid)
@@ -1264,6 +1345,7 @@ def delete_all_user_data(user_id, are_u_sure=False):
         db.engine.execute(delete_phone_backup_hints % uid)
         log.info('deleting task results...')
         db.engine.execute(delete_task_results % uid)
+        db.engine.execute(delete_completed_tasks % uid)
         log.info('deleting auth tokens...')
         db.engine.execute(delete_auth_token % uid)
         log.info('deleting user data...')
@@ -1281,15 +1363,15 @@ def count_registrations_for_phone_number(phone_number):
 
 
 def count_missing_txs():
-    """counts the number of users with missing txs in their data == users we owe money to"""
-    from datetime import datetime
-    todays_date = str(datetime.today()).split(' ')[0] + '%%'  # convert to sql date format with LIKE '2018-10-12%', double the '%' sign for escaping.
-    sql_stmt = '''SELECT count(*) FROM user_task_results u left join transaction t on u.user_id = t.user_id where t.tx_hash is null  and u.update_at::varchar LIKE '%s';''' % todays_date
-    missing_txs_today = db.engine.execute(sql_stmt)
-    missing_txs_today = missing_txs_today.scalar()
+    """counts the number of today's task payments without a tx == payments we owe users"""
+    import datetime
+    from .task_payment import count_unpaid_task_payments
+    start_of_today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    missing_txs_today = count_unpaid_task_payments(start_of_today, start_of_today + datetime.timedelta(days=1))
     log.info('missing txs today: %s' % missing_txs_today)
     gauge_metric('missing-txs', missing_txs_today)
 
+
 def re_register_all_users():
     """sends a push message to all users with a phone"""
     all_phoned_users = User.query.filter(User.enc_phone_number != None).filter(User.deactivated == False).all()
@@ -1349,7 +1431,8 @@ def task20_migrate_user_to_tasks2(user_id):
     for task_id in completed_tasks:
         if task_id in tasks20_task_ids_list:  # some tasks were not migrated to tasks2.0 - just ignore them
             new_completed_tasks_dict[tasks20_task_id_to_category_id(task_id)].append(task_id)
-    uad.completed_tasks_dict = new_completed_tasks_dict
+    uad.completed_tasks_dict = new_completed_tasks_dict  # only kept as a marker for already-migrated users
+    set_completed_tasks(user_id, new_completed_tasks_dict)
 
     # create and populate dicts for memos and ts's
     epoch_start = arrow.get('0').timestamp
@@ -1388,14 +1471,6 @@ def add_task_to_completed_tasks1(user_id, task_id):
     return True
 
 
-def count_completed_tasks(user_id):
-    total_completed_tasks = 0
-    user_app_data = get_user_app_data(user_id)
-    for tasks_in_categories in user_app_data.completed_tasks_dict.values():
-        total_completed_tasks = total_completed_tasks + len(tasks_in_categories)
-    return total_completed_tasks
-
-
 # this is the data we got from Sarit regarding tasks migration. remove this once migration is completed
 def tasks20_get_tasks_dict():
     """this function returns a dict with all the tasks2.0 migration
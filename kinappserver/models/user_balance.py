@@ -0,0 +1,73 @@
+import logging as log
+
+from sqlalchemy_utils import UUIDType
+
+from kinappserver import db, app
+from kinappserver.utils import gauge_metric
+
+# set once the ledger was built for all the users. from then on, a user without a ledger row has no txs
+BACKFILLED_KEY = 'user-balance-backfilled'
+
+# the balance a tx adds to its user: txs from the server pay the user, incoming txs are spent by the user
+TX_BALANCE_DELTA = 'case when incoming_tx then -amount else amount end'
+
+# a cte that adds the txs in the 'inserted' cte to their users' balances - in the statement that inserts them.
+# a user without a ledger row starts from the sum of the txs that were stored before the statement. (two concurrent
+# first txs of a user with an older history would both count it - the verifier corrects that.)
+UPDATE_LEDGER_CTE = '''ledger as (insert into user_balance (user_id, balance, updated_at)
+                                  select i.user_id, i.delta + case when exists(select 1 from user_balance b where b.user_id = i.user_id) then 0
+                                                           else (select coalesce(sum(%s), 0) from transaction t where t.user_id = i.user_id) end, now()
+                                  from (select user_id, sum(%s) as delta from inserted group by user_id) i
+                                  on conflict (user_id) do update set balance = user_balance.balance + excluded.balance, updated_at = now())''' % (TX_BALANCE_DELTA, TX_BALANCE_DELTA)
+
+
+class UserBalance(db.Model):
+    """the kin balance of a user - the sum of the user's txs, kept up to date by create_tx.
+
+       this lets the offers and booking paths read the balance with a single-row lookup, rather
+       than summing the user's whole tx history.
+    """
+    user_id = db.Column('user_id', UUIDType(binary=False), db.ForeignKey("user.user_id"), primary_key=True, nullable=False)
+    balance = db.Column(db.BigInteger(), nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<user_id: %s, balance: %s, updated_at: %s>' % (self.user_id, self.balance, self.updated_at)
+
+
+def get_user_balance(user_id):
+    """returns the user's balance from the ledger - or from the user's txs, until the ledger is backfilled"""
+    balance = db.engine.execute('''select balance from user_balance where user_id=%s;''', (str(user_id),)).scalar()
+    if balance is not None:
+        return balance
+    if app.redis.exists(BACKFILLED_KEY):
+        return 0
+    return db.engine.execute('''select coalesce(sum(%s), 0) from transaction where user_id=%%s;''' % TX_BALANCE_DELTA, (str(user_id),)).scalar()
+
+
+def backfill_user_balances():
+    """builds the ledger rows of all the users with txs, in bulk. returns the number of rows created"""
+    res = db.engine.execute('''insert into user_balance (user_id, balance, updated_at)
+                               select user_id, sum(%s), now() from transaction group by user_id
+                               on conflict (user_id) do nothing;''' % TX_BALANCE_DELTA)
+    app.redis.set(BACKFILLED_KEY, 1)
+    log.info('backfilled the balances of %s users' % res.rowcount)
+    return res.rowcount
+
+
+def verify_user_balances():
+    """recomputes the balances from the txs, and corrects the ledger rows that drifted. returns a dict of user_id: drift"""
+    drifted = db.engine.execute('''select b.user_id, coalesce(sum(%s), 0) - b.balance as drift
+                                   from user_balance b left join transaction t on t.user_id = b.user_id
+                                   group by b.user_id, b.balance having coalesce(sum(%s), 0) != b.balance;''' % (TX_BALANCE_DELTA, TX_BALANCE_DELTA)).fetchall()
+    for user_id, drift in drifted:
+        log.error('the balance of user %s drifted from its txs by %s - correcting it' % (user_id, drift))
+        # txs stored since the check moved both the ledger and the txs - so add the drift, rather than overwrite
+        db.engine.execute('''update user_balance set balance = balance + %s, updated_at = now() where user_id=%s;''', (drift, str(user_id)))
+    gauge_metric('user-balance-drift', len(drifted))
+    return {str(user_id): drift for user_id, drift in drifted}
+
+
+def delete_user_balance(user_id):
+    """drops the user's ledger row, after the user's txs were deleted"""
+    db.engine.execute('''delete from user_balance where user_id=%s;''', (str(user_id),))
@@ -0,0 +1,113 @@
+import logging as log
+from flask import g, has_request_context
+
+from kinappserver import db, app
+from .user import User, UserAppData
+from .push_auth_token import PushAuthToken, is_user_authenticated
+from .blacklisted_phone_numbers import BlacklistedEncPhoneNumber
+
+
+class UserContext(object):
+    """everything the per-request checks need to know about a user, loaded with a single query.
+
+       get one with get_user_context. the properties mirror the standalone predicates
+       (is_user_authenticated, should_block_user_by_phone_prefix etc.) without hitting the db.
+    """
+
+    def __init__(self, user_id, user, user_app_data, push_auth_token, blacklisted_enc_phone_number):
+        self.user_id = user_id
+        self.user = user
+        self.user_app_data = user_app_data
+        self.push_auth_token = push_auth_token
+        self.blacklisted = blacklisted_enc_phone_number is not None
+        self._unenc_phone_number = None
+        self._decrypted = False
+
+    @property
+    def is_authenticated(self):
+        if self.push_auth_token is None:
+            # the token is created on the fly - let the original code path handle it
+            return is_user_authenticated(self.user_id)
+        return self.push_auth_token.authenticated
+
+    @property
+    def is_phone_verified(self):
+        return self.user is not None and self.user.enc_phone_number is not None
+
+    @property
+    def deactivated(self):
+        return self.user is not None and bool(self.user.deactivated)
+
+    @property
+    def unenc_phone_number(self):
+        """the decrypted phone number, or None. decrypted at most once per context"""
+        if not self._decrypted:
+            self._decrypted = True
+            if not self.is_phone_verified:
+                return None
+            try:
+                self._unenc_phone_number = app.encryption.decrypt(self.user.enc_phone_number)
+            except Exception as e:
+                log.error('cant decrypt the phone number of user_id %s. e: %s' % (self.user_id, e))
+        return self._unenc_phone_number
+
+    @property
+    def country_code(self):
+        return self.user_app_data.country_iso_code if self.user_app_data else None
+
+    @property
+    def should_block_by_phone_prefix(self):
+        phone_number = self.unenc_phone_number
+        if not phone_number:
+            return False
+        for prefix in app.blocked_phone_prefixes:
+            if phone_number.find(prefix) == 0:
+                log.info('should_block_by_phone_prefix: should block user_id %s with phone number %s' % (self.user_id, phone_number))
+                return True
+        return False
+
+    @property
+    def should_allow_by_phone_prefix(self):
+        phone_number = self.unenc_phone_number
+        if not phone_number:
+            log.info('should_allow_by_phone_prefix - no phone number. allowing user')
+            return True
+        for prefix in app.allowed_phone_prefixes:
+            if phone_number.find(prefix) == 0:
+                return True
+        log.info('should_allow_by_phone_prefix: not allowing user_id %s with phone number %s' % (self.user_id, phone_number))
+        return False
+
+    @property
+    def should_block_by_country_code(self):
+        if self.user_app_data is None:
+            return False
+        if self.country_code in app.blocked_country_codes:
+            log.info('should_block_by_country_code: should block user_id %s with country_code %s' % (self.user_id, self.country_code))
+            return True
+        return False
+
+
+def load_user_context(user_id):
+    """load the user context for the given user_id from the db"""
+    res = db.session.query(User, UserAppData, PushAuthToken, BlacklistedEncPhoneNumber)\
+        .outerjoin(UserAppData, UserAppData.user_id == User.user_id)\
+        .outerjoin(PushAuthToken, PushAuthToken.user_id == User.user_id)\
+        .outerjoin(BlacklistedEncPhoneNumber, BlacklistedEncPhoneNumber.enc_phone_number == User.enc_phone_number)\
+        .filter(User.user_id == user_id).first()
+    if res is None:
+        return UserContext(user_id, None, None, None, None)
+    return UserContext(user_id, *res)
+
+
+def get_user_context(user_id):
+    """returns the user context for the given user_id. within a request, the context is loaded only once"""
+    if not has_request_context():
+        return load_user_context(user_id)
+
+    if 'user_contexts' not in g:
+        g.user_contexts = {}
+    key = str(user_id)
+    if key not in g.user_contexts:
+        g.user_contexts[key] = load_user_context(user_id)
+    return g.user_contexts[key]
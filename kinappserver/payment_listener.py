@@ -0,0 +1,124 @@
+"""a listener that pre-fetches the payments made to the offer addresses.
+
+redeeming an offer requires the payment's data - memo, amount and destination - and fetching it from
+horizon inline means polling until the tx shows up. instead, this listener (a long-running process,
+see run) streams the payments made to all the offer addresses from horizon and stores each one in
+the cache, keyed by its tx_hash. process_order reads the cache first, and only polls horizon on a miss.
+
+the sdk's monitor calls back from its own thread, so horizon_payment_stream bridges its callbacks to
+the listener through a queue. the stream is injectable: run accepts a stream factory, so tests can feed
+it payments without horizon.
+"""
+import queue
+import time
+import logging as log
+
+from kinappserver import app, config
+from kinappserver.utils import InternalError, increment_metric
+
+PAYMENT_KEY = 'offer-payment:%s'
+
+
+def write_offer_payment_to_cache(tx_hash, data):
+    from kinappserver import cache
+    # written once, by the listener, and read by the redeeming worker - skip the local tier
+    return cache.set(PAYMENT_KEY % tx_hash, data, config.OFFER_PAYMENT_CACHE_TTL_SECS, local=False)
+
+
+def read_offer_payment_from_cache(tx_hash):
+    """returns the pre-fetched data of the given payment, or None"""
+    from kinappserver import cache
+    return cache.get(PAYMENT_KEY % tx_hash, local=False)
+
+
+def get_offer_addresses():
+    """returns the set of addresses the offers are paid to"""
+    from kinappserver.models.offer import Offer
+    return {address for (address,) in Offer.query.with_entities(Offer.address).distinct().all()}
+
+
+def horizon_payment_stream(addresses, kin_client=None):
+    """streams (address, tx_data) for every payment made to any of the given addresses.
+
+    yields (None, None) when no payment arrived for PAYMENT_LISTENER_REFRESH_SECS, so the consumer gets to
+    check for new addresses. the monitor is stopped when the stream is closed.
+    """
+    payments = queue.Queue()
+
+    def on_payment(address, tx_data, *args):
+        # called by the monitor's thread
+        payments.put((address, tx_data))
+
+    monitor = (kin_client or app.kin_sdk).monitor_accounts_payments(addresses, on_payment)
+    try:
+        while True:
+            try:
+                yield payments.get(timeout=config.PAYMENT_LISTENER_REFRESH_SECS)
+            except queue.Empty:
+                thread = getattr(monitor, 'thread', None)
+                if thread is not None and not thread.is_alive():
+                    raise InternalError('the payment monitor stopped')
+                yield None, None
+    finally:
+        monitor.stop()
+
+
+def handle_payment(addresses, tx_data):
+    """stores the given tx's payment data, if it's a payment to one of the offer addresses. returns True if stored"""
+    from kinappserver.stellar import parse_payment
+    res, data = parse_payment(tx_data)
+    if not res or data['to_address'] not in addresses:
+        return False
+    data['amount'] = float(data['amount'])  # the sdk returns a decimal, which doesn't serialize to json
+    write_offer_payment_to_cache(tx_data.hash, data)
+    increment_metric('offer-payment-prefetched')
+    return True
+
+
+def listen(stream_factory=horizon_payment_stream):
+    """consumes a payment stream until it ends, or until the offer addresses change. returns the number of stored payments"""
+    addresses = get_offer_addresses()
+    if not addresses:
+        log.info('payment listener: no offer addresses to listen to')
+        return 0
+    log.info('payment listener: listening to %s offer addresses' % len(addresses))
+
+    stored = 0
+    refreshed_at = time.time()
+    stream = stream_factory(addresses)
+    try:
+        for _, tx_data in stream:
+            if tx_data is not None:
+                try:
+                    if handle_payment(addresses, tx_data):
+                        stored = stored + 1
+                except Exception as e:
+                    increment_metric('offer-payment-prefetch-error')
+                    log.error('payment listener: failed to handle tx %s: %s' % (getattr(tx_data, 'hash', None), e))
+
+            # offers are rarely added - check for new addresses between payments, and re-open the stream for them
+            if time.time() - refreshed_at > config.PAYMENT_LISTENER_REFRESH_SECS:
+                refreshed_at = time.time()
+                if get_offer_addresses() != addresses:
+                    log.info('payment listener: the offer addresses changed - re-opening the stream')
+                    break
+    finally:
+        # stops the monitor behind the stream
+        if hasattr(stream, 'close'):
+            stream.close()
+    return stored
+
+
+def run(stream_factory=horizon_payment_stream):
+    """listens to the offer addresses forever. this is the entry point of the listener process"""
+    while True:
+        try:
+            listen(stream_factory)
+        except Exception as e:
+            increment_metric('payment-listener-error')
+            log.error('payment listener: the stream failed: %s' % e)
+        time.sleep(config.PAYMENT_LISTENER_RESTART_SECS)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,145 @@
+"""a shared client for the payment service.
+
+all the calls go through a single, pooled requests.Session per worker process - so the tcp+tls
+connections to the payment service are kept alive and reused between payments. every call has
+a timeout, and failed calls are retried with the same X-REQUEST-ID (the memo/order id), so the
+payment service can tell a retry from a new request.
+
+a circuit breaker stops calling the service once it fails repeatedly: calls fail fast until
+PAYMENT_SERVICE_BREAKER_RESET_SECS pass, after which a single trial call is let through.
+"""
+import os
+import threading
+import time
+import logging as log
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kinappserver import config
+from kinappserver.utils import increment_metric, timing_metric
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class PaymentServiceError(Exception):
+    """the payment service failed to handle the request"""
+
+
+class PaymentServiceUnavailable(PaymentServiceError):
+    """the circuit breaker is open - the payment service wasn't called"""
+
+
+class CircuitBreaker(object):
+    """opens after max_failures consecutive failures, and lets a trial call through after reset_secs"""
+
+    def __init__(self, max_failures, reset_secs):
+        self.max_failures = max_failures
+        self.reset_secs = reset_secs
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """returns True if a call may be made now"""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_secs:
+                self.state = HALF_OPEN  # this caller makes the trial call
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.state == HALF_OPEN or self.failures >= self.max_failures:
+                if self.state != OPEN:
+                    log.error('payment-service: opening the circuit breaker after %s failures' % self.failures)
+                    increment_metric('payment-service-breaker-open')
+                self.state = OPEN
+                self.opened_at = time.time()
+
+
+class PaymentServiceClient(object):
+    """posts json to the payment service over a pooled session, with timeouts, retries and a circuit breaker"""
+
+    def __init__(self, base_url, session=None):
+        self.base_url = base_url
+        self.session = session or self.create_session()
+        self.breaker = CircuitBreaker(config.PAYMENT_SERVICE_BREAKER_MAX_FAILURES, config.PAYMENT_SERVICE_BREAKER_RESET_SECS)
+
+    @staticmethod
+    def create_session():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.PAYMENT_SERVICE_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def post(self, endpoint, payload, request_id, conflict_ok=False):
+        """posts the payload to the given endpoint and returns the response.
+
+        request_id is sent as the X-REQUEST-ID of every attempt. with conflict_ok, a 409 (the payment
+        service already has this request - e.g. from an attempt that timed out) is a success.
+        raises PaymentServiceError if all the attempts failed.
+        """
+        headers = {'X-REQUEST-ID': str(request_id)}
+        timeout = (config.PAYMENT_SERVICE_CONNECT_TIMEOUT_SECS, config.PAYMENT_SERVICE_READ_TIMEOUT_SECS)
+        last_error = None
+        for attempt in range(config.PAYMENT_SERVICE_RETRIES + 1):
+            if not self.breaker.allow():
+                increment_metric('payment-service-breaker-rejected', tags_str='endpoint:%s' % endpoint)
+                raise PaymentServiceUnavailable('the circuit breaker is open')
+            if attempt > 0:
+                time.sleep(config.PAYMENT_SERVICE_RETRY_BACKOFF_SECS * (2 ** (attempt - 1)))
+                increment_metric('payment-service-retry', tags_str='endpoint:%s' % endpoint)
+
+            start = time.time()
+            status = 'error'
+            try:
+                res = self.session.post('%s%s' % (self.base_url, endpoint), headers=headers, json=payload, timeout=timeout)
+                status = res.status_code
+                if conflict_ok and res.status_code == 409:
+                    self.breaker.record_success()
+                    return res
+                if res.status_code < 500:
+                    # 4xx responses are the request's fault - the service is up, and retrying wont help
+                    self.breaker.record_success()
+                    res.raise_for_status()
+                    return res
+                last_error = PaymentServiceError('status code %s: %s' % (res.status_code, res.text))
+            except requests.HTTPError as e:
+                raise PaymentServiceError(e)
+            except requests.RequestException as e:
+                last_error = PaymentServiceError(e)
+            finally:
+                timing_metric('payment-service-latency', (time.time() - start) * 1000, tags_str='endpoint:%s,status:%s' % (endpoint, status))
+
+            self.breaker.record_failure()
+            log.error('payment-service: attempt %s of %s to %s (request id %s) failed: %s' % (attempt + 1, config.PAYMENT_SERVICE_RETRIES + 1, endpoint, request_id, last_error))
+        raise last_error
+
+
+client = None
+client_pid = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    """returns the payment service client of this process. sessions arent shared across a fork"""
+    global client, client_pid
+    if client is None or client_pid != os.getpid():
+        with client_lock:
+            if client is None or client_pid != os.getpid():
+                client = PaymentServiceClient(config.PAYMENT_SERVICE_URL)
+                client_pid = os.getpid()
+    return client
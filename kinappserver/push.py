@@ -103,30 +103,14 @@ def send_country_IS_supported(user_id):
 
 
 def send_country_not_supported(user_id):
-    """sends a push to the given userid to tell them their country isnt supported"""
+    """sends a push to the given userid to tell them their country isnt supported. the push is sent by the outbox"""
     #  add cooldown with redis to this function.
     if not (app.redis.set('countrynot:%s' % str(user_id), '', ex=COUNTRY_NOT_SUPPORTED_PUSH_COOLDOWN_SECONDS, nx=True)):
         # returns None if already exists
         return
 
-    push_id = generate_push_id()
-    push_type = 'country_not_supported'
-    from kinappserver.models import get_user_push_data
-    os_type, token, push_env = get_user_push_data(user_id)
-    if token:
-        if os_type == OS_ANDROID:
-            increment_metric('country_not_supported-android')
-            # return  # not supported yet
-            print('sending country_not_supported push message to GCM user %s' % user_id)
-            push_send_gcm(token, gcm_payload(push_type, push_id, {'title': 'Oh no!', 'body': "Kinit is currently not available in your country. We are continuing to grow, so check back again soon."}), push_env)
-
-        else:
-            increment_metric('country_not_supported-ios')
-            print('sending country_not_supported push message to APNS user %s' % user_id)
-            push_send_apns(token, apns_payload("Oh no!", "Kinit is currently not available in your country. We are continuing to grow, so check back again soon.", push_type, push_id), push_env)
-    else:
-        print('not sending country_not_supported push to user_id %s: no token' % user_id)
-    return
+    from kinappserver.push_outbox import enqueue_push
+    enqueue_push('country_not_supported', user_id)
 
 
 def send_please_upgrade_push(user_id):
@@ -157,28 +141,29 @@ def send_please_upgrade_push(user_id):
 
 
 def send_please_upgrade_push_2(user_ids):
-    for user_id in user_ids:
-        send_please_upgrade_push_2_inner(user_id)
-
-
-def send_please_upgrade_push_2_inner(user_id):
-    """sends a push to the given userid to please upgrade"""
-    push_id = generate_push_id()
+    """sends a please-upgrade push to all the given userids. users that share the os and push env are sent together"""
     push_type = 'please_upgrade'
-    from kinappserver.models import get_user_push_data
-    os_type, token, push_env = get_user_push_data(user_id)
-    if token:
+    from kinappserver.models import get_users_push_data
+    push_data = get_users_push_data([str(user_id) for user_id in user_ids])
+
+    tokens_by_target = {}
+    for user_id in user_ids:
+        os_type, token, push_env = push_data.get(str(user_id), (None, None, None))
+        if not token:
+            print('not sending please-upgrade push to user_id %s: no token' % user_id)
+            continue
+        tokens_by_target.setdefault((os_type, push_env), []).append(token)
+
+    for (os_type, push_env), tokens in tokens_by_target.items():
+        push_id = generate_push_id()
         if os_type == OS_ANDROID:
-            increment_metric('pleaseupgrade-android')
-            print('sending please-upgrade push message to GCM user %s' % user_id)
-            push_send_gcm(token, gcm_payload('engage-recent', push_id, {'title': '', 'body': "Your current version of Kinit is no longer supported. Please download the newest version from Google Play"}), push_env)
+            increment_metric('pleaseupgrade-android', len(tokens))
+            print('sending please-upgrade push message to %s GCM users' % len(tokens))
+            push_send_gcm_batch(tokens, gcm_payload('engage-recent', push_id, {'title': '', 'body': "Your current version of Kinit is no longer supported. Please download the newest version from Google Play"}), push_env)
         else:
-            increment_metric('pleaseupgrade-ios')
-            print('sending please-upgrade push message to APNS user %s' % user_id)
-            push_send_apns(token, apns_payload("", "Your current version of Kinit is no longer supported. Please download the newest version from the App Store", push_type, push_id), push_env)
-    else:
-        print('not sending please-upgrade push to user_id %s: no token' % user_id)
-    return
+            increment_metric('pleaseupgrade-ios', len(tokens))
+            print('sending please-upgrade push message to %s APNS users' % len(tokens))
+            push_send_apns_batch(tokens, apns_payload("", "Your current version of Kinit is no longer supported. Please download the newest version from the App Store", push_type, push_id), push_env)
 
 
 def apns_payload(title, body, push_type, push_id, sound='default', extra_payload_dict=None):
@@ -212,6 +197,64 @@ def push_send_gcm(token, payload, push_env):
     app.amqp_publisher_beta.send_gcm("eshu-key-beta", payload, [token], False, config.PUSH_TTL_SECS)
 
 
+def push_send_gcm_batch(tokens, payload, push_env):
+    """sends the same gcm payload to all the given tokens. returns a list with the success of each token"""
+    if config.DEPLOYMENT_ENV == 'test':
+        print('skipping push on test env')
+        return
+
+    if push_env != 'beta':
+        print('error: cant send gcm over push env: %s. only beta is currently supported' % push_env)
+        return
+
+    return app.amqp_publisher_beta.send_gcm("eshu-key-beta", payload, tokens, False, config.PUSH_TTL_SECS)
+
+
+def push_send_apns_batch(tokens, payload, push_env):
+    """sends the same apns payload to all the given tokens. returns a list with the success of each token"""
+    if config.DEPLOYMENT_ENV == 'test':
+        print('skipping push on test env')
+        return
+    if push_env == 'beta':
+        return app.amqp_publisher_beta.send_apns("eshu-key-beta", payload, tokens)
+    else:
+        return app.amqp_publisher_release.send_apns("eshu-key-release", payload, tokens)
+
+
+def push_send_many(pushes):
+    """sends the given list of (os_type, token, payload, push_env) pushes, each with its own payload.
+
+    the pushes are published in one batch per push env. returns a list with the success of each push.
+    """
+    if config.DEPLOYMENT_ENV == 'test':
+        print('skipping push on test env')
+        return [True] * len(pushes)
+
+    results = [False] * len(pushes)
+    batches = {}
+    for i, (os_type, token, payload, push_env) in enumerate(pushes):
+        if os_type == OS_ANDROID:
+            if push_env != 'beta':
+                print('error: cant send gcm over push env: %s. only beta is currently supported' % push_env)
+                continue
+            message = app.amqp_publisher_beta.gcm_message(token, payload, False, config.PUSH_TTL_SECS)
+        else:
+            publisher = app.amqp_publisher_beta if push_env == 'beta' else app.amqp_publisher_release
+            message = publisher.apns_message(token, payload, False)
+        batches.setdefault(push_env, ([], []))
+        batches[push_env][0].append(i)
+        batches[push_env][1].append(message)
+
+    for push_env, (indices, messages) in batches.items():
+        if push_env == 'beta':
+            batch_results = app.amqp_publisher_beta.publish_many("eshu-key-beta", messages)
+        else:
+            batch_results = app.amqp_publisher_release.publish_many("eshu-key-release", messages)
+        for i, success in zip(indices, batch_results):
+            results[i] = success
+    return results
+
+
 def push_send_apns(token, payload, push_env):
     if config.DEPLOYMENT_ENV == 'test':
         print('skipping push on test env')
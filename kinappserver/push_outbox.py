@@ -0,0 +1,256 @@
+"""an outbox for pushes sent from the request path.
+
+request handlers dont talk to rabbitmq (or look up push tokens) inline: they enqueue a compact push
+intent - (kind, user_id, args) - into an in-process queue, and return. a background flusher thread
+(one per worker process, started on first use) drains the queue in batches: it loads the push data
+of the whole batch in a single query, builds the payloads and publishes them through the amqp pool.
+
+a redis list is the durable fallback: intents are spilled to it when the in-process queue is full,
+when a batch fails to publish and when the worker exits. the flushers drain the list whenever their
+own queue is idle, and it can also be drained via the private api.
+"""
+import atexit
+import json
+import os
+import time
+import threading
+from queue import Queue, Empty, Full
+import logging as log
+
+from flask import has_app_context
+
+from kinappserver import app, config
+from kinappserver.utils import OS_IOS, increment_metric, gauge_metric, timing_metric
+
+# counters of this worker process, reported by the private api
+stats = {'enqueued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'spilled': 0}
+stats_lock = threading.Lock()
+
+outbox = Queue(maxsize=config.PUSH_OUTBOX_MAX_SIZE)
+flusher = None
+flusher_pid = None
+flusher_lock = threading.Lock()
+
+
+def count(stat, value=1):
+    if not value:
+        return
+    with stats_lock:
+        stats[stat] = stats[stat] + value
+    increment_metric('push-outbox-%s' % stat, value)
+
+
+def tx_completed_payload(os_type, user_id, args):
+    from kinappserver.push import tx_completed_push_apns, gcm_payload, generate_push_id
+    if os_type == OS_IOS:
+        return tx_completed_push_apns(generate_push_id(), str(args['tx_hash']), str(user_id), str(args['task_id']), int(args['amount']), str(args['memo']))
+    return gcm_payload('tx_completed', generate_push_id(), {'type': 'tx_completed', 'user_id': user_id, 'tx_hash': args['tx_hash'], 'kin': args['amount'], 'task_id': args['task_id']})
+
+
+def country_not_supported_payload(os_type, user_id, args):
+    from kinappserver.push import apns_payload, gcm_payload, generate_push_id
+    title = 'Oh no!'
+    body = "Kinit is currently not available in your country. We are continuing to grow, so check back again soon."
+    if os_type == OS_IOS:
+        increment_metric('country_not_supported-ios')
+        return apns_payload(title, body, 'country_not_supported', generate_push_id())
+    increment_metric('country_not_supported-android')
+    return gcm_payload('country_not_supported', generate_push_id(), {'title': title, 'body': body})
+
+
+# the kinds of intents the outbox knows how to send, and the function building each one's payload
+PAYLOAD_BUILDERS = {
+    'tx_completed': tx_completed_payload,
+    'country_not_supported': country_not_supported_payload,
+}
+
+
+def enqueue_push(kind, user_id, **args):
+    """queues a push of the given kind to the given user. never blocks on rabbitmq or the db"""
+    return enqueue_pushes(kind, [(user_id, args)])
+
+
+def enqueue_pushes(kind, pushes):
+    """queues a push of the given kind for each of the given (user_id, args) pairs"""
+    if kind not in PAYLOAD_BUILDERS:
+        log.error('push-outbox: no such push kind: %s' % kind)
+        return False
+
+    intents = [{'kind': kind, 'user_id': str(user_id), 'args': args, 'attempts': 0, 'ts': time.time()} for user_id, args in pushes]
+    count('enqueued', len(intents))
+    if config.DEPLOYMENT_ENV == 'test':
+        # no background threads in tests - deliver right away
+        deliver(intents)
+        return True
+
+    ensure_flusher()
+    overflow = []
+    for intent in intents:
+        try:
+            outbox.put_nowait(intent)
+        except Full:
+            overflow.append(intent)
+    spill(overflow)
+    return True
+
+
+def ensure_flusher():
+    """starts this process' flusher thread, unless it is already running. threads dont survive a fork,
+    so the thread is started on first use in each worker"""
+    global flusher, flusher_pid
+    if flusher is not None and flusher_pid == os.getpid() and flusher.is_alive():
+        return
+    with flusher_lock:
+        if flusher is not None and flusher_pid == os.getpid() and flusher.is_alive():
+            return
+        flusher = threading.Thread(target=flush_forever, name='push-outbox-flusher', daemon=True)
+        flusher_pid = os.getpid()
+        flusher.start()
+
+
+def flush_forever():
+    while True:
+        try:
+            if not flush_once():
+                # nothing queued locally - help drain the backlog left in redis
+                drain_backlog(config.PUSH_OUTBOX_BATCH_SIZE)
+        except Exception as e:
+            log.error('push-outbox: flusher failed. e: %s' % e)
+            time.sleep(config.PUSH_OUTBOX_FLUSH_INTERVAL_SECS)
+
+
+def flush_once():
+    """waits for intents in the in-process queue and delivers a batch of them. returns the number delivered"""
+    try:
+        batch = [outbox.get(timeout=config.PUSH_OUTBOX_FLUSH_INTERVAL_SECS)]
+    except Empty:
+        return 0
+    while len(batch) < config.PUSH_OUTBOX_BATCH_SIZE:
+        try:
+            batch.append(outbox.get_nowait())
+        except Empty:
+            break
+    gauge_metric('push-outbox-size', outbox.qsize())
+    deliver(batch)
+    return len(batch)
+
+
+def deliver(intents):
+    """sends the given intents. intents that fail are spilled to redis for another attempt"""
+    from kinappserver.models import get_users_push_data
+    from kinappserver.push import push_send_many
+
+    start = time.time()
+    try:
+        user_ids = list({intent['user_id'] for intent in intents})
+        if has_app_context():
+            push_data = get_users_push_data(user_ids)
+        else:
+            # the flusher thread - the context is popped afterwards, releasing its db session
+            with app.app_context():
+                push_data = get_users_push_data(user_ids)
+    except Exception as e:
+        log.error('push-outbox: cant load the push data of %s intents. e: %s' % (len(intents), e))
+        retry(intents)
+        return
+
+    pushes = []
+    to_send = []
+    for intent in intents:
+        os_type, token, push_env = push_data.get(intent['user_id'], (None, None, None))
+        if not token:
+            log.error('push-outbox: cant push %s to user %s: no push token' % (intent['kind'], intent['user_id']))
+            count('dropped')
+            continue
+        try:
+            payload = PAYLOAD_BUILDERS[intent['kind']](os_type, intent['user_id'], intent['args'])
+        except Exception as e:
+            log.error('push-outbox: cant build the payload of %s. e: %s' % (intent, e))
+            count('dropped')
+            continue
+        pushes.append((os_type, token, payload, push_env))
+        to_send.append(intent)
+
+    if not pushes:
+        return
+    try:
+        results = push_send_many(pushes)
+    except Exception as e:
+        log.error('push-outbox: failed to send %s pushes. e: %s' % (len(pushes), e))
+        results = [False] * len(pushes)
+
+    failed = [intent for intent, success in zip(to_send, results) if not success]
+    count('sent', len(to_send) - len(failed))
+    retry(failed)
+    timing_metric('push-outbox-deliver-latency', (time.time() - start) * 1000)
+
+
+def retry(intents):
+    """spills the given failed intents to redis, dropping those that ran out of attempts"""
+    if not intents:
+        return
+    count('failed', len(intents))
+    retriable = []
+    for intent in intents:
+        intent['attempts'] = intent['attempts'] + 1
+        if intent['attempts'] >= config.PUSH_OUTBOX_MAX_ATTEMPTS:
+            log.error('push-outbox: giving up on %s' % intent)
+            count('dropped')
+        else:
+            retriable.append(intent)
+    spill(retriable)
+
+
+def spill(intents):
+    """appends the given intents to the redis backlog"""
+    if not intents:
+        return
+    try:
+        app.redis.rpush(config.PUSH_OUTBOX_REDIS_KEY, *[json.dumps(intent) for intent in intents])
+        count('spilled', len(intents))
+    except Exception as e:
+        log.error('push-outbox: cant spill %s intents to redis - they are lost. e: %s' % (len(intents), e))
+        count('dropped', len(intents))
+
+
+def drain_backlog(limit):
+    """pops up to limit intents from the redis backlog and delivers them. returns the number popped"""
+    pipe = app.redis.pipeline()  # a transaction, so two flushers never pop the same intents
+    pipe.lrange(config.PUSH_OUTBOX_REDIS_KEY, 0, limit - 1)
+    pipe.ltrim(config.PUSH_OUTBOX_REDIS_KEY, limit, -1)
+    raw_intents = pipe.execute()[0]
+    if not raw_intents:
+        return 0
+
+    intents = []
+    for raw in raw_intents:
+        try:
+            intents.append(json.loads(raw.decode()))
+        except Exception as e:
+            log.error('push-outbox: cant decode intent %s. e: %s' % (raw, e))
+    deliver(intents)
+    return len(raw_intents)
+
+
+def spill_local_queue():
+    """moves whatever is still in the in-process queue to redis. called when the worker exits"""
+    intents = []
+    while True:
+        try:
+            intents.append(outbox.get_nowait())
+        except Empty:
+            break
+    spill(intents)
+
+
+atexit.register(spill_local_queue)
+
+
+def get_outbox_status():
+    """returns this worker's outbox counters, along with the size of the shared redis backlog"""
+    with stats_lock:
+        status = dict(stats)
+    status['queued'] = outbox.qsize()
+    status['backlog'] = app.redis.llen(config.PUSH_OUTBOX_REDIS_KEY)
+    status['flusher_alive'] = flusher is not None and flusher_pid == os.getpid() and flusher.is_alive()
+    return status
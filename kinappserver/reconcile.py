@@ -0,0 +1,90 @@
+"""incremental reconciliation of task payments.
+
+every requested task payment is recorded in the task_payment table. this job scans the table forward
+from a watermark kept in redis, matching each payment to its tx by memo. payments that have no tx
+RECONCILE_GRACE_SECS after they were requested are re-submitted through the reward queue - with the
+same memo, so the payment service never pays twice - until they run out of attempts.
+
+the watermark is the creation time of the oldest payment that is still pending: everything before it
+is either paid or abandoned, so every run only scans the recent, unsettled part of the table.
+"""
+import datetime
+import logging as log
+
+import redis_lock
+
+from kinappserver import app, config
+from kinappserver.utils import gauge_metric, increment_metric
+
+WATERMARK_KEY = 'reconcile-watermark'
+LOCK_NAME = 'reconcile-payments'
+
+
+def get_watermark():
+    """returns the watermark, or the start of the lookback period if there is none"""
+    watermark = app.redis.get(WATERMARK_KEY)
+    if watermark is None:
+        return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=config.RECONCILE_LOOKBACK_SECS)
+    return datetime.datetime.fromtimestamp(float(watermark), datetime.timezone.utc)
+
+
+def set_watermark(watermark):
+    app.redis.set(WATERMARK_KEY, watermark.timestamp())
+
+
+def reconcile_payments():
+    """re-submits the unpaid task payments after the watermark and advances it. returns a summary dict"""
+    from kinappserver.models import ensure_transaction_memo_index, get_task_payments_since, mark_task_payment_resubmitted
+    from kinappserver.rewards import resubmit_task_reward
+
+    lock = redis_lock.Lock(app.redis, LOCK_NAME, expire=config.RECONCILE_LOCK_EXPIRE_SECS)
+    if not lock.acquire(blocking=False):
+        log.info('reconcile: another reconciliation is running')
+        return None
+
+    try:
+        ensure_transaction_memo_index()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        until = now - datetime.timedelta(seconds=config.RECONCILE_GRACE_SECS)
+        watermark = get_watermark()
+        payments = get_task_payments_since(watermark, until, config.RECONCILE_BATCH_SIZE)
+
+        summary = {'scanned': len(payments), 'paid': 0, 'resubmitted': 0, 'abandoned': 0, 'backlog': 0, 'backlog_age_secs': 0}
+        oldest_pending = None
+        retry_before = now - datetime.timedelta(seconds=config.RECONCILE_RETRY_INTERVAL_SECS)
+        for memo, user_id, task_id, public_address, amount, send_push, attempts, abandoned, created_at, resubmitted_at, paid in payments:
+            if paid:
+                summary['paid'] = summary['paid'] + 1
+                continue
+            if abandoned:
+                continue
+            if attempts >= config.RECONCILE_MAX_ATTEMPTS:
+                mark_task_payment_resubmitted(memo, abandon=True)
+                summary['abandoned'] = summary['abandoned'] + 1
+                continue
+
+            summary['backlog'] = summary['backlog'] + 1
+            oldest_pending = oldest_pending or created_at
+            if resubmitted_at is not None and resubmitted_at > retry_before:
+                continue  # the last attempt is still in flight
+            log.info('reconcile: re-submitting the payment of %s kins for task %s to user %s (memo %s)' % (amount, task_id, user_id, memo))
+            resubmit_task_reward(public_address, task_id, send_push, user_id, memo, amount)
+            mark_task_payment_resubmitted(memo)
+            summary['resubmitted'] = summary['resubmitted'] + 1
+
+        if oldest_pending is not None:
+            set_watermark(oldest_pending)
+            summary['backlog_age_secs'] = int((now - oldest_pending).total_seconds())
+        elif len(payments) == config.RECONCILE_BATCH_SIZE:
+            set_watermark(payments[-1][8])  # a full batch - continue from its last payment in the next run
+        else:
+            set_watermark(until)
+
+        gauge_metric('reconcile-backlog', summary['backlog'])
+        gauge_metric('reconcile-backlog-age', summary['backlog_age_secs'])
+        increment_metric('reconcile-resubmitted', summary['resubmitted'])
+        increment_metric('reconcile-abandoned', summary['abandoned'])
+        log.info('reconcile: %s' % summary)
+        return summary
+    finally:
+        lock.release()
@@ -0,0 +1,173 @@
+"""a bounded pool of threads sending the rewards that are paid directly from our own kin account.
+
+app.kin_account sends over a fixed set of channel seeds, so there's no point in running more sends
+than there are channels: the pool has one thread per channel seed, and a bounded number of pending
+rewards. when it is full, submit_reward raises RewardPoolFull, so the endpoint can tell the caller
+to come back later instead of piling up threads. a caller that must know there's room before it commits
+to a reward takes a reservation first (see reserve) and hands it over to submit_reward.
+
+each pool thread keeps to a slot - one per channel - and the in-flight sends and their latency are
+reported per slot. on SIGTERM the pool stops taking rewards and drains the pending ones before the
+process exits.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import logging as log
+
+from kinappserver import app, config
+from kinappserver.utils import InternalError, increment_metric, gauge_metric, timing_metric
+
+
+class RewardPoolFull(InternalError):
+    """raised when there's no room for another pending reward"""
+    status_code = 503
+
+
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+draining = False
+
+# the rewards submitted to the pool and not done yet, and the number currently sent by each slot
+pending = 0
+in_flight = {}
+pending_cond = threading.Condition()
+slots = threading.local()
+slots_count = 0
+
+
+def get_pool_size():
+    """one thread per channel seed"""
+    return max(1, getattr(app, 'kin_channels_count', 1))
+
+
+def get_executor():
+    """returns this process' executor. threads dont survive a fork, so it is created on first use in each worker"""
+    global executor, executor_pid, pending, in_flight, slots_count
+    if executor is not None and executor_pid == os.getpid():
+        return executor
+    with executor_lock:
+        if executor is None or executor_pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=get_pool_size())
+            executor_pid = os.getpid()
+            pending = 0
+            in_flight = {}
+            slots_count = 0
+    return executor
+
+
+def get_slot():
+    """returns the slot (channel) of the calling pool thread"""
+    global slots_count
+    if not hasattr(slots, 'slot'):
+        with pending_cond:
+            slots.slot = slots_count
+            slots_count = slots_count + 1
+    return slots.slot
+
+
+class Reservation(object):
+    """room for one pending reward, taken before the reward is submitted"""
+
+    def __init__(self):
+        self.used = False
+
+    def release(self):
+        """gives the room back, unless a reward was submitted with it. safe to call more than once"""
+        if not self.used:
+            self.used = True
+            done()
+
+
+def reserve():
+    """takes room for a reward and returns its Reservation. raises RewardPoolFull if the pool can't take it"""
+    global pending
+    get_executor()  # resets the counters in a new worker
+    with pending_cond:
+        if draining or pending >= get_pool_size() + config.REWARD_POOL_MAX_PENDING:
+            increment_metric('reward-pool-rejected')
+            raise RewardPoolFull('too many pending rewards - try again later')
+        pending = pending + 1
+    gauge_metric('reward-pool-pending', pending)
+    return Reservation()
+
+
+def submit_reward(func, *args, reservation=None):
+    """runs func(*args) on the pool, using the given reservation if any. raises RewardPoolFull if the pool can't take it"""
+    if config.DEPLOYMENT_ENV == 'test':
+        # no background threads in tests - send right away
+        if reservation is not None:
+            reservation.release()
+        return func(*args)
+
+    pool = get_executor()
+    reservation = reservation or reserve()
+    reservation.used = True  # from now on, the reward itself gives the room back
+    try:
+        return pool.submit(run_reward, func, args)
+    except Exception:
+        done()
+        raise
+
+
+def run_reward(func, args):
+    slot = get_slot()
+    with pending_cond:
+        in_flight[slot] = in_flight.get(slot, 0) + 1
+    gauge_metric('reward-pool-in-flight', in_flight[slot], tags_str='channel:%s' % slot)
+    start = time.time()
+    try:
+        return func(*args)
+    except Exception as e:
+        log.error('reward-pool: reward failed on channel %s: %s' % (slot, e))
+    finally:
+        timing_metric('reward-pool-latency', (time.time() - start) * 1000, tags_str='channel:%s' % slot)
+        with pending_cond:
+            in_flight[slot] = in_flight[slot] - 1
+        gauge_metric('reward-pool-in-flight', in_flight[slot], tags_str='channel:%s' % slot)
+        done()
+
+
+def done():
+    global pending
+    with pending_cond:
+        pending = pending - 1
+        pending_cond.notify_all()
+
+
+def drain(timeout):
+    """stops taking rewards and waits up to timeout seconds for the pending ones. returns the number left pending"""
+    global draining
+    draining = True
+    deadline = time.time() + timeout
+    with pending_cond:
+        while pending > 0 and time.time() < deadline:
+            pending_cond.wait(deadline - time.time())
+        left = pending
+    if left:
+        log.error('reward-pool: exiting with %s pending rewards' % left)
+    return left
+
+
+def install_sigterm_handler():
+    """drains the pool on SIGTERM, and then hands the signal over to the previous handler"""
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        if executor is not None and executor_pid == os.getpid():
+            log.info('reward-pool: got SIGTERM - draining %s pending rewards' % pending)
+            drain(config.REWARD_POOL_DRAIN_TIMEOUT_SECS)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            sys.exit(0)
+
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        log.info('reward-pool: not in the main thread - not installing the SIGTERM handler')
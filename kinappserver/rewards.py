@@ -0,0 +1,219 @@
+"""asynchronous dispatch of task rewards.
+
+/user/task/results doesn't pay the user inline: it enqueues a reward job on the dedicated reward rq
+queue and returns. the job - keyed by (user_id, task_id, memo) - looks up the reward, writes the memo
+for the payment callback and posts the payment to the payment service. the memo is the payment's id,
+so a job that runs twice can't pay twice.
+
+every payment is recorded in the task_payment table, so the reconciliation job can re-submit
+payments whose tx never shows up (see reconcile.py).
+
+a job that fails is retried with an exponential backoff: it is put in a redis sorted set, scored by the
+time it is due, and moved back to the queue by requeue_due_rewards (called by every reward job and by a
+cron job). a job that keeps failing is moved to a dead-letter list. each job's status is kept in a
+redis hash for a day.
+"""
+import json
+import time
+from uuid import uuid4
+import logging as log
+
+import arrow
+
+from kinappserver import app, config
+from kinappserver.utils import InternalError, increment_metric, gauge_metric, write_payment_data_to_cache
+
+REWARD_JOB_STATUS_KEY = 'reward-job:%s'
+REWARD_RETRY_KEY = 'reward-retry'
+REWARD_DEAD_LETTER_KEY = 'reward-dead-letter'
+REWARD_JOB_STATUS_TTL_SECS = 24 * 60 * 60
+
+QUEUED = 'queued'
+RUNNING = 'running'
+RETRYING = 'retrying'
+DONE = 'done'
+DEAD = 'dead'
+
+
+def get_job_key(user_id, task_id, memo):
+    return '%s:%s:%s' % (user_id, task_id, memo)
+
+
+def set_job_status(job_key, state, **fields):
+    key = REWARD_JOB_STATUS_KEY % job_key
+    fields.update({'state': state, 'updated_at': time.time()})
+    pipe = app.redis.pipeline()
+    pipe.hmset(key, fields)
+    pipe.expire(key, REWARD_JOB_STATUS_TTL_SECS)
+    pipe.execute()
+
+
+def get_job_status(user_id, task_id, memo):
+    """returns the status of the reward job for the given user, task and memo - or None if there's no such job"""
+    status = {k.decode(): v.decode() for k, v in app.redis.hgetall(REWARD_JOB_STATUS_KEY % get_job_key(user_id, task_id, memo)).items()}
+    if not status:
+        return None
+    status['attempts'] = int(status.get('attempts', 0))
+    status['updated_at'] = float(status['updated_at'])
+    return status
+
+
+def enqueue_task_reward(public_address, task_id, send_push, user_id, memo, delta=0, amount=None, compensated=False):
+    """enqueues a job paying the user for the task. returns False if a job for this payment already exists.
+
+    the amount is the task's reward (plus the delta), unless given. compensated payments let the user know
+    with a push once they were made.
+    """
+    job_key = get_job_key(user_id, task_id, memo)
+    if not app.redis.hsetnx(REWARD_JOB_STATUS_KEY % job_key, 'state', QUEUED):
+        log.info('reward: job %s already exists - not enqueueing it again' % job_key)
+        increment_metric('reward-job-duplicate')
+        return False
+    set_job_status(job_key, QUEUED, attempts=0)
+
+    args = {'public_address': public_address, 'task_id': str(task_id), 'send_push': send_push, 'user_id': str(user_id), 'memo': str(memo), 'delta': delta, 'amount': amount, 'compensated': compensated}
+    if config.DEPLOYMENT_ENV == 'test':
+        # there are no rq workers in tests - pay right away
+        run_reward_job(args, 0)
+        return True
+
+    app.rq_reward.enqueue_call(func=run_reward_job, args=(args, 0), job_id='reward-%s' % job_key)
+    increment_metric('reward-job-enqueued')
+    return True
+
+
+def resubmit_task_reward(public_address, task_id, send_push, user_id, memo, amount):
+    """enqueues another attempt of a payment that was made, but never reached the user. used by the reconciliation job"""
+    job_key = get_job_key(user_id, task_id, memo)
+    set_job_status(job_key, QUEUED, attempts=0)
+    args = {'public_address': public_address, 'task_id': str(task_id), 'send_push': send_push, 'user_id': str(user_id), 'memo': str(memo), 'delta': 0, 'amount': amount}
+    if config.DEPLOYMENT_ENV == 'test':
+        run_reward_job(args, 0)
+        return
+    app.rq_reward.enqueue_call(func=run_reward_job, args=(args, 0), job_id='reward-%s-%s' % (job_key, uuid4().hex))
+    increment_metric('reward-job-resubmitted')
+
+
+def retry_failed_payment(memo):
+    """re-submits the task payment with the given memo, after the payment service reported that it failed.
+
+    counts as one of the payment's reconciliation attempts. returns True if the payment was re-submitted
+    """
+    from kinappserver.models import get_task_payment, mark_task_payment_resubmitted
+    payment = get_task_payment(memo)
+    if payment is None or payment.abandoned:
+        log.info('reward: not retrying the failed payment %s - not a pending task payment' % memo)
+        return False
+    if payment.attempts >= config.RECONCILE_MAX_ATTEMPTS:
+        mark_task_payment_resubmitted(memo, abandon=True)
+        return False
+
+    log.info('reward: re-submitting the failed payment of %s kins for task %s to user %s (memo %s)' % (payment.amount, payment.task_id, payment.user_id, memo))
+    mark_task_payment_resubmitted(memo)
+    resubmit_task_reward(payment.public_address, payment.task_id, payment.send_push, payment.user_id, memo, payment.amount)
+    increment_metric('reward-failed-payment-resubmitted')
+    return True
+
+
+def run_reward_job(args, attempt):
+    """pays the reward described by args. should be called in the worker"""
+    job_key = get_job_key(args['user_id'], args['task_id'], args['memo'])
+    status = get_job_status(args['user_id'], args['task_id'], args['memo'])
+    if status and status['state'] == DONE:
+        log.info('reward: job %s is already done' % job_key)
+        return
+
+    set_job_status(job_key, RUNNING, attempts=attempt + 1)
+    try:
+        pay_task_reward(**args)
+    except Exception as e:
+        log.error('reward: job %s failed (attempt %s): %s' % (job_key, attempt + 1, e))
+        schedule_retry(job_key, args, attempt + 1, str(e))
+    else:
+        set_job_status(job_key, DONE)
+        increment_metric('reward-job-done')
+        # dispatch the retries that are due, now that the payment service seems to be up
+        requeue_due_rewards()
+
+
+def pay_task_reward(public_address, task_id, send_push, user_id, memo, delta=0, amount=None, compensated=False):
+    """transfer the correct amount of kins for the task to the given address using the payment service.
+       the payment service is async and calls a callback when its done. the tx is written into the db
+       in the callback function.
+
+       typically, tips are negative delta and quiz-results are positive delta
+    """
+    from kinappserver.models import get_reward_for_task, create_tx, record_task_payment, get_task_details, send_compensated_push
+    from kinappserver.stellar import send_kin, send_kin_with_payment_service
+
+    if amount is None:
+        # get reward amount from db
+        amount = get_reward_for_task(task_id)
+        if not amount:
+            print('could not figure reward amount for task_id: %s' % task_id)
+            raise InternalError('cant find reward for task_id %s' % task_id)
+
+        # take into account the delta: add or reduce kins from the amount
+        amount = amount + delta
+
+    # the reconciliation job re-submits this payment if its tx never shows up
+    record_task_payment(memo, user_id, task_id, public_address, amount, send_push)
+    write_payment_data_to_cache(memo, user_id, task_id, arrow.utcnow().timestamp, send_push)  # store this info in cache for when the callback is called
+    print('calling send_kin with the payment service: %s, %s' % (public_address, amount))
+    # sends a request to the payment service. result comes back via a callback
+    if config.DEPLOYMENT_ENV == 'test':
+        tx_hash = send_kin(public_address, amount, memo)
+        create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': memo})
+    elif not send_kin_with_payment_service(public_address, amount, memo):
+        raise InternalError('the payment service failed to pay %s kins to %s' % (amount, public_address))
+
+    if compensated:
+        # a failed push must not fail the job - that would pay again
+        try:
+            send_compensated_push(user_id, amount, get_task_details(task_id)['title'])
+        except Exception as e:
+            log.error('failed to send the compensation push to user %s. e: %s' % (user_id, e))
+
+
+def schedule_retry(job_key, args, attempts, error):
+    """schedules another attempt of the given job, or dead-letters it if it ran out of attempts"""
+    if attempts >= config.REWARD_JOB_MAX_ATTEMPTS:
+        app.redis.rpush(REWARD_DEAD_LETTER_KEY, json.dumps({'args': args, 'attempts': attempts, 'error': error, 'ts': time.time()}))
+        set_job_status(job_key, DEAD, attempts=attempts, error=error)
+        increment_metric('reward-job-dead-lettered')
+        log.error('reward: job %s failed %s times - moved to the dead-letter list' % (job_key, attempts))
+        return
+
+    due = time.time() + config.REWARD_JOB_RETRY_BACKOFF_SECS * (2 ** (attempts - 1))
+    app.redis.zadd(REWARD_RETRY_KEY, due, json.dumps({'args': args, 'attempt': attempts}))
+    set_job_status(job_key, RETRYING, attempts=attempts, error=error, due=due)
+    increment_metric('reward-job-retry')
+
+
+def requeue_due_rewards():
+    """moves the retries that are due back to the reward queue. returns the number of requeued jobs"""
+    requeued = 0
+    for item in app.redis.zrangebyscore(REWARD_RETRY_KEY, 0, time.time()):
+        # zrem tells concurrent callers apart - only the one that removed the item requeues it
+        if not app.redis.zrem(REWARD_RETRY_KEY, item):
+            continue
+        retry = json.loads(item.decode())
+        args = retry['args']
+        job_key = get_job_key(args['user_id'], args['task_id'], args['memo'])
+        set_job_status(job_key, QUEUED, attempts=retry['attempt'])
+        if config.DEPLOYMENT_ENV == 'test':
+            run_reward_job(args, retry['attempt'])
+        else:
+            app.rq_reward.enqueue_call(func=run_reward_job, args=(args, retry['attempt']), job_id='reward-%s-%s' % (job_key, retry['attempt']))
+        requeued = requeued + 1
+    return requeued
+
+
+def get_reward_queue_stats():
+    """returns the size of the reward queue, the pending retries and the dead-letter list"""
+    stats = {'queued': app.rq_reward.count,
+             'retrying': app.redis.zcard(REWARD_RETRY_KEY),
+             'dead_lettered': app.redis.llen(REWARD_DEAD_LETTER_KEY)}
+    for name, value in stats.items():
+        gauge_metric('reward-jobs-%s' % name, value)
+    return stats
@@ -1,9 +1,9 @@
 from kinappserver import app, config
 from kinappserver.utils import InvalidUsage, increment_metric
+from kinappserver.payment_service import get_client as get_payment_service_client
 from time import sleep
+from uuid import uuid4
 import kin
-import requests
-import random
 import json
 import logging as log
 ASSET_NAME = 'KIN'
@@ -54,7 +54,6 @@ def send_kin_with_payment_service(public_address, amount, memo=None):
         return False, None
 
     print('sending kin to address: %s' % public_address)
-    headers = {'X-REQUEST-ID': str(random.randint(1, 1000000))}  # doesn't actually matter
     payment_payload = {
         'id': memo,
         'amount': amount,
@@ -65,19 +64,20 @@ def send_kin_with_payment_service(public_address, amount, memo=None):
 
     try:
         print('posting %s/payments, payment_payload %s' % (config.PAYMENT_SERVICE_URL, payment_payload))
-        res = requests.post('%s/payments' % config.PAYMENT_SERVICE_URL, headers=headers, json=payment_payload)
-        res.raise_for_status()
+        # the payment id doubles as the idempotency key - a retried payment is rejected with a 409
+        get_payment_service_client().post('/payments', payment_payload, request_id=memo or uuid4().hex, conflict_ok=memo is not None)
+        return True
     except Exception as e:
         increment_metric('send_kin_error')
         print('caught exception sending kin to address %s using the payment service' % public_address)
         print(e)
+        return False
 
 
 def add_signature(id, sender_address, recipient_address, amount, transaction):
     """add backend signature to transaction"""
 
     print('adding whitelisted signature for transaction from %s to: %s' %(sender_address, recipient_address))
-    headers = {'X-REQUEST-ID': str(random.randint(1, 1000000))}  # doesn't actually matter
     payment_payload = {
         'id': id,
         'sender_address': sender_address,
@@ -90,12 +90,8 @@ def add_signature(id, sender_address, recipient_address, amount, transaction):
 
     try:
         print('posting %s/tx/whitelist payload: %s' % (config.PAYMENT_SERVICE_URL, payment_payload))
-        result = requests.post('%s/tx/whitelist' % config.PAYMENT_SERVICE_URL, headers=headers, json=payment_payload)
-        result.raise_for_status()
-        print('result %s ' % result.text)
-        print('result %s ' % result.content)
+        result = get_payment_service_client().post('/tx/whitelist', payment_payload, request_id=id)
         tx_json = json.loads(result.content.decode("utf-8"))
-        print('tx_json %s ' % tx_json)
         print('returning tx= %s ' % tx_json['tx'])
         return tx_json['tx']
     except Exception as e:
@@ -110,11 +106,23 @@ def extract_tx_payment_data(tx_hash):
     if tx_hash is None:
         raise InvalidUsage('invalid params')
 
+    # payments to the offer addresses are usually pre-fetched by the payment listener
+    from kinappserver.payment_listener import read_offer_payment_from_cache
+    data = read_offer_payment_from_cache(tx_hash)
+    if data:
+        increment_metric('offer-payment-prefetch-hit')
+        return True, data
+    increment_metric('offer-payment-prefetch-miss')
+
     # get the tx_hash data. this might take a second,
     # so retry while 'Resource Missing' is recevied
     count = 0
     tx_data = None
     while count < config.STELLAR_TIMEOUT_SEC:
+        # the listener might store the payment while we wait
+        data = read_offer_payment_from_cache(tx_hash) if count else None
+        if data:
+            return True, data
         try:
             tx_data = app.kin_sdk.get_transaction_data(tx_hash)
 
@@ -129,6 +137,11 @@ def extract_tx_payment_data(tx_hash):
         increment_metric('tx_data_timeout')
         return False, {}
 
+    return parse_payment(tx_data)
+
+
+def parse_payment(tx_data):
+    """returns a tuple of (True, dict with the memo, amount and to_address) if the given tx is a payment, or (False, {})"""
     # get the simple op:
     op = tx_data.operation
 
@@ -0,0 +1,100 @@
+import unittest
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, cache
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+        cache.local_cache.clear()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_cache(self):
+        """test the two-tier cache: tags, compression and recomputation"""
+        self.assertEqual(cache.get('test:a'), None)
+        self.assertTrue(cache.set('test:a', {'x': 1}, 60, tags=['user:1']))
+        self.assertEqual(cache.get('test:a', tags=['user:1']), {'x': 1})
+
+        # served from redis once the local copy is gone
+        cache.local_cache.clear()
+        self.assertEqual(cache.get('test:a', tags=['user:1']), {'x': 1})
+
+        # invalidating the tag drops both the local and the redis copies
+        cache.invalidate_tags('user:1')
+        self.assertEqual(cache.get('test:a', tags=['user:1']), None)
+
+        # large values are compressed
+        big_value = ['some long string'] * 1000
+        cache.set('test:big', big_value, 60)
+        self.assertEqual(kinappserver.app.redis.get('test:big')[:1], cache.COMPRESSED_PREFIX)
+        cache.local_cache.clear()
+        self.assertEqual(cache.get('test:big'), big_value)
+
+        # flushing redis drops the local copies too
+        cache.set('test:b', 'b', 60)
+        kinappserver.app.redis.flushdb()
+        self.assertEqual(cache.get('test:b'), None)
+
+        # plain json written before the cache was deployed is still served
+        kinappserver.app.redis.setex('memo:legacy', 60, json.dumps({'user_id': '1'}))
+        self.assertEqual(cache.get('memo:legacy', local=False), {'user_id': '1'})
+        self.assertEqual(cache.get('memo:legacy', tags=['user:1'], local=False), None)
+
+        # writing an entry keeps its tags alive. an entry whose tag expired since its version was read is dropped
+        cache.invalidate_tags('user:3')
+        kinappserver.app.redis.expire(cache.TAG_VERSION_KEY % 'user:3', 10)
+        self.assertTrue(cache.set('test:d', 'd', 60, tags=['user:3']))
+        self.assertGreater(kinappserver.app.redis.ttl(cache.TAG_VERSION_KEY % 'user:3'), 10)
+        tag_versions = cache.get_tag_versions(['user:3'])
+        kinappserver.app.redis.delete(cache.TAG_VERSION_KEY % 'user:3')
+        self.assertFalse(cache.set('test:e', 'e', 60, tags=['user:3'], tag_versions=tag_versions))
+        self.assertEqual(kinappserver.app.redis.get('test:e'), None)
+
+        # computed once, then served from the cache
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 'computed'
+
+        self.assertEqual(cache.get_or_compute('test:c', compute, 60, tags=['user:2']), 'computed')
+        self.assertEqual(cache.get_or_compute('test:c', compute, 60, tags=['user:2']), 'computed')
+        self.assertEqual(len(calls), 1)
+        cache.invalidate_tags('user:2')
+        self.assertEqual(cache.get_or_compute('test:c', compute, 60, tags=['user:2']), 'computed')
+        self.assertEqual(len(calls), 2)
+
+        # the local lru is bounded
+        lru = cache.LRU(2)
+        lru.set('a', 2e9, {}, '1')
+        lru.set('b', 2e9, {}, '2')
+        lru.get('a')
+        lru.set('c', 2e9, {}, '3')
+        self.assertEqual(lru.get('b'), None)
+        self.assertNotEqual(lru.get('a'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
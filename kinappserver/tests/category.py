@@ -5,7 +5,7 @@ import simplejson as json
 import testing.postgresql
 
 import kinappserver
-from kinappserver import db, models
+from kinappserver import db, models, cache
 
 import logging as log
 
@@ -269,11 +269,9 @@ class Tester(unittest.TestCase):
         
 
         # clear tasks cache
-        from kinappserver.utils import delete_pattern, delete_from_cache
-        from kinappserver import config
+        from kinappserver.utils import invalidate_user_cache
 
-        delete_from_cache(config.USER_CATEGORIES_CACHE_REDIS_KEY % userid)
-        delete_pattern(config.USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_PREFIX % userid)
+        invalidate_user_cache(userid)
 
         resp = self.app.get('/user/categories', headers=headers)
         print('user categories: %s ' % resp.data)
@@ -445,8 +443,7 @@ class Tester(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
 
         # verify keys in redis
-        cached_results = kinappserver.utils.read_json_from_cache(
-            kinappserver.config.USER_CATEGORIES_CACHE_REDIS_KEY % userid)
+        cached_results = cache.get('categories:%s' % userid)
         self.assertListEqual(data['categories'], [cat for cat in cached_results.values()])
 
         
@@ -0,0 +1,138 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, config, models
+from kinappserver.models import completed_task
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+        completed_task._backfilled = False
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return userid
+
+    def set_legacy_completed_tasks(self, userid, completed_tasks_dict):
+        db.engine.execute("update user_app_data set completed_tasks_dict=%s where user_id=%s", (json.dumps(completed_tasks_dict), str(userid)))
+
+    def test_completed_tasks(self):
+        """test storing, reading and backfilling completed tasks"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(models.get_completed_tasks(str(userid)), {})
+        self.assertEqual(models.count_completed_tasks(str(userid)), 0)
+
+        self.assertTrue(models.add_completed_task(str(userid), '0', '1'))
+        self.assertTrue(models.add_completed_task(str(userid), '0', '2'))
+        self.assertTrue(models.add_completed_task(str(userid), '1', '3'))
+        # adding the same task twice is a no-op
+        self.assertFalse(models.add_completed_task(str(userid), '0', '1'))
+        self.assertEqual(models.get_completed_tasks(str(userid)), {'0': {'1', '2'}, '1': {'3'}})
+        self.assertEqual(models.count_completed_tasks(str(userid)), 3)
+
+        self.assertTrue(models.remove_completed_task(str(userid), '2'))
+        self.assertFalse(models.remove_completed_task(str(userid), '2'))
+        self.assertEqual(models.get_completed_tasks(str(userid)), {'0': {'1'}, '1': {'3'}})
+
+        models.set_completed_tasks(str(userid), {'0': ['5', '6']})
+        self.assertEqual(models.get_completed_tasks(str(userid)), {'0': {'5', '6'}})
+
+        # the legacy tasks of a user without completed tasks are copied on first use, until the backfill is done
+        userid2 = self.register()
+        self.set_legacy_completed_tasks(userid2, {'0': ['9'], '1': ['10']})
+        self.assertEqual(models.count_completed_tasks(str(userid2)), 2)
+        self.assertEqual(models.get_completed_tasks(str(userid2)), {'0': {'9'}, '1': {'10'}})
+
+        # a user that was copied, or has completed tasks of its own, is never copied again
+        self.assertTrue(models.remove_completed_task(str(userid2), '10'))
+        self.assertEqual(models.get_completed_tasks(str(userid2)), {'0': {'9'}})
+        self.set_legacy_completed_tasks(userid, {'0': ['5', '7'], '1': ['8']})
+        self.assertEqual(models.get_completed_tasks(str(userid)), {'0': {'5', '6'}})
+
+        # the backfill copies the users that weren't copied yet, in batches
+        userid3 = self.register()
+        userid4 = self.register()
+        self.set_legacy_completed_tasks(userid3, {'0': ['11']})
+        self.set_legacy_completed_tasks(userid4, {'1': ['12', '13']})
+        config.COMPLETED_TASKS_BACKFILL_BATCH_SIZE = 1
+        self.assertEqual(models.backfill_completed_tasks(), 3)
+        self.assertEqual(models.get_completed_tasks(str(userid4)), {'1': {'12', '13'}})
+        # running it again changes nothing
+        self.assertEqual(models.backfill_completed_tasks(), 0)
+
+        # once backfilled, the legacy column is no longer read
+        userid5 = self.register()
+        self.set_legacy_completed_tasks(userid5, {'0': ['14']})
+        self.assertEqual(models.get_completed_tasks(str(userid5)), {})
+
+        # the users' app data reports the completed tasks from the completed_task table
+        users_app_data = {str(user_id): data for user_id, data in models.list_all_users_app_data().items()}
+        self.assertEqual(users_app_data[str(userid)]['completed_tasks'], {'0': ['5', '6']})
+        self.assertEqual(users_app_data[str(userid3)]['completed_tasks'], {'0': ['11']})
+        self.assertEqual(users_app_data[str(userid5)]['completed_tasks'], {})
+
+    def test_p2p_gate(self):
+        """test that p2p transfers are enabled after P2P_MIN_TASKS completed tasks"""
+        config.P2P_TRANSFERS_ENABLED = True
+        config.P2P_MIN_TASKS = 2
+        userid = self.register()
+        self.assertFalse(models.get_user_config(str(userid))['p2p_enabled'])
+
+        # the gate counts completed tasks - not the categories they belong to
+        models.add_completed_task(str(userid), '0', '1')
+        self.assertFalse(models.get_user_config(str(userid))['p2p_enabled'])
+        models.add_completed_task(str(userid), '0', '2')
+        self.assertTrue(models.get_user_config(str(userid))['p2p_enabled'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -101,7 +101,7 @@ class Tester(unittest.TestCase):
             kinappserver.app.redis.flushdb()
 
         def nuke_user_data_and_taks():
-            db.engine.execute("update user_app_data set completed_tasks_dict=%s;", (json.dumps({'0': [], '1': []}),))
+            db.engine.execute("""delete from completed_task;""")
             db.engine.execute("""delete from task2;""")
             db.engine.execute("""delete from truex_blacklisted_user;""")
             self.app_config.TRUEX_BLACKLISTED_TASKIDS = "[]"
@@ -178,8 +178,7 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=0, task_id=1, position=0, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=2, position=1, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=3, position=2, delay_days=1)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 0})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
 
         # test an ios client with Truex task
         # nuke_user_data_and_taks()
@@ -274,33 +273,25 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=0, task_id=0, position=0, delay_days=0)
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 0})
         add_task_to_test(task, cat_id=0, task_id=1, position=1, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 0})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
 
         add_task_to_test(task, cat_id=1, task_id=2, position=0, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 1})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 1})
 
         add_task_to_test(task, cat_id=1, task_id=3, position=1, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 2})
-        # self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 2})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 1, '1': 1})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 2})
+        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 2})
         # set limit on ios version. task should be seen in android, but not ios
         task['min_client_version_ios'] = '2.0'
         add_task_to_test(task, cat_id=1, task_id=4, position=2, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
-        # self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 2})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 1, '1': 1})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
+        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 2})
         # set limit on android version. should not be seen in ios
         task['min_client_version_android'] = '2.0'
         task['min_client_version_ios'] = '1.0' # reset version
         add_task_to_test(task, cat_id=1, task_id=5, position=3, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
-        # self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 1, '1': 1})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
+        self.assertEqual(models.count_immediate_tasks(str(userid_ios)), {'0': 2, '1': 3})
 
         # nuke tasks - lets start testing exclude-by-country
         print("### test exclude-by-country")
@@ -362,7 +353,7 @@ class Tester(unittest.TestCase):
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
 
         # mark some unrelated task. should make no difference
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['9']}),))
+        models.set_completed_tasks(str(userid), {'0': ['9']})
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
 
         print("### test delay days ------------------------------ 2")
@@ -370,15 +361,13 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=0, task_id=1, position=0, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=2, position=1, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=3, position=2, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 3, '1': 0})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 0})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 3, '1': 0})
 
         nuke_user_data_and_taks()
         add_task_to_test(task, cat_id=0, task_id=1, position=0, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=2, position=1, delay_days=0)
         add_task_to_test(task, cat_id=0, task_id=3, position=2, delay_days=1)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 0})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 0})
 
         nuke_user_data_and_taks()
         add_task_to_test(task, cat_id=0, task_id=1, position=0, delay_days=0)
@@ -402,32 +391,27 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=1, task_id=3, position=0, delay_days=0)
         add_task_to_test(task, cat_id=1, task_id=4, position=1, delay_days=0)
         add_task_to_test(task, cat_id=1, task_id=5, position=2, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 3, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0']}),))
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 3, '1': 3})
+        models.set_completed_tasks(str(userid), {'0': ['0']})
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
+        models.set_completed_tasks(str(userid), {'0': ['0', '1']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 3})
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 2})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 2})
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
             str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4', '5']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4', '5']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
@@ -444,31 +428,31 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=1, task_id=4, position=1, delay_days=1)
         add_task_to_test(task, cat_id=1, task_id=5, position=2, delay_days=1)
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
             str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
             str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
             str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
             str(userid)), {'0': 0, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4', '5']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4', '5']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
@@ -483,33 +467,28 @@ class Tester(unittest.TestCase):
         add_task_to_test(task, cat_id=1, task_id=3, position=0, delay_days=2)
         add_task_to_test(task, cat_id=1, task_id=4, position=1, delay_days=0)
         add_task_to_test(task, cat_id=1, task_id=5, position=2, delay_days=0)
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})
+        models.set_completed_tasks(str(userid), {'0': ['0']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # 2 + 1
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # 2 + 1
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # 2 + 1
+        models.set_completed_tasks(str(userid), {'0': ['0', '1']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # 1 + 1
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # 1 + 1
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # 1 + 1
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 3})  # 0 + 1
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})  # 0 + 1
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 3})  # 0 + 1
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 2})  # 0 + 2
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})  # 0 + 2
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 2})  # 0 + 2
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 1})  # 0 + 1
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['0', '1', '2'], '1': ['3', '4', '5']}),))
+        models.set_completed_tasks(str(userid), {'0': ['0', '1', '2'], '1': ['3', '4', '5']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(
@@ -533,29 +512,24 @@ class Tester(unittest.TestCase):
         # 2 already-inactive ad-hoc tasks
         add_task_to_test(task, cat_id=0, task_id=10, position=-1, delay_days=0, task_start_date=str(now.shift(hours=-10)), task_expiration_date=str(now.shift(hours=-9)))
         add_task_to_test(task, cat_id=1, task_id=11, position=-1, delay_days=0, task_start_date=str(now.shift(hours=-10)), task_expiration_date=str(now.shift(hours=-9)))
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 4})  # [6],[7,3,4,5]
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # [6],[7,3,4,5]
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['6']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 4})  # [6],[7,3,4,5]
+        models.set_completed_tasks(str(userid), {'0': ['6']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 4})  # [6],[7,3,4,5]
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # [6],[7,3,4,5]
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['6'], '1': ['7']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 4})  # [0,1],[7,3,4,5]
+        models.set_completed_tasks(str(userid), {'0': ['6'], '1': ['7']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})  # [0],[3]
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # [0],[3]
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['6', '0'], '1': ['7']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 2, '1': 3})  # [0],[3]
+        models.set_completed_tasks(str(userid), {'0': ['6', '0'], '1': ['7']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # [1],[3]
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # [1],[3]
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['6', '0'], '1': ['7', '3']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 3})  # [1],[3]
+        models.set_completed_tasks(str(userid), {'0': ['6', '0'], '1': ['7', '3']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
-        # self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 2})  # [1,2],[4,5]
-        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 1})  # [1,2],[4,5]
-        db.engine.execute("update user_app_data set completed_tasks_dict=%s", (json.dumps({'0': ['6', '0', '1', '2', '3'], '1': ['7', '3', '4', '5']}),))
+        self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 1, '1': 2})  # [1,2],[4,5]
+        models.set_completed_tasks(str(userid), {'0': ['6', '0', '1', '2', '3'], '1': ['7', '3', '4', '5']})
         # tasks were manipulated - clear redis
         kinappserver.app.redis.flushdb()
         self.assertEqual(models.count_immediate_tasks(str(userid)), {'0': 0, '1': 0})  # [], []
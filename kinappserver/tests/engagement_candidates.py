@@ -0,0 +1,138 @@
+import simplejson as json
+import unittest
+from uuid import uuid4
+from datetime import datetime, timedelta
+
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+USER_ID_HEADER = "X-USERID"
+
+
+class Tester(unittest.TestCase):
+    """tests the skip reasons of the engagement push candidates"""
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+        self.blocked_country_codes = kinappserver.app.blocked_country_codes
+        kinappserver.app.blocked_country_codes = ['XX']
+
+    def tearDown(self):
+        kinappserver.app.blocked_country_codes = self.blocked_country_codes
+        self.postgresql.stop()
+
+    def add_user(self, os_type='android', app_ver='1.4.1', days_inactive=2, phone_num=None):
+        user_id = uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(user_id),
+                            'os': os_type,
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '+02:00',
+                            'token': 'AAAAA',
+                            'app_ver': '1.4.1'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        if phone_num is not None:
+            db.engine.execute("""update public.push_auth_token set auth_token='%s' where user_id='%s';""" % (str(user_id), str(user_id)))
+            resp = self.app.post('/user/auth/ack',
+                                 data=json.dumps({
+                                     'token': str(user_id)}),
+                                 headers={USER_ID_HEADER: str(user_id)},
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+            resp = self.app.post('/user/firebase/update-id-token',
+                                 data=json.dumps({
+                                     'token': 'fake-token',
+                                     'phone_number': phone_num}),
+                                 headers={USER_ID_HEADER: str(user_id)},
+                                 content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+
+        db.engine.execute("update public.user_app_data set app_ver=%s, update_at=%s where user_id=%s;",
+                          (app_ver, datetime.utcnow() + timedelta(days=-days_inactive), str(user_id)))
+        return str(user_id)
+
+    def get_skip_reasons(self, scheme):
+        params = models.get_engagement_candidates_params(scheme, datetime.utcnow())
+        results = db.engine.execute('select user_id, skip_reason from (%s) candidates;' % models.ENGAGEMENT_CANDIDATES_SQL, params)
+        return {str(user_id): skip_reason for user_id, skip_reason in results.fetchall()}
+
+    def test_skip_reasons(self):
+        """test that every pushable user gets the right skip reason"""
+        expected_recent = {}
+        expected_old = {}
+
+        # versions at or below the floors, and versions that cant be parsed
+        for os_type, app_ver in (('android', '1.4.0'), ('android', '1.3.9'), ('iOS', '1.2.1'), ('android', None),
+                                 ('android', ''), ('iOS', 'beta'), ('android', 'v1.5.0')):
+            user_id = self.add_user(os_type, app_ver)
+            expected_recent[user_id] = expected_old[user_id] = 'old_version'
+
+        # a version with a suffix is compared by its numeric prefix
+        for os_type, app_ver in (('android', '1.4.1'), ('android', '1.10'), ('iOS', '1.2.2'), ('android', '1.5.0-beta')):
+            user_id = self.add_user(os_type, app_ver)
+            expected_recent[user_id] = None
+            expected_old[user_id] = None
+
+        user_id = self.add_user(phone_num='+972528802130')
+        self.assertTrue(models.blacklist_phone_number('+972528802130'))
+        expected_recent[user_id] = expected_old[user_id] = 'blacklist'
+
+        # the version is checked before the blacklist
+        user_id = self.add_user(app_ver='1.0', phone_num='+972528802131')
+        self.assertTrue(models.blacklist_phone_number('+972528802131'))
+        expected_recent[user_id] = expected_old[user_id] = 'old_version'
+
+        user_id = self.add_user()
+        db.engine.execute("update public.user_app_data set country_iso_code='XX' where user_id=%s;", (user_id,))
+        expected_recent[user_id] = expected_old[user_id] = 'country'
+
+        user_id = self.add_user(days_inactive=0)
+        expected_recent[user_id] = expected_old[user_id] = 'active_today'
+
+        for days_inactive, reason in ((4, None), (5, 'not_active_recently'), (7, None), (8, 'not_active_recently')):
+            user_id = self.add_user(days_inactive=days_inactive)
+            expected_recent[user_id] = reason
+            expected_old[user_id] = None
+
+        for days_inactive, reason in ((13, None), (14, 'active_in_last_two_weeks'), (30, 'active_in_last_two_weeks')):
+            user_id = self.add_user(days_inactive=days_inactive)
+            expected_recent[user_id] = 'not_active_recently'
+            expected_old[user_id] = reason
+
+        # deactivated users and users without a push token aren't candidates at all
+        user_id = self.add_user()
+        models.deactivate_user(user_id)
+        user_id = self.add_user()
+        db.engine.execute("update public.user set push_token='' where user_id=%s;", (user_id,))
+
+        self.assertEqual(self.get_skip_reasons('engage-recent'), expected_recent)
+        self.assertEqual(self.get_skip_reasons('engage-old'), expected_old)
+
+        # there are no tasks, so the remaining candidates are skipped too
+        tokens = models.get_users_for_engagement_push('engage-recent')
+        self.assertEqual(len(tokens['iOS']) + len(tokens['android']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import simplejson as json
+import time
+import unittest
+from uuid import uuid4
+
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, config, engagement
+from kinappserver.utils import OS_ANDROID, OS_IOS
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+    """tests the rate-controlled dispatch of engagement pushes"""
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def add_user(self, os_type, push_token='fake_token'):
+        user_id = uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(user_id),
+                            'os': os_type,
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '+02:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.4.1'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.engine.execute("update public.user set push_token=%s where user_id=%s;", (push_token, str(user_id)))
+        return user_id
+
+    def test_token_bucket(self):
+        """test the refill and wait math of the token bucket"""
+        bucket = engagement.TokenBucket('test-bucket', 10, 20)
+
+        # the bucket starts full
+        self.assertEqual(bucket.try_acquire(20, now=1000), 0)
+        self.assertAlmostEqual(bucket.try_acquire(5, now=1000), 0.5)
+        # a failed attempt takes nothing
+        self.assertAlmostEqual(bucket.try_acquire(5, now=1000.25), 0.25)
+        # refilled at 10 tokens per second
+        self.assertEqual(bucket.try_acquire(5, now=1000.5), 0)
+        self.assertAlmostEqual(bucket.try_acquire(1, now=1000.5), 0.1)
+        # requests above the capacity are capped to it
+        self.assertAlmostEqual(bucket.try_acquire(100, now=1000.5), 2)
+        # the refill is capped at the capacity
+        self.assertEqual(bucket.try_acquire(20, now=2000), 0)
+        self.assertAlmostEqual(bucket.try_acquire(1, now=2000), 0.1)
+        # the clock going back doesn't take tokens
+        self.assertAlmostEqual(bucket.try_acquire(1, now=1999), 0.1)
+
+        # the capacity is at least a second's worth of tokens
+        self.assertEqual(engagement.TokenBucket('test-bucket2', 10, 2).capacity, 10)
+
+        # acquire waits for the bucket to refill
+        bucket = engagement.TokenBucket('test-bucket3', 100, 100)
+        self.assertEqual(bucket.acquire(100), 0)
+        start = time.time()
+        waited = bucket.acquire(50)
+        self.assertTrue(0 < waited <= 0.6)
+        self.assertTrue(time.time() - start >= waited)
+
+    def test_dispatch(self):
+        """test splitting a campaign into chunks and counting its results"""
+        config.ENGAGEMENT_PUSH_JOB_CHUNK_SIZE = 2
+        config.ENGAGEMENT_PUSH_BATCH_SIZE = 2
+        user_ids = {OS_IOS: [self.add_user(OS_IOS), self.add_user(OS_IOS)],
+                    OS_ANDROID: [self.add_user(OS_ANDROID), self.add_user(OS_ANDROID), self.add_user(OS_ANDROID, push_token=''), uuid4()]}
+
+        for dry_run in (True, False):
+            campaign_id = engagement.dispatch_engagement_push('engage-recent', user_ids, dry_run)
+            progress = engagement.get_progress(campaign_id)
+            self.assertEqual(progress['scheme'], 'engage-recent')
+            self.assertEqual(progress['dry_run'], dry_run)
+            self.assertEqual(progress['total'], 6)
+            self.assertEqual(progress['chunks'], 3)
+            self.assertEqual(progress['chunks_done'], 3)
+            # the user without a token and the unknown user aren't sent to
+            self.assertEqual(progress['sent'], 4)
+            self.assertEqual(progress['no_token'], 2)
+            self.assertEqual(progress['failed'], 0)
+            self.assertEqual(progress['done'], 6)
+            self.assertEqual(progress['eta_secs'], 0)
+
+        # a dry run doesn't take tokens from the bucket
+        kinappserver.app.redis.delete(config.ENGAGEMENT_PUSH_TOKEN_BUCKET_REDIS_KEY)
+        engagement.dispatch_engagement_push('engage-recent', user_ids, True)
+        self.assertFalse(kinappserver.app.redis.exists(config.ENGAGEMENT_PUSH_TOKEN_BUCKET_REDIS_KEY))
+
+        # the campaign id can be given
+        self.assertEqual(engagement.dispatch_engagement_push('engage-old', {OS_IOS: [], OS_ANDROID: []}, True, 'campaign1'), 'campaign1')
+        progress = engagement.get_progress('campaign1')
+        self.assertEqual((progress['total'], progress['chunks'], progress['eta_secs']), (0, 0, 0))
+
+    def test_progress(self):
+        """test the counters and the eta of a campaign in progress"""
+        self.assertIsNone(engagement.get_progress('no-such-campaign'))
+
+        key = engagement.CAMPAIGN_PROGRESS_KEY % 'campaign1'
+        kinappserver.app.redis.hmset(key, {'scheme': 'engage-old', 'dry_run': 0, 'total': 100, 'chunks': 4,
+                                           'started_at': time.time() - 10, 'sent': 0, 'no_token': 0, 'failed': 0, 'chunks_done': 0})
+        progress = engagement.get_progress('campaign1')
+        self.assertEqual(progress['done'], 0)
+        self.assertIsNone(progress['eta_secs'])
+
+        engagement.report_progress('campaign1', 20, 3, 2)
+        progress = engagement.get_progress('campaign1')
+        self.assertEqual((progress['sent'], progress['no_token'], progress['failed']), (20, 3, 2))
+        self.assertEqual(progress['chunks_done'], 1)
+        self.assertEqual(progress['done'], 25)
+        # 25 users in 10 secs - 75 users to go
+        self.assertTrue(29 <= progress['eta_secs'] <= 31)
+
+        for i in range(3):
+            engagement.report_progress('campaign1', 25, 0, 0)
+        progress = engagement.get_progress('campaign1')
+        self.assertEqual(progress['chunks_done'], 4)
+        self.assertEqual(progress['done'], 100)
+        self.assertEqual(progress['eta_secs'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import threading
+import time
+import unittest
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, config, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+GOODS_COUNT = 1200
+
+
+class Tester(unittest.TestCase):
+    """books goods of a single offer with many concurrent bookers. run with: make loadtest"""
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql(postgres_args='-h 127.0.0.1 -F -c logging_collector=off -c max_connections=600')
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+        offer = {'id': '0',
+                 'type': 'gift-card',
+                 'type_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'domain': 'music',
+                 'title': 'offer_title',
+                 'desc': 'offer_desc',
+                 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'price': 100,
+                 'address': 'the address',
+                 'skip_image_test': True,
+                 'provider':
+                     {'name': 'om-nom-nom-food', 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'},
+                 }
+        resp = self.app.post('/offer/add', data=json.dumps({'offer': offer}), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        db.engine.execute('''insert into good (offer_id, good_type, value, created_at)
+                             select '0', 'code', to_json('code' || i), now() from generate_series(1, %s) i;''', (GOODS_COUNT,))
+
+    def tearDown(self):
+        config.GOODS_PRESTAGING_ENABLED = False
+        self.postgresql.stop()
+
+    def book(self, bookers, prefix):
+        """books a good with each of the given number of concurrent bookers. returns (the allocated sids, bookings per second)"""
+        sids = []
+        sids_lock = threading.Lock()
+        barrier = threading.Barrier(bookers)
+
+        def booker(i):
+            with kinappserver.app.app_context():
+                barrier.wait()
+                sid = models.allocate_good('0', '%s-%s' % (prefix, i))
+                with sids_lock:
+                    sids.append(sid)
+                db.session.remove()
+
+        threads = [threading.Thread(target=booker, args=(i,)) for i in range(bookers)]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        for thread in threads:
+            thread.join()
+        throughput = bookers / (time.time() - start)
+        print('%s concurrent bookers (%s): %.1f bookings/sec' % (bookers, prefix, throughput))
+        return sids, throughput
+
+    def check_bookings(self):
+        small_sids, small_throughput = self.book(50, 'small')
+        large_sids, large_throughput = self.book(500, 'large')
+
+        # every booker got a good of its own
+        sids = small_sids + large_sids
+        self.assertNotIn(None, sids)
+        self.assertEqual(len(set(sids)), len(sids))
+        self.assertEqual(models.count_goods_by_offer(['0'])['0']['allocated'], 550)
+
+        # the bookers don't queue on each other: ten times the bookers doesn't slow the booking down
+        self.assertGreater(large_throughput, small_throughput / 2)
+
+    def test_skip_locked_allocation(self):
+        """test allocating goods with the db search under flash demand"""
+        self.check_bookings()
+
+    def test_staged_allocation(self):
+        """test allocating pre-staged goods under flash demand"""
+        config.GOODS_PRESTAGING_ENABLED = True
+        self.assertEqual(models.restage_free_goods(), (GOODS_COUNT, 0))
+        self.check_bookings()
+
+        # nothing was stranded: the staged list holds exactly the free goods
+        self.assertEqual(models.restage_free_goods(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
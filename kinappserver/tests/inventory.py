@@ -0,0 +1,74 @@
+import unittest
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, inventory, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_inventory_counters(self):
+        """test that the inventory counters follow the goods, and that drifted counters are reconciled"""
+        offer = {'id': '0',
+                 'type': 'gift-card',
+                 'type_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'domain': 'music',
+                 'title': 'offer_title',
+                 'desc': 'offer_desc',
+                 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'price': 100,
+                 'address': 'the address',
+                 'skip_image_test': True,
+                 'provider':
+                     {'name': 'om-nom-nom-food', 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'},
+                 }
+        resp = self.app.post('/offer/add', data=json.dumps({'offer': offer}), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # the counters are loaded from the db on first read
+        self.assertEqual(inventory.get_inventory(['0']), {'0': {'available': 0, 'allocated': 0, 'redeemed': 0}})
+        for code in ('code1', 'code2', 'code3'):
+            self.assertTrue(models.create_good('0', 'code', code))
+
+        self.assertIsNotNone(models.allocate_good('0', 'order1'))
+        self.assertIsNotNone(models.allocate_good('0', 'order2'))
+        self.assertTrue(models.release_good('order2'))
+        self.assertEqual(inventory.get_inventory(['0']), {'0': {'available': 2, 'allocated': 1, 'redeemed': 0}})
+        self.assertEqual(inventory.get_inventory(['0']), {'0': models.count_goods_by_offer(['0'])['0']})
+
+        # drifted counters are overwritten with the db counts
+        kinappserver.app.redis.hset(inventory.INVENTORY_KEY % '0', 'available', 10)
+        self.assertEqual(inventory.reconcile_inventory(), {'0': {'available': 2, 'allocated': 1, 'redeemed': 0}})
+        self.assertEqual(inventory.reconcile_inventory(), {})
+        self.assertTrue(models.goods_avilable('0'))
+
+        resp = self.app.get('/good/inventory')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['inventory'], {'0': {'total': 3, 'unallocated': 2}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return userid
+
+    def test_offer_purchases(self):
+        """test that purchases lock their offers for a while, and that they are backfilled from the txs"""
+        userid = self.register()
+        self.assertTrue(models.record_offer_purchase(userid, '1', 'hash1'))
+        self.assertFalse(models.record_offer_purchase(userid, '1', 'hash1'))
+        self.assertEqual(models.get_locked_offers(userid, 30), {'1'})
+
+        # purchases older than the time range don't lock their offer
+        db.engine.execute('''update offer_purchase set purchased_at = now() - interval '31 days' where tx_hash='hash1';''')
+        self.assertEqual(models.get_locked_offers(userid, 30), set())
+
+        # purchases made before the table existed are recorded from the incoming txs
+        models.create_tx('hash2', userid, 'GOFFER', True, 0, {'offer_id': '2', 'order_id': 'order2'})
+        models.create_tx('hash3', userid, 'GADDRESS', False, 10, {'task_id': '1', 'memo': 'memo3'})
+        self.assertEqual(models.backfill_offer_purchases(30), 1)
+        self.assertEqual(models.get_locked_offers(userid, 30), {'2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,7 @@ from time import sleep
 import testing.postgresql
 
 import kinappserver
-from kinappserver import db, models, utils
+from kinappserver import db, models
 from kinappserver.config import SERVERSIDE_CLIENT_VALIDATION_ENABLED
 from kinit_client_validation_module.config import MOCK_B64_NONCE, MOCK_B64_TOKEN, NONCE_REDIS_KEY
 
@@ -147,7 +147,7 @@ class Tester(unittest.TestCase):
         self.assertEqual(resp.status_code, 200)
 
         # store a mocked token
-        utils.write_json_to_cache(NONCE_REDIS_KEY % str(userid),MOCK_B64_NONCE)
+        kinappserver.app.redis.setex(NONCE_REDIS_KEY % str(userid), 30*60, json.dumps(MOCK_B64_NONCE))
         
         # create the first order (books item 1) - no funds - should fail
         resp = self.app.post('/offer/book',
@@ -163,7 +163,7 @@ class Tester(unittest.TestCase):
         create_tx("AAA", userid, "someaddress", False, 100, {'task_id': 1, 'memo': 'AAA'})
 
         # store a mocked token
-        utils.write_json_to_cache(NONCE_REDIS_KEY % str(userid),MOCK_B64_NONCE)
+        kinappserver.app.redis.setex(NONCE_REDIS_KEY % str(userid), 30*60, json.dumps(MOCK_B64_NONCE))
 
         # create the first order (books item 1)
         resp = self.app.post('/offer/book',
@@ -181,7 +181,7 @@ class Tester(unittest.TestCase):
 
 
          # store a mocked token
-        utils.write_json_to_cache(NONCE_REDIS_KEY % str(userid),MOCK_B64_NONCE)
+        kinappserver.app.redis.setex(NONCE_REDIS_KEY % str(userid), 30*60, json.dumps(MOCK_B64_NONCE))
 
         # create another order for the same offer (books item 2)
         resp = self.app.post('/offer/book',
@@ -197,7 +197,7 @@ class Tester(unittest.TestCase):
         print('order_id: %s' % orderid2)
 
          # store a mocked token
-        utils.write_json_to_cache(NONCE_REDIS_KEY % str(userid),MOCK_B64_NONCE)
+        kinappserver.app.redis.setex(NONCE_REDIS_KEY % str(userid), 30*60, json.dumps(MOCK_B64_NONCE))
         
 
         # should fail as there are already 2 active orders
@@ -227,7 +227,7 @@ class Tester(unittest.TestCase):
             self.assertEqual(resp.status_code, 200)
 
          # store a mocked token
-        utils.write_json_to_cache(NONCE_REDIS_KEY % str(userid),MOCK_B64_NONCE)
+        kinappserver.app.redis.setex(NONCE_REDIS_KEY % str(userid), 30*60, json.dumps(MOCK_B64_NONCE))
         
         # should succeed now
         resp = self.app.post('/offer/book',
@@ -0,0 +1,119 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, models, utils
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+def payment_callback(memo, tx_hash, amount):
+    return {'action': 'send', 'object': 'payment', 'state': 'success', 'timestamp': '2018-11-01T10:00:00',
+            'value': {'id': memo, 'transaction_id': tx_hash, 'amount': amount, 'sender_address': 'GSENDER'}}
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_payment_callbacks(self):
+        """test processing payment service callbacks in a batch and one by one"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        for memo, task_id in (('memo1', '1'), ('memo2', '2'), ('memo3', '3')):
+            utils.write_payment_data_to_cache(memo, str(userid), task_id, 1541066400, True)
+
+        resp = self.app.post('/payments/callback/batch',
+                             data=json.dumps([payment_callback('memo1', 'hash1', 10),
+                                              payment_callback('memo2', 'hash2', 20),
+                                              payment_callback('no-such-memo', 'hash4', 5),
+                                              {'action': 'send'}]),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['results'], ['ok', 'ok', 'error', 'error'])
+
+        txs = {tx.tx_hash: tx for tx in models.list_user_transactions(str(userid))}
+        self.assertEqual(set(txs.keys()), {'hash1', 'hash2'})
+        self.assertEqual(txs['hash2'].amount, 20)
+        self.assertEqual(txs['hash2'].tx_info, {'task_id': '2', 'memo': 'memo2'})
+
+        # the single callback is a wrapper over the batch. repeated callbacks are ignored
+        for callback in (payment_callback('memo3', 'hash3', 30), payment_callback('memo1', 'hash1', 10)):
+            resp = self.app.post('/payments/callback', data=json.dumps(callback), headers={}, content_type='application/json')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data)['status'], 'ok')
+        self.assertEqual(len(models.list_user_transactions(str(userid))), 3)
+
+        # a bad callback doesn't drop the others in its batch
+        utils.write_payment_data_to_cache('memo5', str(userid), '5', 1541066400, True)
+        utils.write_payment_data_to_cache('memo6', str(uuid.uuid4()), '6', 1541066400, True)  # no such user
+        utils.write_payment_data_to_cache('memo7', str(userid), '7', 1541066400, True)
+        no_sender = payment_callback('memo7', 'hash7', 70)
+        del no_sender['value']['sender_address']
+        resp = self.app.post('/payments/callback/batch',
+                             data=json.dumps([payment_callback('memo5', 'hash5', 50), payment_callback('memo6', 'hash6', 60), no_sender]),
+                             headers={},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['results'], ['ok', 'error', 'error'])
+        txs = {tx.tx_hash for tx in models.list_user_transactions(str(userid))}
+        self.assertEqual(txs, {'hash1', 'hash2', 'hash3', 'hash5'})
+
+    def test_failed_payment_callback(self):
+        """test that a failed payment is given up on once it used up its attempts"""
+        from kinappserver import config
+        userid = str(uuid.uuid4())
+        models.record_task_payment('memo1', userid, '1', 'GADDRESS', 10, False)
+        self.assertTrue(models.has_task_payment(userid, '1'))
+        self.assertFalse(models.has_task_payment(userid, '2'))
+
+        config.RECONCILE_MAX_ATTEMPTS = 0
+        failed = {'action': 'send', 'object': 'payment', 'state': 'fail', 'timestamp': '2018-11-01T10:00:00',
+                  'value': {'id': 'memo1', 'reason': 'timeout'}}
+        resp = self.app.post('/payments/callback', data=json.dumps(failed), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(models.get_task_payment('memo1').abandoned)
+        # an abandoned payment doesn't block a manual compensation
+        self.assertFalse(models.has_task_payment(userid, '1'))
+
+        # failed payments that aren't task payments are ignored
+        failed['value']['id'] = 'no-such-memo'
+        resp = self.app.post('/payments/callback', data=json.dumps(failed), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
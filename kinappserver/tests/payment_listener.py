@@ -0,0 +1,135 @@
+import threading
+import unittest
+from collections import namedtuple
+from decimal import Decimal
+
+import simplejson as json
+import testing.postgresql
+from kin.transactions import OperationTypes
+
+
+import kinappserver
+from kinappserver import db, config, payment_listener, stellar
+from kinappserver.utils import InternalError
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+TxData = namedtuple('TxData', ['hash', 'memo', 'operation'])
+Operation = namedtuple('Operation', ['type', 'amount', 'destination'])
+
+
+def payment(tx_hash, memo, amount, destination, op_type=OperationTypes.PAYMENT):
+    return TxData(tx_hash, memo, Operation(op_type, Decimal(amount), destination))
+
+
+class FakeMonitor(object):
+    def __init__(self):
+        self.stopped = False
+        self.thread = None
+
+    def stop(self):
+        self.stopped = True
+
+
+class FakeKinClient(object):
+    """calls back with the given payments as soon as the addresses are monitored, like the sdk's monitor thread would"""
+    def __init__(self, payments):
+        self.payments = payments
+        self.monitor = FakeMonitor()
+        self.monitored_addresses = None
+
+    def monitor_accounts_payments(self, addresses, callback_fn):
+        self.monitored_addresses = addresses
+        for address, tx_data in self.payments:
+            callback_fn(address, tx_data, self.monitor)
+        return self.monitor
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_payment_listener(self):
+        """test that payments to the offer addresses are pre-fetched from a stubbed stream"""
+        offer = {'id': '0',
+                 'type': 'gift-card',
+                 'type_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'domain': 'music',
+                 'title': 'offer_title',
+                 'desc': 'offer_desc',
+                 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'price': 100,
+                 'address': 'GOFFERADDRESS',
+                 'skip_image_test': True,
+                 'provider':
+                     {'name': 'om-nom-nom-food', 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'},
+                 }
+        resp = self.app.post('/offer/add', data=json.dumps({'offer': offer}), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        streamed_addresses = []
+
+        def stub_stream(addresses):
+            streamed_addresses.append(addresses)
+            return [('GOFFERADDRESS', payment('hash1', '1-kit-order1', '100', 'GOFFERADDRESS')),
+                    ('GOFFERADDRESS', payment('hash2', '1-kit-order2', '100', 'GSOMEONEELSE')),
+                    ('GOFFERADDRESS', payment('hash3', '1-kit-order3', '100', 'GOFFERADDRESS', op_type=OperationTypes.CREATE_ACCOUNT))]
+
+        self.assertEqual(payment_listener.listen(stub_stream), 1)
+        self.assertEqual(streamed_addresses, [{'GOFFERADDRESS'}])
+
+        # the pre-fetched payment is used without asking horizon
+        res, data = stellar.extract_tx_payment_data('hash1')
+        self.assertTrue(res)
+        self.assertEqual(data, {'memo': '1-kit-order1', 'amount': 100, 'to_address': 'GOFFERADDRESS'})
+        self.assertIsNone(payment_listener.read_offer_payment_from_cache('hash2'))
+        self.assertIsNone(payment_listener.read_offer_payment_from_cache('hash3'))
+
+    def test_horizon_payment_stream(self):
+        """test that the sdk monitor's callbacks are streamed to the listener"""
+        config.PAYMENT_LISTENER_REFRESH_SECS = 0
+        kin_client = FakeKinClient([('GOFFERADDRESS', payment('hash1', '1-kit-order1', '100', 'GOFFERADDRESS'))])
+        stream = payment_listener.horizon_payment_stream({'GOFFERADDRESS'}, kin_client)
+
+        address, tx_data = next(stream)
+        self.assertEqual(kin_client.monitored_addresses, {'GOFFERADDRESS'})
+        self.assertEqual(address, 'GOFFERADDRESS')
+        self.assertTrue(payment_listener.handle_payment({'GOFFERADDRESS'}, tx_data))
+        self.assertEqual(payment_listener.read_offer_payment_from_cache('hash1'), {'memo': '1-kit-order1', 'amount': 100, 'to_address': 'GOFFERADDRESS'})
+
+        # no more payments - the stream keeps yielding, so the listener can check for new addresses
+        self.assertEqual(next(stream), (None, None))
+
+        # closing the stream stops the monitor
+        stream.close()
+        self.assertTrue(kin_client.monitor.stopped)
+
+        # a stream whose monitor died fails, so the listener re-opens it
+        kin_client = FakeKinClient([])
+        kin_client.monitor.thread = threading.Thread(target=lambda: None)
+        kin_client.monitor.thread.start()
+        kin_client.monitor.thread.join()
+        stream = payment_listener.horizon_payment_stream({'GOFFERADDRESS'}, kin_client)
+        with self.assertRaises(InternalError):
+            next(stream)
+        self.assertTrue(kin_client.monitor.stopped)
+
+
+if __name__ == '__main__':
+    unittest.main()
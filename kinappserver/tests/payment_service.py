@@ -0,0 +1,92 @@
+import unittest
+
+import requests
+
+import kinappserver
+from kinappserver import config
+from kinappserver.payment_service import PaymentServiceClient, PaymentServiceError, PaymentServiceUnavailable, CircuitBreaker, OPEN, CLOSED
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('status code %s' % self.status_code)
+
+
+class FakeSession(object):
+    """replays the given status codes (or exceptions), recording the request ids it was called with"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.request_ids = []
+
+    def post(self, url, headers, json, timeout):
+        self.request_ids.append(headers['X-REQUEST-ID'])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return FakeResponse(response)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        config.PAYMENT_SERVICE_RETRIES = 2
+        config.PAYMENT_SERVICE_RETRY_BACKOFF_SECS = 0
+        config.PAYMENT_SERVICE_BREAKER_MAX_FAILURES = 3
+        config.PAYMENT_SERVICE_BREAKER_RESET_SECS = 60
+
+    def test_retries(self):
+        """test that failed calls are retried with the same request id"""
+        session = FakeSession([requests.ConnectionError('boom'), 503, 200])
+        client = PaymentServiceClient('http://payments', session)
+        self.assertEqual(client.post('/payments', {}, 'memo1').status_code, 200)
+        self.assertEqual(session.request_ids, ['memo1'] * 3)
+
+        # a 409 means an earlier attempt already got through
+        session = FakeSession([requests.Timeout('slow'), 409])
+        client = PaymentServiceClient('http://payments', session)
+        self.assertEqual(client.post('/payments', {}, 'memo2', conflict_ok=True).status_code, 409)
+
+        # 4xx responses arent retried
+        session = FakeSession([400])
+        client = PaymentServiceClient('http://payments', session)
+        with self.assertRaises(PaymentServiceError):
+            client.post('/tx/whitelist', {}, 'id1')
+        self.assertEqual(len(session.request_ids), 1)
+
+    def test_circuit_breaker(self):
+        """test that the breaker opens after repeated failures and fails fast"""
+        session = FakeSession([500, 500, 500, 200])
+        client = PaymentServiceClient('http://payments', session)
+        with self.assertRaises(PaymentServiceError):
+            client.post('/payments', {}, 'memo1')
+        self.assertEqual(client.breaker.state, OPEN)
+        with self.assertRaises(PaymentServiceUnavailable):
+            client.post('/payments', {}, 'memo2')
+        self.assertEqual(len(session.request_ids), 3)
+
+        # after the reset period, a successful trial call closes it again
+        client.breaker.opened_at = 0
+        self.assertEqual(client.post('/payments', {}, 'memo3').status_code, 200)
+        self.assertEqual(client.breaker.state, CLOSED)
+
+        breaker = CircuitBreaker(1, 60)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, push_outbox
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_push_outbox(self):
+        """test queueing push intents and draining the redis backlog"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertFalse(push_outbox.enqueue_push('no-such-kind', str(userid)))
+
+        sent = push_outbox.stats['sent']
+        self.assertTrue(push_outbox.enqueue_push('tx_completed', str(userid), tx_hash='hash', amount=10, task_id='1', memo='memo'))
+        self.assertEqual(push_outbox.stats['sent'], sent + 1)
+
+        # intents left in redis by a dead worker are delivered by the drain endpoint
+        push_outbox.spill([{'kind': 'country_not_supported', 'user_id': str(userid), 'args': {}, 'attempts': 0, 'ts': 0}] * 3)
+        dropped = push_outbox.stats['dropped']
+        push_outbox.spill([{'kind': 'country_not_supported', 'user_id': str(uuid.uuid4()), 'args': {}, 'attempts': 0, 'ts': 0}])
+
+        resp = self.app.get('/push/outbox')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)['outbox']['backlog'], 4)
+
+        resp = self.app.post('/push/outbox/drain', data=json.dumps({'limit': 10}), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['drained'], 4)
+        self.assertEqual(data['outbox']['backlog'], 0)
+        self.assertEqual(push_outbox.stats['sent'], sent + 4)
+        # the unknown user has no push token
+        self.assertEqual(push_outbox.stats['dropped'], dropped + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, config, models, reconcile, rewards
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+        config.RECONCILE_GRACE_SECS = -60  # consider the payments made in this test
+        config.RECONCILE_RETRY_INTERVAL_SECS = 0
+        config.RECONCILE_MAX_ATTEMPTS = 1
+
+        # don't actually pay - just record the re-submitted memos
+        self.resubmitted = []
+        self.resubmit_task_reward = rewards.resubmit_task_reward
+        rewards.resubmit_task_reward = lambda public_address, task_id, send_push, user_id, memo, amount: self.resubmitted.append(memo)
+
+    def tearDown(self):
+        rewards.resubmit_task_reward = self.resubmit_task_reward
+        self.postgresql.stop()
+
+    def test_reconcile_payments(self):
+        """test that unpaid task payments are re-submitted and then abandoned"""
+        userid = uuid.uuid4()
+        address = 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ'
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        self.assertTrue(models.record_task_payment('memo1', userid, '1', address, 10, True))
+        self.assertTrue(models.record_task_payment('memo2', userid, '2', address, 20, True))
+        self.assertFalse(models.record_task_payment('memo2', userid, '2', address, 20, True))
+        models.create_tx('hash1', userid, address, False, 10, {'task_id': '1', 'memo': 'memo1'})
+
+        # memo1 is paid, memo2 is re-submitted
+        summary = reconcile.reconcile_payments()
+        self.assertEqual(summary['scanned'], 2)
+        self.assertEqual(summary['paid'], 1)
+        self.assertEqual(summary['resubmitted'], 1)
+        self.assertEqual(self.resubmitted, ['memo2'])
+
+        # the watermark was kept at memo2, which is now out of attempts
+        summary = reconcile.reconcile_payments()
+        self.assertEqual(summary['scanned'], 1)
+        self.assertEqual(summary['abandoned'], 1)
+        self.assertEqual(self.resubmitted, ['memo2'])
+
+        summary = reconcile.reconcile_payments()
+        self.assertEqual(summary['backlog'], 0)
+        self.assertEqual(summary['resubmitted'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, config, inventory, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def add_order(self, order_id, userid, age_secs):
+        db.engine.execute('''insert into "order" (order_id, offer_id, user_id, kin_amount, address, created_at)
+                             values (%s, '0', %s, 100, 'the address', (now() at time zone 'utc') - %s * interval '1 second');''',
+                          (order_id, str(userid), age_secs))
+
+    def test_release_unclaimed_goods(self):
+        """test that expired orders and orphaned goods are released, and paid goods are left alone"""
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        offer = {'id': '0',
+                 'type': 'gift-card',
+                 'type_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'domain': 'music',
+                 'title': 'offer_title',
+                 'desc': 'offer_desc',
+                 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                 'price': 100,
+                 'address': 'the address',
+                 'skip_image_test': True,
+                 'provider':
+                     {'name': 'om-nom-nom-food', 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'},
+                 }
+        resp = self.app.post('/offer/add', data=json.dumps({'offer': offer}), headers={}, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        for code in ('code1', 'code2', 'code3', 'code4', 'code5'):
+            self.assertTrue(models.create_good('0', 'code', code))
+        for order_id in ('expired', 'expired-paid', 'fresh', 'orphan-fresh', 'orphan-expired'):
+            self.assertIsNotNone(models.allocate_good('0', order_id))
+
+        expired_secs = config.ORDER_EXPIRATION_SECS + 60
+        self.add_order('expired', userid, expired_secs)
+        self.add_order('expired-paid', userid, expired_secs)
+        self.add_order('fresh', userid, 0)
+        models.create_tx('hash1', userid, 'the address', True, 100, {'offer_id': '0', 'order_id': 'expired-paid'})
+        db.engine.execute('''update good set tx_hash='hash1' where order_id='expired-paid';''')
+        # the orphaned goods' orders are gone. only the one allocated long enough ago is released
+        db.engine.execute('''update good set updated_at=now() - %s * interval '1 second' where order_id='orphan-expired';''', (expired_secs,))
+
+        available = inventory.get_inventory(['0'])['0']['available']
+        self.assertEqual(models.release_unclaimed_goods(), 2)
+
+        # the expired orders are deleted, paid or not
+        self.assertEqual([order_id for (order_id,) in db.engine.execute('''select order_id from "order";''')], ['fresh'])
+        allocated = {order_id for (order_id,) in db.engine.execute('''select order_id from good where order_id is not null;''')}
+        self.assertEqual(allocated, {'expired-paid', 'fresh', 'orphan-fresh'})
+        self.assertEqual(inventory.get_inventory(['0'])['0']['available'], available + 2)
+
+        # nothing left to release
+        self.assertEqual(models.release_unclaimed_goods(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
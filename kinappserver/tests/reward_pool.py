@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, config, reward_pool
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+        # the pool runs inline in tests - use real threads here, with room for 2 pending rewards
+        config.DEPLOYMENT_ENV = 'unittest'
+        config.REWARD_POOL_MAX_PENDING = 1
+        kinappserver.app.kin_channels_count = 1
+        reward_pool.executor = None
+        reward_pool.draining = False
+
+    def tearDown(self):
+        config.DEPLOYMENT_ENV = 'test'
+        reward_pool.draining = False
+        self.postgresql.stop()
+
+    def test_reward_pool(self):
+        """test the pool's bounded queue, its pending rewards accounting and draining"""
+        release = threading.Event()
+        paid = []
+
+        def pay(amount):
+            release.wait(5)
+            paid.append(amount)
+
+        reward_pool.submit_reward(pay, 1)
+        reward_pool.submit_reward(pay, 2)
+        self.assertEqual(reward_pool.pending, 2)
+
+        # the pool is full
+        with self.assertRaises(reward_pool.RewardPoolFull):
+            reward_pool.submit_reward(pay, 3)
+        with self.assertRaises(reward_pool.RewardPoolFull):
+            reward_pool.reserve()
+        self.assertEqual(reward_pool.pending, 2)
+
+        # draining waits for the pending rewards, and then rejects new ones
+        release.set()
+        self.assertEqual(reward_pool.drain(5), 0)
+        self.assertEqual(reward_pool.pending, 0)
+        self.assertEqual(sorted(paid), [1, 2])
+        with self.assertRaises(reward_pool.RewardPoolFull):
+            reward_pool.submit_reward(pay, 4)
+
+    def test_reward_pool_reservations(self):
+        """test that reserved room is counted once, and given back unless a reward used it"""
+        def fail():
+            raise Exception('no kin for you')
+
+        reservation = reward_pool.reserve()
+        self.assertEqual(reward_pool.pending, 1)
+        reservation.release()
+        reservation.release()
+        self.assertEqual(reward_pool.pending, 0)
+
+        # a reward submitted with a reservation doesn't take more room. a failing reward gives its room back too
+        reservation = reward_pool.reserve()
+        reward_pool.submit_reward(fail, reservation=reservation).exception(5)
+        reservation.release()
+        self.assertEqual(reward_pool.drain(5), 0)
+        self.assertEqual(reward_pool.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, config, rewards
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+        config.REWARD_JOB_MAX_ATTEMPTS = 2
+        config.REWARD_JOB_RETRY_BACKOFF_SECS = 0
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_reward_retries(self):
+        """test that a failing reward job is retried, dead-lettered and never enqueued twice"""
+        userid = str(uuid.uuid4())
+        address = 'GCYUCLHLMARYYT5EXJIK2KZJCMRGIKKUCCJKJOAPUBALTBWVXAT4F4OZ'
+
+        # there is no such task, so the job fails
+        self.assertTrue(rewards.enqueue_task_reward(address, '1', False, userid, 'memo1'))
+        job = rewards.get_job_status(userid, '1', 'memo1')
+        self.assertEqual(job['state'], rewards.RETRYING)
+        self.assertEqual(job['attempts'], 1)
+
+        # the same payment is never enqueued twice
+        self.assertFalse(rewards.enqueue_task_reward(address, '1', False, userid, 'memo1'))
+
+        self.assertEqual(rewards.requeue_due_rewards(), 1)
+        job = rewards.get_job_status(userid, '1', 'memo1')
+        self.assertEqual(job['state'], rewards.DEAD)
+        self.assertEqual(job['attempts'], 2)
+
+        resp = self.app.get('/rewards/status?user_id=%s&task_id=1&memo=memo1' % userid)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['job']['state'], rewards.DEAD)
+        self.assertEqual(data['stats']['retrying'], 0)
+        self.assertEqual(data['stats']['dead_lettered'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
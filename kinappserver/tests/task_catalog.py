@@ -0,0 +1,130 @@
+import unittest
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, models, config
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def test_task_catalog(self):
+        """test that the in-process task catalog follows changes to the task2 table"""
+        cat = {'id': '0',
+          'title': 'cat-title',
+          'supported_os': 'all',
+          'ui_data': {'color': "#something",
+                      'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png',
+                      'header_image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'}}
+
+        resp = self.app.post('/category/add',
+                            data=json.dumps({
+                            'category': cat}),
+                            headers={},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        task = {  'id': '0',
+                  'title': 'do you know horses?',
+                  'desc': 'horses_4_dummies',
+                  'type': 'questionnaire',
+                  'position': 0,
+                  'cat_id': '0',
+                  'price': 2,
+                  'delay_days': 0,
+                  'min_to_complete': 2,
+                  'skip_image_test': True,
+                  'tags': ['music',  'crypto', 'movies', 'kardashians', 'horses'],
+                  'provider':
+                    {'name': 'om-nom-nom-food', 'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/gift_card.png'},
+                  'items': [
+                    {
+                     'id': '435',
+                     'text': 'what animal is this?',
+                     'type': 'text',
+                         'results': [
+                                {'id': '235',
+                                 'text': 'a horse!'},
+                                {'id': '2465436',
+                                 'text': 'a cat!'},
+                                 ],
+                    }]
+            }
+
+        self.assertEqual(models.get_task_by_id('0'), None)
+        version = models.get_task_catalog_version()
+
+        resp = self.app.post('/task/add',
+                            data=json.dumps({
+                            'task': task}),
+                            headers={},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        # adding a task bumps the version and the task is served from the catalog
+        self.assertTrue(models.get_task_catalog_version() > version)
+        self.assertEqual(models.get_task_by_id('0')['title'], 'do you know horses?')
+        self.assertEqual(models.get_task_delay('0'), 0)
+        self.assertEqual(models.get_reward_for_task('0'), 2)
+        self.assertEqual(models.get_task_type('0'), 'questionnaire')
+
+        # callers get copies - mutating them must not leak into the catalog
+        models.get_task_by_id('0')['memo'] = 'some-memo'
+        self.assertTrue('memo' not in models.get_task_by_id('0'))
+        models.get_task_by_id('0')['items'][0]['text'] = 'what animal is that?'
+        self.assertEqual(models.get_task_by_id('0')['items'][0]['text'], 'what animal is this?')
+        self.assertEqual(models.get_task_by_id('0', 1000)['start_date'], 1000)
+        self.assertEqual(models.get_task_by_id('0')['start_date'], 0)
+
+        models.set_delay_days(3, '0')
+        self.assertEqual(models.get_task_delay('0'), 3)
+
+        # another worker changed the table and bumped the version - reload on next lookup
+        db.engine.execute("""update task2 set price=5 where task_id='0';""")
+        self.assertEqual(models.get_reward_for_task('0'), 2)
+        kinappserver.app.redis.incr(config.TASK_CATALOG_VERSION_REDIS_KEY)
+        self.assertEqual(models.get_reward_for_task('0'), 5)
+
+        # the per-category index keeps the tasks ordered by position
+        task['id'] = '1'
+        task['position'] = 1
+        resp = self.app.post('/task/add',
+                            data=json.dumps({
+                            'task': task}),
+                            headers={},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([entry.task_id for entry in models.get_unsolved_task_entries_for_category('0', [])], ['0', '1'])
+        self.assertEqual([entry.task_id for entry in models.get_unsolved_task_entries_for_category('0', ['0'])], ['1'])
+        self.assertEqual(models.next_task_id_for_category('android', '1.0', {'0': ['0']}, '0', None, 'US', False), ['1'])
+        self.assertEqual(models.next_task_id_for_category('android', '1.0', {'0': ['0', '1']}, '0', None, 'US', False), [])
+
+        models.delete_task('0')
+        self.assertEqual(models.get_task_by_id('0'), None)
+        self.assertEqual([entry.task_id for entry in models.get_unsolved_task_entries_for_category('0', [])], ['1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+USER_ID_HEADER = "X-USERID"
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return userid
+
+    def test_transactions_pagination(self):
+        """test paging through the user's tx history with a cursor"""
+        userid = self.register()
+        for i in range(5):
+            models.create_tx('hash%s' % i, userid, 'GADDRESS', False, 10 + i, {'task_id': str(i), 'memo': 'memo%s' % i})
+
+        # without a limit, the whole history is returned, newest first
+        resp = self.app.get('/user/transactions', headers={USER_ID_HEADER: str(userid)})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual([tx['tx_hash'] for tx in data['txs']], ['hash4', 'hash3', 'hash2', 'hash1', 'hash0'])
+        self.assertIsNone(data['next_cursor'])
+        self.assertEqual(data['txs'][0]['type'], 'server')
+        self.assertEqual(data['txs'][0]['amount'], 14)
+        self.assertTrue(data['txs'][0]['client_received'])
+        self.assertEqual(data['txs'][0]['tx_info'], {'task_id': '4', 'memo': 'memo4'})
+        self.assertEqual(data['txs'][0]['title'], 'Delayed Kin')  # there's no such task
+
+        tx_hashes = []
+        cursor = None
+        while True:
+            url = '/user/transactions?limit=2' + ('&cursor=%s' % cursor if cursor else '')
+            resp = self.app.get(url, headers={USER_ID_HEADER: str(userid)})
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            self.assertLessEqual(len(data['txs']), 2)
+            tx_hashes.extend([tx['tx_hash'] for tx in data['txs']])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(tx_hashes, ['hash4', 'hash3', 'hash2', 'hash1', 'hash0'])
+
+        resp = self.app.get('/user/transactions?cursor=bad-cursor', headers={USER_ID_HEADER: str(userid)})
+        self.assertEqual(resp.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
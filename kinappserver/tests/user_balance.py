@@ -0,0 +1,82 @@
+import unittest
+import uuid
+
+import simplejson as json
+import testing.postgresql
+
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register(self):
+        userid = uuid.uuid4()
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(userid),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '234234',
+                            'time_zone': '05:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.0'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        return userid
+
+    def test_user_balance_ledger(self):
+        """test that the ledger follows the txs, and that it is backfilled and verified against them"""
+        userid = self.register()
+        models.create_tx('hash1', userid, 'GADDRESS', False, 100, {'task_id': '1', 'memo': 'memo1'})
+        models.create_txs([{'tx_hash': 'hash2', 'user_id': userid, 'amount': 20, 'incoming_tx': False, 'remote_address': 'GADDRESS', 'tx_info': {'task_id': '2', 'memo': 'memo2'}},
+                           {'tx_hash': 'hash3', 'user_id': userid, 'amount': 30, 'incoming_tx': True, 'remote_address': 'GOFFER', 'tx_info': {'offer_id': '0', 'order_id': 'order1'}},
+                           {'tx_hash': 'hash1', 'user_id': userid, 'amount': 100, 'incoming_tx': False, 'remote_address': 'GADDRESS', 'tx_info': {'task_id': '1', 'memo': 'memo1'}}])
+        self.assertEqual(models.get_user_inapp_balance(userid), 90)
+        self.assertEqual(models.UserBalance.query.filter_by(user_id=userid).one().balance, 90)
+
+        # a user whose txs predate the ledger starts from the sum of its txs
+        other_userid = self.register()
+        models.create_tx('hash4', other_userid, 'GADDRESS', False, 50, {'task_id': '1', 'memo': 'memo4'})
+        models.delete_user_balance(other_userid)
+        self.assertEqual(models.get_user_inapp_balance(other_userid), 50)
+        models.create_tx('hash5', other_userid, 'GADDRESS', False, 5, {'task_id': '2', 'memo': 'memo5'})
+        self.assertEqual(models.get_user_inapp_balance(other_userid), 55)
+
+        # the backfill only creates the missing rows
+        models.delete_user_balance(other_userid)
+        self.assertEqual(models.backfill_user_balances(), 1)
+        self.assertEqual(models.get_user_inapp_balance(other_userid), 55)
+        self.assertEqual(models.get_user_inapp_balance(self.register()), 0)
+
+        # the verifier corrects drifted balances
+        db.engine.execute('''update user_balance set balance = 1000 where user_id=%s;''', (str(userid),))
+        self.assertEqual(models.verify_user_balances(), {str(userid): -910})
+        self.assertEqual(models.verify_user_balances(), {})
+        self.assertEqual(models.get_user_inapp_balance(userid), 90)
+
+
+if __name__ == '__main__':
+    unittest.main()
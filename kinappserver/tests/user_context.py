@@ -0,0 +1,161 @@
+import simplejson as json
+import unittest
+import uuid
+
+from flask import g
+import testing.postgresql
+
+import kinappserver
+from kinappserver import db, models
+
+import logging as log
+log.getLogger().setLevel(log.INFO)
+
+USER_ID_HEADER = "X-USERID"
+
+
+class Tester(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        pass
+
+    def setUp(self):
+        #overwrite the db name, dont interfere with stage db data
+        self.postgresql = testing.postgresql.Postgresql()
+        kinappserver.app.config['SQLALCHEMY_DATABASE_URI'] = self.postgresql.url()
+        kinappserver.app.testing = True
+        self.app = kinappserver.app.test_client()
+        db.drop_all()
+        db.create_all()
+        kinappserver.app.redis.flushdb()
+
+    def tearDown(self):
+        self.postgresql.stop()
+
+    def register_user(self, user_id, phone_num=None):
+        resp = self.app.post('/user/register',
+            data=json.dumps({
+                            'user_id': str(user_id),
+                            'os': 'android',
+                            'device_model': 'samsung8',
+                            'device_id': '123456',
+                            'time_zone': '00:00',
+                            'token': 'fake_token',
+                            'app_ver': '1.4.1'}),
+            headers={},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        db.engine.execute("""update public.push_auth_token set auth_token='%s' where user_id='%s';""" % (str(user_id), str(user_id)))
+
+        resp = self.app.post('/user/auth/ack',
+                            data=json.dumps({
+                                'token': str(user_id)}),
+                            headers={USER_ID_HEADER: str(user_id)},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+        if phone_num is None:
+            return
+
+        resp = self.app.post('/user/firebase/update-id-token',
+                    data=json.dumps({
+                        'token': 'fake-token',
+                        'phone_number': phone_num}),
+                    headers={USER_ID_HEADER: str(user_id)},
+                    content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_user_context(self):
+        """test loading the user context of a registered user"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id, '+972528802120')
+        db.engine.execute("""update public.user_app_data set country_iso_code='IL' where user_id='%s';""" % str(user_id))
+
+        ctx = models.load_user_context(str(user_id))
+        self.assertTrue(ctx.is_authenticated)
+        self.assertTrue(ctx.is_phone_verified)
+        self.assertFalse(ctx.deactivated)
+        self.assertFalse(ctx.blacklisted)
+        self.assertEqual(ctx.unenc_phone_number, '+972528802120')
+        self.assertEqual(ctx.country_code, 'IL')
+
+        # a user without a phone number
+        user_id = uuid.uuid4()
+        self.register_user(user_id)
+        ctx = models.load_user_context(str(user_id))
+        self.assertFalse(ctx.is_phone_verified)
+        self.assertIsNone(ctx.unenc_phone_number)
+        self.assertFalse(ctx.should_block_by_phone_prefix)
+        self.assertTrue(ctx.should_allow_by_phone_prefix)
+
+        # no such user
+        ctx = models.load_user_context(str(uuid.uuid4()))
+        self.assertIsNone(ctx.user)
+        self.assertFalse(ctx.is_phone_verified)
+        self.assertFalse(ctx.deactivated)
+        self.assertFalse(ctx.blacklisted)
+        self.assertIsNone(ctx.country_code)
+
+    def test_missing_app_data(self):
+        """test the context of a user without a user_app_data row"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id)
+        db.engine.execute("""delete from public.user_app_data where user_id='%s';""" % str(user_id))
+
+        ctx = models.load_user_context(str(user_id))
+        self.assertIsNotNone(ctx.user)
+        self.assertIsNone(ctx.user_app_data)
+        self.assertIsNone(ctx.country_code)
+        self.assertFalse(ctx.should_block_by_country_code)
+
+    def test_missing_push_auth_token(self):
+        """test that a missing push auth token is created on the fly, like is_user_authenticated does"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id)
+        db.engine.execute("""delete from public.push_auth_token where user_id='%s';""" % str(user_id))
+
+        ctx = models.load_user_context(str(user_id))
+        self.assertIsNone(ctx.push_auth_token)
+        self.assertFalse(ctx.is_authenticated)
+        self.assertEqual(db.engine.execute("""select count(*) from public.push_auth_token where user_id='%s';""" % str(user_id)).scalar(), 1)
+
+    def test_blacklisted_phone(self):
+        """test the context of a user with a blacklisted phone number"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id, '+972528802121')
+        self.assertFalse(models.load_user_context(str(user_id)).blacklisted)
+
+        self.assertTrue(models.blacklist_phone_number('+972528802121'))
+        self.assertTrue(models.load_user_context(str(user_id)).blacklisted)
+
+    def test_deactivated_user(self):
+        """test the context of a deactivated user"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id)
+        self.assertFalse(models.load_user_context(str(user_id)).deactivated)
+
+        models.deactivate_user(str(user_id))
+        self.assertTrue(models.load_user_context(str(user_id)).deactivated)
+
+    def test_memoization(self):
+        """test that the context is loaded once per request"""
+        user_id = uuid.uuid4()
+        self.register_user(user_id)
+
+        with kinappserver.app.test_request_context():
+            ctx = models.get_user_context(user_id)
+            self.assertIs(models.get_user_context(str(user_id)), ctx)
+            self.assertIs(g.user_contexts[str(user_id)], ctx)
+
+        # a new request loads the context again
+        with kinappserver.app.test_request_context():
+            self.assertIsNot(models.get_user_context(str(user_id)), ctx)
+
+        # outside of a request, the context isn't memoized
+        self.assertIsNot(models.get_user_context(str(user_id)), models.get_user_context(str(user_id)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,9 @@ MAX_TXS_PER_USER = 100
 
 REDIS_USERID_PREFIX = 'userid'
 
+USER_CACHE_TAG = 'user:%s'  # the cache tag of everything cached for a specific user
+TASKS_CATALOG_CACHE_TAG = 'catalog:tasks'  # the cache tag of everything derived from the task catalog
+
 
 def generate_order_id(is_manual=False):
     # generate a unique-ish id for txs, this goes into the memo field of txs
@@ -36,10 +39,13 @@ def generate_order_id(is_manual=False):
     return env + str(uuid4().hex[:ORDER_ID_LENGTH])  # generate a memo string and send it to the client
 
 
-def increment_metric(metric_name, count=1):
+def increment_metric(metric_name, count=1, tags_str=''):
     """increment a counter with the given name and value"""
     # set env to undefined for local tests (which do not emit stats, as there's no agent)
-    statsd.increment(metric_name, count, tags=['app:kinit,env:%s' % config.DEPLOYMENT_ENV])
+    tags = 'app:kinit,env:%s' % config.DEPLOYMENT_ENV
+    if tags_str:
+        tags = tags + ',' + tags_str
+    statsd.increment(metric_name, count, tags=[tags])
 
 
 def gauge_metric(metric_name, value, tags_str=''):
@@ -51,6 +57,14 @@ def gauge_metric(metric_name, value, tags_str=''):
     statsd.gauge(metric_name, value, tags=[tags])
 
 
+def timing_metric(metric_name, value, tags_str=''):
+    """report a timing (in ms) with the given name and value"""
+    tags = 'app:kinit,env:%s' % config.DEPLOYMENT_ENV
+    if tags_str:
+        tags = tags + ',' + tags_str
+    statsd.timing(metric_name, value, tags=[tags])
+
+
 def errors_to_string(errorcode):
     """ translate error codes to human-readable reasons """
     if errorcode == ERROR_ORDERS_COOLDOWN:
@@ -243,7 +257,7 @@ def print_creation_statement():
     """prints out db creation statement. useful"""
     from sqlalchemy.schema import CreateTable
     from sqlalchemy.dialects import postgresql
-    from .models import BlackhawkCard, BlackhawkOffer, BlackhawkCreds, UserAppData, User, ACL, BackupQuestion, PhoneBackupHints, EmailTemplate, TruexBlacklistedUser, BlacklistedEncPhoneNumber, Task2, SystemConfig, Category, AppDiscovery, AppDiscoveryCategory
+    from .models import BlackhawkCard, BlackhawkOffer, BlackhawkCreds, UserAppData, User, ACL, BackupQuestion, PhoneBackupHints, EmailTemplate, TruexBlacklistedUser, BlacklistedEncPhoneNumber, Task2, SystemConfig, Category, AppDiscovery, AppDiscoveryCategory, CompletedTask
     log.info(CreateTable(User.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(UserAppData.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(BlackhawkCard.__table__).compile(dialect=postgresql.dialect()))
@@ -261,6 +275,7 @@ def print_creation_statement():
     log.info(CreateTable(Category.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(AppDiscovery.__table__).compile(dialect=postgresql.dialect()))
     log.info(CreateTable(AppDiscoveryCategory.__table__).compile(dialect=postgresql.dialect()))
+    log.info(CreateTable(CompletedTask.__table__).compile(dialect=postgresql.dialect()))
 
 
 def random_string(length=8):
@@ -271,20 +286,6 @@ def random_percent():
     return random.randint(0, 100)
 
 
-def delete_pattern(pt):
-    if pt is None:
-        log.error('delete_from_cache: refusing to delete None key')
-        return False
-    try:
-        keys = app.redis.keys(pt)
-        for key in keys:
-            app.redis.delete(key)
-        return True
-    except Exception as e:
-        log.error('failed to write json data to cache with key %s and value %s. exception: %s' % (pt,  e))
-        return False
-
-
 def delete_from_cache(key):
     if key is None:
         log.error('delete_from_cache: refusing to delete None key')
@@ -297,38 +298,38 @@ def delete_from_cache(key):
             key,  e))
         return False
 
-def read_json_from_cache(key):
-    try:
-        data = app.redis.get(key)
-        if not data:
-            raise InternalError('could not find key %s in cache' % key)
-        return json.loads(data.decode())
-    except Exception as e:
-        log.error('could not read json data from cache with key %s. e=%s. data=%s' % (key, e, data))
-        return None
-
 
-def write_json_to_cache(key, val, ttl=30*60):
-    if val is None:
-        log.error('write_json_to_cache: refusing to store None value')
-        return False
-    try:
-        app.redis.setex(key, ttl, json.dumps(val))
-        return True
-    except Exception as e:
-        log.error('failed to write json data to cache with key %s and value %s. exception: %s' % (key, val, e))
-        return False
+def invalidate_user_cache(user_id):
+    """drops the user's cached tasks and categories"""
+    from kinappserver import cache
+    return cache.invalidate_tags(USER_CACHE_TAG % user_id)
 
 
 def write_payment_data_to_cache(memo, user_id, task_id, timestamp, send_push=True):
-    return write_json_to_cache('memo:%s' % memo, {'user_id': str(user_id), 'task_id': str(task_id), 'timestamp': timestamp, 'send_push': send_push})
+    from kinappserver import cache
+    # the memo is written once and read by the callback, which might land on another worker - skip the local tier
+    return cache.set('memo:%s' % memo, {'user_id': str(user_id), 'task_id': str(task_id), 'timestamp': timestamp, 'send_push': send_push}, config.PAYMENT_MEMO_CACHE_TTL_SECS, local=False)
 
 
 def read_payment_data_from_cache(memo):
-    data = read_json_from_cache('memo:%s' % memo)
+    from kinappserver import cache
+    data = cache.get('memo:%s' % memo, local=False)
     return data['user_id'], data['task_id'], data['timestamp'], data['send_push']
 
 
+def read_payment_data_from_cache_many(memos):
+    """returns a dict of memo: (user_id, task_id, timestamp, send_push) for the given memos, read with a single MGET.
+    memos that aren't in the cache are omitted"""
+    from kinappserver import cache
+    found, _ = cache.get_many(['memo:%s' % memo for memo in memos], local=False)
+    payment_data = {}
+    for memo in memos:
+        data = found.get('memo:%s' % memo)
+        if data is not None:
+            payment_data[memo] = (data['user_id'], data['task_id'], data['timestamp'], data['send_push'])
+    return payment_data
+
+
 def passed_captcha(captcha_token):
     """get and parse a re-captcha result"""
     try:
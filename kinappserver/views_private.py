@@ -2,7 +2,7 @@
 The Kin App Server private API is defined here.
 """
 import traceback
-from uuid import UUID
+from uuid import UUID, uuid4
 import logging as log
 
 from flask import request, jsonify, abort
@@ -12,13 +12,19 @@ from kinappserver.views_common import limit_to_acl, limit_to_localhost, limit_to
 
 from kinappserver import app, config, stellar, utils, ssm
 from .push import send_please_upgrade_push_2
+from .engagement import dispatch_engagement_push, get_progress as get_engagement_progress
+from .push_outbox import drain_backlog, get_outbox_status
+from .rewards import get_job_status as get_reward_job_status, get_reward_queue_stats, requeue_due_rewards, enqueue_task_reward
+from .reconcile import reconcile_payments
+from .inventory import reconcile_inventory
 from kinappserver.stellar import send_kin, send_kin_with_payment_service, get_kin_balance
 from kinappserver.utils import InvalidUsage, InternalError, increment_metric, gauge_metric,\
     sqlalchemy_pool_status
 from kinappserver.models import add_task, add_category, send_engagement_push, \
-    create_tx, add_offer, set_offer_active, create_good, list_inventory, release_unclaimed_goods, \
-    get_users_for_engagement_push, list_user_transactions, get_task_details, set_delay_days, \
-    get_address_by_userid, send_compensated_push, nuke_user_data, send_push_auth_token, init_bh_creds, create_bh_offer, \
+    add_offer, set_offer_active, create_good, list_inventory, release_unclaimed_goods, restage_free_goods, \
+    backfill_user_balances, verify_user_balances, backfill_offer_purchases, ensure_user_history_indexes, \
+    get_users_for_engagement_push, list_user_transactions, set_delay_days, has_task_payment, \
+    get_address_by_userid, nuke_user_data, send_push_auth_token, init_bh_creds, create_bh_offer, \
     get_task_results, get_user_report, get_user_tx_report, get_user_goods_report, \
     scan_for_deauthed_users, user_exists, send_push_register, store_next_task_results_ts, \
     get_unauthed_users, get_all_user_id_by_phone, delete_all_user_data, \
@@ -27,7 +33,8 @@ from kinappserver.models import add_task, add_category, send_engagement_push, \
     remove_task_from_completed_tasks, switch_task_ids, delete_task, block_user_from_truex_tasks, \
     unblock_user_from_truex_tasks, set_update_available_below, set_force_update_below, \
     update_categories_extra_data, task20_migrate_tasks, add_discovery_app, set_discovery_app_active, \
-    add_discovery_app_category, get_user, blacklist_enc_phone_number, is_enc_phone_number_blacklisted
+    add_discovery_app_category, get_user, blacklist_enc_phone_number, is_enc_phone_number_blacklisted, \
+    backfill_completed_tasks
 
 
 
@@ -162,6 +169,65 @@ def inventory_api():
     return jsonify(status='ok', inventory=list_inventory())
 
 
+@app.route('/good/inventory/reconcile', methods=['POST'])
+def inventory_reconcile_api():
+    """internal endpoint used to correct the inventory counters that drifted from the db. called by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', drifted=reconcile_inventory())
+
+
+@app.route('/good/restage', methods=['POST'])
+def restage_goods_api():
+    """internal endpoint used to return stranded goods to the staged lists. called by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    if not config.GOODS_PRESTAGING_ENABLED:
+        return jsonify(status='ok', restaged=0, removed=0)
+    restaged, removed = restage_free_goods()
+    return jsonify(status='ok', restaged=restaged, removed=removed)
+
+
+@app.route('/users/balances/backfill', methods=['POST'])
+def backfill_user_balances_api():
+    """internal endpoint used to build the balance ledger of the existing users, in bulk"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', created=backfill_user_balances())
+
+
+@app.route('/users/balances/verify', methods=['POST'])
+def verify_user_balances_api():
+    """internal endpoint used to check the balance ledger against the txs. called by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=verify_user_balances, args=())
+    return jsonify(status='ok')
+
+
+@app.route('/offers/purchases/backfill', methods=['POST'])
+def backfill_offer_purchases_api():
+    """internal endpoint used to record the offer purchases made before the offer_purchase table existed"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', recorded=backfill_offer_purchases(config.OFFER_LIMIT_TIME_RANGE))
+
+
+@app.route('/users/transactions/indexes', methods=['POST'])
+def user_history_indexes_api():
+    """internal endpoint used to create the indexes of the paginated tx history on existing tables"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=ensure_user_history_indexes, args=())
+    return jsonify(status='ok')
+
+
 @app.route('/stats/db', methods=['GET'])
 def dbstats_api():
     """internal endpoint used to retrieve the number of db connections"""
@@ -214,28 +280,94 @@ def send_engagement_api():
     if scheme is None:
         raise InvalidUsage('invalid param')
     dry_run = payload.get('dryrun', 'True') == 'True'
-    log.info('engage-push: will call engage_push on rq_push with scheme:%s, dry run:%s' % (scheme, dry_run))
-    app.rq_push.enqueue_call(func=send_engagement_messages, args=(scheme, dry_run))
-    return jsonify(status='ok')
+    campaign_id = uuid4().hex
+    log.info('engage-push: will call engage_push on rq_push with scheme:%s, dry run:%s, campaign_id: %s' % (scheme, dry_run, campaign_id))
+    app.rq_push.enqueue_call(func=send_engagement_messages, args=(scheme, dry_run, campaign_id))
+    return jsonify(status='ok', campaign_id=campaign_id)
 
 
-def send_engagement_messages(scheme, dry_run):
-    """does the actual work related to sending engagement messages. should be called in the worker"""
+def send_engagement_messages(scheme, dry_run, campaign_id=None):
+    """selects the users for the given scheme and fans the push out to rate-limited chunk jobs. should be called in the worker"""
     user_ids = get_users_for_engagement_push(scheme)
     log.info('engage-push: --- in send_engagement_messages')
 
     if dry_run:
         log.info('engage-push: engagement_api - dry_run - not sending push')
-    else:
-        import time
-        for user_id in user_ids[utils.OS_IOS]:
-            time.sleep(1)  # hack to slow down push-sending as it kills the server
-            if not send_engagement_push(user_id, scheme):
-                log.error('engage-push: cant push to user %s: no push token' % user_id)
-        for user_id in user_ids[utils.OS_ANDROID]:
-            time.sleep(1)  # hack to slow down push-sending as it kills the server
-            if not send_engagement_push(user_id, scheme):
-                log.error('engage-push: cant push to user %s: no push token' % user_id)
+    campaign_id = dispatch_engagement_push(scheme, user_ids, dry_run, campaign_id)
+    log.info('engage-push: started campaign %s' % campaign_id)
+
+
+@app.route('/engagement/progress', methods=['GET'])
+def engagement_progress_api():
+    """returns the progress of an engagement push campaign"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    campaign_id = request.args.get('campaign_id')
+    if campaign_id is None:
+        raise InvalidUsage('invalid param')
+    progress = get_engagement_progress(campaign_id)
+    if progress is None:
+        raise InvalidUsage('no such campaign: %s' % campaign_id)
+    return jsonify(status='ok', progress=progress)
+
+
+@app.route('/push/outbox', methods=['GET'])
+def push_outbox_status_api():
+    """returns the push outbox counters of the serving worker and the size of the redis backlog"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', outbox=get_outbox_status())
+
+
+@app.route('/push/outbox/drain', methods=['POST'])
+def push_outbox_drain_api():
+    """delivers up to 'limit' intents from the push outbox's redis backlog"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        limit = int(payload.get('limit', config.PUSH_OUTBOX_BATCH_SIZE))
+    except (TypeError, ValueError):
+        raise InvalidUsage('invalid param')
+    if limit <= 0:
+        raise InvalidUsage('invalid param')
+
+    drained = 0
+    while drained < limit:
+        popped = drain_backlog(min(config.PUSH_OUTBOX_BATCH_SIZE, limit - drained))
+        if not popped:
+            break
+        drained = drained + popped
+    return jsonify(status='ok', drained=drained, outbox=get_outbox_status())
+
+
+@app.route('/rewards/status', methods=['GET'])
+def reward_jobs_status_api():
+    """returns the stats of the reward queue. given user_id, task_id and memo, also returns that reward job's status"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    user_id = request.args.get('user_id')
+    task_id = request.args.get('task_id')
+    memo = request.args.get('memo')
+    job = None
+    if None not in (user_id, task_id, memo):
+        job = get_reward_job_status(user_id, task_id, memo)
+        if job is None:
+            raise InvalidUsage('no such reward job')
+    return jsonify(status='ok', stats=get_reward_queue_stats(), job=job)
+
+
+@app.route('/rewards/retry', methods=['POST'])
+def reward_jobs_retry_api():
+    """moves the failed reward jobs that are due for another attempt back to the reward queue. called by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    return jsonify(status='ok', requeued=requeue_due_rewards())
 
 
 @app.route('/user/compensate', methods=['POST'])
@@ -260,23 +392,29 @@ def compensate_user_api():
     if task_id in user_tx_task_ids:
         print('refusing to compensate user %s for task %s - already received funds!' % (user_id, task_id))
         return jsonify(status='error', reason='already_compensated')
-
-    print('calling send_kin: %s, %s' % (public_address, kin_amount))
-    try:
-        tx_hash = send_kin(public_address, kin_amount, memo)
-        create_tx(tx_hash, user_id, public_address, False, kin_amount, {'task_id': task_id, 'memo': memo})
-    except Exception as e:
-        print('error attempting to compensate user %s for task %s' % (user_id, task_id))
-        print(e)
+    # the payment is made asynchronously - dont pay again while an earlier payment is on its way
+    if has_task_payment(user_id, task_id):
+        print('refusing to compensate user %s for task %s - a payment is already pending' % (user_id, task_id))
+        return jsonify(status='error', reason='payment_pending')
+
+    # the payment goes through the reward queue, and is recorded for the reconciliation job like any task payment
+    print('compensating user %s with %s kins for task_id %s. memo: %s' % (user_id, kin_amount, task_id, memo))
+    # the reward job also pushes to the user once the payment was made. the tx isn't there yet - return the memo
+    if not enqueue_task_reward(public_address, task_id, False, user_id, memo, amount=kin_amount, compensated=True):
         return jsonify(status='error', reason='internal_error')
-    else:
-        print('compensated user %s with %s kins for task_id %s' % (user_id, kin_amount, task_id))
-        # also send push to the user
-        task_title = get_task_details(task_id)['title']
-        send_compensated_push(user_id, kin_amount, task_title)
-        increment_metric('manual-compensation')
+    increment_metric('manual-compensation')
+
+    return jsonify(status='ok', memo=memo)
 
-        return jsonify(status='ok', tx_hash=tx_hash)
+
+@app.route('/payments/reconcile', methods=['POST'])
+def reconcile_payments_api():
+    """re-submits the task payments whose tx never showed up. called by cron"""
+    if not config.DEBUG:
+        limit_to_localhost()
+
+    app.rq_slow.enqueue_call(func=reconcile_payments, args=())
+    return jsonify(status='ok')
 
 
 @app.route('/user/nuke-data', methods=['POST'])
@@ -727,6 +865,15 @@ def get_missing_txs_endpoint():
     return jsonify(status='ok')
 
 
+@app.route('/users/completed_tasks/backfill', methods=['POST'])
+def backfill_completed_tasks_endpoint():
+    """copy the completed tasks of all users from the legacy json column into the completed_task table"""
+    if not config.DEBUG:
+        limit_to_localhost()
+    app.rq_slow.enqueue_call(func=backfill_completed_tasks, args=())
+    return jsonify(status='ok')
+
+
 @app.route('/users/migrate-restored-user', methods=['POST'])
 def migrate_restored_user():
     # TODO remove me later
@@ -756,7 +903,7 @@ def get_rq_q_length_endpoint():
         limit_to_localhost()
 
     from rq import Queue
-    for queue_name in ['kinappserver-%s-fast' % config.DEPLOYMENT_ENV,'kinappserver-%s-slow' % config.DEPLOYMENT_ENV]:
+    for queue_name in ['kinappserver-%s-fast' % config.DEPLOYMENT_ENV,'kinappserver-%s-slow' % config.DEPLOYMENT_ENV, 'kinappserver-%s-reward' % config.DEPLOYMENT_ENV]:
         q = Queue(queue_name, connection=app.redis)
         print('there are currently %s jobs in the %s queue' % (q.count, queue_name))
         gauge_metric('rq_queue_len', q.count, 'queue_name:%s' % queue_name)
@@ -1,7 +1,6 @@
 """
 The Kin App Server public API is defined here.
 """
-from threading import Thread
 from uuid import UUID
 from flask_cors import cross_origin
 from flask import request, jsonify, abort
@@ -15,18 +14,21 @@ from .utils import OS_ANDROID, OS_IOS, passed_captcha
 
 from kinappserver import app, config, utils
 from .push import send_please_upgrade_push_2, send_country_not_supported
-from kinappserver.stellar import create_account, send_kin, send_kin_with_payment_service, add_signature
+from .rewards import enqueue_task_reward, retry_failed_payment
+from .reward_pool import submit_reward, reserve as reserve_reward, RewardPoolFull
+from kinappserver.stellar import create_account, send_kin, add_signature
 from kinappserver.utils import InvalidUsage, InternalError, errors_to_string, increment_metric, gauge_metric, MAX_TXS_PER_USER, extract_phone_number_from_firebase_id_token,\
-     get_global_config, write_payment_data_to_cache, read_payment_data_from_cache
+     get_global_config, read_payment_data_from_cache_many
 from kinappserver.models import create_user, update_user_token, update_user_app_version, \
     store_task_results, is_onboarded, \
-    set_onboarded, send_push_tx_completed, \
-    create_tx, get_reward_for_task, \
+    set_onboarded, send_push_tx_completed, send_pushes_tx_completed, \
+    create_tx, create_txs, get_reward_for_task, \
     get_offers_for_user, create_order, process_order, \
-    list_user_transactions, get_redeemed_items, get_offer_details, get_task_details,\
+    list_user_transactions, get_redeemed_items, get_offer_details,\
+    list_user_history, decode_history_cursor, get_offers_details, get_tasks_details,\
     add_p2p_tx,add_app2app_tx, set_user_phone_number, match_phone_number_to_address, user_deactivated,\
     handle_task_results_resubmission, reject_premature_results, get_address_by_userid,\
-    list_p2p_transactions_for_user_id, send_push_auth_token, ack_auth_token, is_user_authenticated, is_user_phone_verified,\
+    send_push_auth_token, ack_auth_token, is_user_authenticated, is_user_phone_verified,\
     get_user_config, get_task_by_id, get_truex_activity, get_and_replace_next_task_memo,\
     user_exists, get_user_id_by_truex_user_id,\
     get_email_template_by_type, get_backup_hints, generate_backup_questions_list, store_backup_hints, \
@@ -34,7 +36,7 @@ from kinappserver.models import create_user, update_user_token, update_user_app_
     should_block_user_by_client_version, deactivate_user, get_user_os_type, should_block_user_by_phone_prefix, count_registrations_for_phone_number, \
     update_ip_address, should_block_user_by_country_code, is_userid_blacklisted, should_allow_user_by_phone_prefix, should_pass_captcha, \
     captcha_solved, get_user_tz, do_captcha_stuff, get_personalized_categories_header_message, get_categories_for_user, \
-    task20_migrate_user_to_tasks2, should_force_update, is_update_available, count_immediate_tasks
+    task20_migrate_user_to_tasks2, should_force_update, is_update_available, count_immediate_tasks, get_user_context
 
 def get_payment_lock_name(user_id, task_id):
     """generate a user and task specific lock for payments."""
@@ -319,10 +321,8 @@ def post_user_task_results_endpoint():
 
     # task was submitted successfuly.
     # clear tasks cache
-    from kinappserver.utils import delete_pattern, delete_from_cache
-
-    delete_from_cache(config.USER_CATEGORIES_CACHE_REDIS_KEY % user_id)
-    delete_pattern(config.USER_TASK_IN_CATEGORY_CACHE_REDIS_KEY_PREFIX % user_id)
+    from kinappserver.utils import invalidate_user_cache
+    invalidate_user_cache(user_id)
 
     if reject_premature_results(user_id, task_id):
         # should never happen: the client sent the results too soon
@@ -432,7 +432,8 @@ def post_user_task_results_endpoint():
 
         memo = get_and_replace_next_task_memo(user_id, task_id)
         do_captcha_stuff(user_id) # raise captcha flag if needed
-        reward_address_for_task_internal_payment_service(address, task_id, send_push, user_id, memo, delta)
+        # the payment is sent by a reward job - the payment service isn't called inline
+        enqueue_task_reward(address, task_id, send_push, user_id, memo, delta)
 
     except Exception as e:
         print('exception: %s' % e)
@@ -461,33 +462,34 @@ def check_captcha(user_id, captcha_token):
 
 
 def authorize(user_id):
-    if config.AUTH_TOKEN_ENFORCED and not is_user_authenticated(user_id):
+    user_context = get_user_context(user_id)
+    if config.AUTH_TOKEN_ENFORCED and not user_context.is_authenticated:
         print('user %s is not authenticated. rejecting results submission request' % user_id)
         increment_metric('rejected-on-auth')
         return 'auth-failed'
 
-    if config.PHONE_VERIFICATION_REQUIRED and not is_user_phone_verified(user_id):
+    if config.PHONE_VERIFICATION_REQUIRED and not user_context.is_phone_verified:
         print('blocking user (%s) results - didnt pass phone_verification' % user_id)
         return 'user_phone_not_verified'
 
-    if user_deactivated(user_id):
+    if user_context.deactivated:
         print('user %s deactivated. rejecting submission' % user_id)
         return 'denied'
 
-    if should_block_user_by_phone_prefix(user_id):
+    if user_context.should_block_by_phone_prefix:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from submitting tasks - country not supported' % user_id)
         return 'denied'
 
     # user has a verified phone number, but is it from a blocked country?
-    if should_block_user_by_country_code(user_id):
+    if user_context.should_block_by_country_code:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from getting tasks - blocked country code' % user_id)
         return 'denied'
 
-    if is_userid_blacklisted(user_id):
+    if user_context.blacklisted:
         print('blocked user_id %s from booking goods - user_id blacklisted' % user_id)
         return 'denied'
 
@@ -509,27 +511,28 @@ def get_next_task_internal(cat_ids=[]):
     user_id, auth_token = extract_headers(request)
 
     log.info('getting tasks for userid %s and source_ip: %s' % (user_id, get_source_ip(request)))
+    user_context = get_user_context(user_id)
 
     # dont serve users with no phone number
-    if config.PHONE_VERIFICATION_REQUIRED and not is_user_phone_verified(user_id):
+    if config.PHONE_VERIFICATION_REQUIRED and not user_context.is_phone_verified:
         log.info('blocking user %s from getting tasks: phone not verified' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it blocked?
-    if should_block_user_by_phone_prefix(user_id):
+    if user_context.should_block_by_phone_prefix:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         log.info('blocked user_id %s from getting tasks - blocked prefix' % user_id)
         return jsonify(tasks=[], reason='denied'),  status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it from a blocked country?
-    if should_block_user_by_country_code(user_id):
+    if user_context.should_block_by_country_code:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         log.info('blocked user_id %s from getting tasks - blocked country code' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
-    if user_deactivated(user_id):
+    if user_context.deactivated:
         print('user %s is deactivated. returning empty task array' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
@@ -568,7 +571,8 @@ def get_next_task_internal(cat_ids=[]):
 
 @app.route('/user/transactions', methods=['GET'])
 def get_transactions_api():
-    """return a list of the last X txs for this user
+    """return a list of the last X txs for this user - a page of up to limit txs, following the given cursor.
+    the response's next_cursor fetches the next page (or is null on the last page)
 
     each item in the list contains:
         - the tx_hash
@@ -577,64 +581,58 @@ def get_transactions_api():
         - date
         - title and additional details
     """
-    detailed_txs = []
     try:
         user_id, auth_token = extract_headers(request)
-        server_txs = [{'type': 'server', 'tx_hash': tx.tx_hash, 'amount': tx.amount, 'client_received': not tx.incoming_tx, 'tx_info': tx.tx_info, 'date': arrow.get(tx.update_at).timestamp} for tx in list_user_transactions(user_id, MAX_TXS_PER_USER)]
+        limit = min(int(request.args.get('limit', MAX_TXS_PER_USER)), MAX_TXS_PER_USER)
+        cursor = request.args.get('cursor', None)
+        if cursor:
+            decode_history_cursor(cursor)  # reject malformed cursors
+        if limit < 1:
+            raise InvalidUsage('bad-request')
+    except Exception as e:
+        print('exception: %s' % e)
+        raise InvalidUsage('bad-request')
 
+    detailed_txs = []
+    next_cursor = None
+    try:
+        # a page of the server and p2p txs, merged and sorted in the db
+        txs, next_cursor = list_user_history(user_id, limit, cursor)
 
-        # get the offer, task details
-        for tx in server_txs:
-            details = get_offer_details(tx['tx_info']['offer_id']) if not tx['client_received'] else get_task_details(tx['tx_info']['task_id'])
-            detailed_txs.append({**tx, **details})
+        # get the offer, task and app details of the whole page at once
+        offers_details = get_offers_details([tx['tx_info']['offer_id'] for tx in txs if tx['type'] == 'server' and not tx['client_received']])
+        tasks_details = get_tasks_details([tx['tx_info']['task_id'] for tx in txs if tx['type'] == 'server' and tx['client_received']])
+        app_sids = {tx['receiver_app_sid'] for tx in txs if tx['receiver_app_sid'] is not None}
+        from .models import AppDiscovery
+        apps = {d_app.sid: d_app for d_app in AppDiscovery.query.filter(AppDiscovery.sid.in_(app_sids)).all()} if app_sids else {}
 
-        # get p2p details
         import emoji
-        from .models import AppDiscovery
-        apps = AppDiscovery.query.all()
-        
-        kin_from_a_friend_text=emoji.emojize(':party_popper: Kin from a friend')
-        p2p_txs = []
-        for tx in list_p2p_transactions_for_user_id(user_id, MAX_TXS_PER_USER):
-            is_app2app = tx.receiver_app_sid is not None
-            if is_app2app:
-                d_app = list(filter(lambda item: item.sid == tx.receiver_app_sid, apps))
-                title = 'Sent Kin to %s' % d_app[0].name
-                p2p_txs.append({'title': title,
-                    'description': 'You sent %sKIN to %s' % (tx.amount, d_app[0].name),
-                    'provider': {'image_url': d_app[0].meta_data['icon_url'], 'name': d_app[0].name},
-                    'type': 'p2p',
-                    'tx_hash': tx.tx_hash,
-                    'amount': tx.amount,
-                    'client_received': str(tx.receiver_user_id).lower() == str(user_id).lower(),
-                    'tx_info': {'memo': 'na', 'task_id': '-1'},
-                    'date': arrow.get(tx.update_at).timestamp})
+        kin_from_a_friend_text = emoji.emojize(':party_popper: Kin from a friend')
+        for tx in txs:
+            item = {'type': tx['type'], 'tx_hash': tx['tx_hash'], 'amount': tx['amount'], 'client_received': tx['client_received'], 'date': arrow.get(tx['update_at']).timestamp}
+            if tx['type'] == 'server':
+                details = offers_details[str(tx['tx_info']['offer_id'])] if not tx['client_received'] else tasks_details[str(tx['tx_info']['task_id'])]
+                detailed_txs.append({**item, 'tx_info': tx['tx_info'], **details})
+            elif tx['receiver_app_sid'] is not None:
+                d_app = apps[tx['receiver_app_sid']]
+                detailed_txs.append({**item,
+                    'title': 'Sent Kin to %s' % d_app.name,
+                    'description': 'You sent %sKIN to %s' % (tx['amount'], d_app.name),
+                    'provider': {'image_url': d_app.meta_data['icon_url'], 'name': d_app.name},
+                    'tx_info': {'memo': 'na', 'task_id': '-1'}})
             else:
-                title = kin_from_a_friend_text if str(tx.receiver_user_id).lower() == str(user_id).lower() else 'Kin to a friend'
-                p2p_txs.append({'title': kin_from_a_friend_text if str(tx.receiver_user_id).lower() == str(user_id).lower() else 'Kin to a friend',
-                    'description': 'a friend sent you %sKIN' % tx.amount,
+                detailed_txs.append({**item,
+                    'title': kin_from_a_friend_text if tx['client_received'] else 'Kin to a friend',
+                    'description': 'a friend sent you %sKIN' % tx['amount'],
                     'provider': {'image_url': 'https://s3.amazonaws.com/kinapp-static/brand_img/poll_logo_kin.png', 'name': 'friend'},
-                    'type': 'p2p',
-                    'tx_hash': tx.tx_hash,
-                    'amount': tx.amount,
-                    'client_received': str(tx.receiver_user_id).lower() == str(user_id).lower(),
-                    'tx_info': {'memo': 'na', 'task_id': '-1'},
-                    'date': arrow.get(tx.update_at).timestamp})
-
-        # merge txs:
-        detailed_txs = detailed_txs + p2p_txs
-
-        # sort by date
-        detailed_txs = sorted(detailed_txs, key=lambda k: k['date'], reverse=True)
-        if len(detailed_txs) > MAX_TXS_PER_USER:
-            detailed_txs = detailed_txs[:MAX_TXS_PER_USER]
+                    'tx_info': {'memo': 'na', 'task_id': '-1'}})
 
     except Exception as e:
         log.error('cant get txs for user')
         print(e)
         return jsonify(status='error', txs=[])
 
-    return jsonify(status='ok', txs=detailed_txs)
+    return jsonify(status='ok', txs=detailed_txs, next_cursor=next_cursor)
 
 
 @app.route('/user/redeemed', methods=['GET'])
@@ -804,9 +802,9 @@ def register_api():
             return jsonify(status='ok', config=global_config)
 
 
-def reward_and_push(public_address, task_id, send_push, user_id, memo, delta):
-    """create a thread to perform this function in the background"""
-    Thread(target=reward_address_for_task_internal, args=(public_address, task_id, send_push, user_id, memo, delta)).start()
+def reward_and_push(public_address, task_id, send_push, user_id, memo, delta, reservation=None):
+    """perform this function in the background, on the reward pool. raises RewardPoolFull if the pool is full"""
+    submit_reward(reward_address_for_task_internal, public_address, task_id, send_push, user_id, memo, delta, reservation=reservation)
 
 
 def reward_address_for_task_internal(public_address, task_id, send_push, user_id, memo, delta=0):
@@ -826,6 +824,7 @@ def reward_address_for_task_internal(public_address, task_id, send_push, user_id
     # take into account the delta: add or reduce kins from the amount
     amount = amount + delta
 
+    tx_hash = None
     try:
         # send the moneys
         print('calling send_kin: %s, %s' % (public_address, amount))
@@ -844,32 +843,6 @@ def reward_address_for_task_internal(public_address, task_id, send_push, user_id
             log.error('failed to release payment lock for user_id %s and task_id %s' % (user_id, task_id))
 
 
-def reward_address_for_task_internal_payment_service(public_address, task_id, send_push, user_id, order_id, delta=0):
-    """transfer the correct amount of kins for the task to the given address using the payment service.
-       the payment service is async and calls a callback when its done. the tx is written into the db
-       in the callback function.
-
-       typically, tips are negative delta and quiz-results are positive delta
-    """
-    # get reward amount from db
-    amount = get_reward_for_task(task_id)
-    if not amount:
-        print('could not figure reward amount for task_id: %s' % task_id)
-        raise InternalError('cant find reward for task_id %s' % task_id)
-
-    # take into account the delta: add or reduce kins from the amount
-    amount = amount + delta
-    write_payment_data_to_cache(order_id, user_id, task_id, arrow.utcnow().timestamp, send_push)  # store this info in cache for when the callback is called
-    print('calling send_kin with the payment service: %s, %s' % (public_address, amount))
-    # sends a request to the payment service. result comes back via a callback
-    if config.DEPLOYMENT_ENV == 'test':
-        tx_hash = send_kin(public_address, amount, order_id)
-        create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': order_id})
-        return
-    else:
-        send_kin_with_payment_service(public_address, amount, order_id)
-
-
 @app.route('/user/offers', methods=['GET'])
 def get_offers_api():
     """return the list of available offers for this user"""
@@ -882,25 +855,26 @@ def get_offers_api():
         raise InvalidUsage('bad-request')
         #print('offers %s' % get_offers_for_user(user_id))
 
-    if config.PHONE_VERIFICATION_REQUIRED and not is_user_phone_verified(user_id):
+    user_context = get_user_context(user_id)
+    if config.PHONE_VERIFICATION_REQUIRED and not user_context.is_phone_verified:
         print('blocking user (%s) from getting offers - didnt pass phone_verification' % user_id)
         return jsonify(offers=[], status='error', reason='user_phone_not_verified'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it in the phone-prefix blacklist? also send push!
-    if should_block_user_by_phone_prefix(user_id):
+    if user_context.should_block_by_phone_prefix:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from getting offers - blocked prefix' % user_id)
         return jsonify(offers=[], status='error', reason='denied'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it in the phone-prefix white list? if not, just dont return offers
-    if not should_allow_user_by_phone_prefix(user_id):
+    if not user_context.should_allow_by_phone_prefix:
         # send push with 8 hour cooldown and dont return tasks
         print('blocked user_id %s from getting offers - not in whitelist' % user_id)
         return jsonify(offers=[], status='error', reason='denied'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it from a blocked country?
-    if should_block_user_by_country_code(user_id):
+    if user_context.should_block_by_country_code:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from getting offers - blocked country code' % user_id)
@@ -942,30 +916,31 @@ def book_offer_api():
         log.error(e)
         raise e
 
-    if config.AUTH_TOKEN_ENFORCED and not is_user_authenticated(user_id):
+    user_context = get_user_context(user_id)
+    if config.AUTH_TOKEN_ENFORCED and not user_context.is_authenticated:
         print('user %s is not authenticated. rejecting book request' % user_id)
         increment_metric('rejected-on-auth')
         return jsonify(status='error', reason='denied'),  status.HTTP_403_FORBIDDEN
 
-    if config.PHONE_VERIFICATION_REQUIRED and not is_user_phone_verified(user_id):
+    if config.PHONE_VERIFICATION_REQUIRED and not user_context.is_phone_verified:
         print('blocking user (%s) results - didnt pass phone_verification' % user_id)
         return jsonify(status='error', reason='denied'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it blocked?
-    if should_block_user_by_phone_prefix(user_id):
+    if user_context.should_block_by_phone_prefix:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from booking goods - blocked prefix' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
     # user has a verified phone number, but is it from a blocked country?
-    if should_block_user_by_country_code(user_id):
+    if user_context.should_block_by_country_code:
         # send push with 8 hour cooldown and dont return tasks
         send_country_not_supported(user_id)
         print('blocked user_id %s from booking goods - blocked country code' % user_id)
         return jsonify(tasks=[], reason='denied'),  status.HTTP_403_FORBIDDEN
 
-    if is_userid_blacklisted(user_id):
+    if user_context.blacklisted:
         print('blocked user_id %s from booking goods - user_id blacklisted' % user_id)
         return jsonify(tasks=[], reason='denied'), status.HTTP_403_FORBIDDEN
 
@@ -1171,19 +1146,30 @@ def truex_callback_endpoint():
             print('truex_callback_endpoint: failed to authenticate request from truex')
             return TRUEX_CALLBACK_BAD_SIG
 
-        # ensure eng_id uniqueness with ttl
-        if not app.redis.set('truex-%s' % eng_id, 1, nx=True, ex=TRUEX_ENG_UNIQUENESS_TTL_SEC):
-            # dup eng_id
-            print('truex_callback_endpoint: detected duplicate eng-id. ignoring request')
-            return TRUEX_CALLBACK_DUP_ENGAGEMENT_ID
-
-        # okay. pay the user
-        # translate truex user-string to user_id
+        # dont take the engagement if it can't be paid for right now - truex will retry it.
+        # the room is reserved before the eng_id is claimed, so a claimed engagement is always paid
+        try:
+            reservation = reserve_reward()
+        except RewardPoolFull:
+            print('truex_callback_endpoint: the reward pool is full. asking truex to retry')
+            return TRUEX_CALLBACK_RECOVERABLE_ERROR
 
-        print('paying user %s for truex activity' % user_id)
-        res = compensate_truex_activity(user_id)
-        if not res:
-            log.error('failed to pay user %s for truex activity' % user_id)
+        try:
+            # ensure eng_id uniqueness with ttl
+            if not app.redis.set('truex-%s' % eng_id, 1, nx=True, ex=TRUEX_ENG_UNIQUENESS_TTL_SEC):
+                # dup eng_id
+                print('truex_callback_endpoint: detected duplicate eng-id. ignoring request')
+                return TRUEX_CALLBACK_DUP_ENGAGEMENT_ID
+
+            # okay. pay the user
+            # translate truex user-string to user_id
+
+            print('paying user %s for truex activity' % user_id)
+            res = compensate_truex_activity(user_id, reservation)
+            if not res:
+                log.error('failed to pay user %s for truex activity' % user_id)
+        finally:
+            reservation.release()  # unless the reward was submitted with it
 
         do_captcha_stuff(user_id)  # raise captcha flag if needed
     except Exception as e:
@@ -1193,8 +1179,8 @@ def truex_callback_endpoint():
     return TRUEX_CALLBACK_PROCESSED
 
 
-def compensate_truex_activity(user_id):
-    """pay a user for her truex activity
+def compensate_truex_activity(user_id, reservation=None):
+    """pay a user for her truex activity, using the given reward pool reservation if any
 
     this function has a lot of duplicate code from post_user_task_results_endpoint
     """
@@ -1239,7 +1225,7 @@ def compensate_truex_activity(user_id):
     try:
         memo = get_and_replace_next_task_memo(user_id, task_id, TRUEX_CAT_ID)
         address = get_address_by_userid(user_id)
-        reward_and_push(address, task_id, False, user_id, memo, delta=0)
+        reward_and_push(address, task_id, False, user_id, memo, delta=0, reservation=reservation)
     except Exception as e:
         log.error('failed to reward truex task %s at address %s for user_id %s . exception: %s' % (task_id, address, user_id, e))
         raise(e)
@@ -1367,74 +1353,130 @@ def get_blacklist_areacodes_endpoint():
 
 @app.route('/payments/callback', methods=['POST'])
 def payment_service_callback_endpoint():
-    """an endpoint for the payment service."""
+    """an endpoint for the payment service. a thin wrapper over the batch callback"""
     payload = request.get_json(silent=True)
     print(payload) #TODO remove eventually
 
-    try:
-        action = payload.get('action', None)
-        obj = payload.get('object', None)
-        state = payload.get('state', None)
-        val = payload.get('value', None)
+    result = process_payment_callbacks([payload])[0]
+    if result != 'ok':
+        return jsonify(status='error', reason='internal_error')
+    return jsonify(status='ok')
 
-        if None in (action, obj, state, val):
-            print('should never happen: cant process payment service callback: %s' % payload)
-            increment_metric('payment-callback-error')
-            return jsonify(status='error', reason='internal_error')
-
-        #  process payment:
-        if action == 'send' and obj == 'payment':
-            if state == 'success':
-                memo = val.get('id', None)
-                tx_hash = val.get('transaction_id', None)
-                amount = val.get('amount', None)
-                payment_ts = payload.get('timestamp', None)
-                public_address = val.get('sender_address')
-                if None in (memo, tx_hash, amount):
-                    print('should never happen: cant process successful payment callback: %s' % payload)
-                    increment_metric('payment-callback-error')
-                    return jsonify(status='error', reason='internal_error')
 
-                # retrieve the user_id and task_id from the cache
-                log.info("reading payment data from cache for %s" % memo)
-                user_id, task_id, request_timestamp, send_push = read_payment_data_from_cache(memo)
+@app.route('/payments/callback/batch', methods=['POST'])
+def payment_service_batch_callback_endpoint():
+    """an endpoint for the payment service, accepting a list of callbacks. returns the result of each one"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, list):
+        raise InvalidUsage('bad-request')
+    increment_metric('payment-callback-batch')
+    return jsonify(status='ok', results=process_payment_callbacks(payload))
 
-                # compare the timestamp from the callback with the one from the original request, and
-                # post as a gauge  metric for tracking
-                try:
-                    request_duration_sec = arrow.get(payment_ts) - arrow.get(request_timestamp)
-                    request_duration_sec = int(request_duration_sec.total_seconds())
-                    print('payment request for tx_hash: %s took %s seconds' % (tx_hash, request_duration_sec))
-                    gauge_metric('payment-req-dur', request_duration_sec)
-                except Exception as e:
-                    log.error('failed to calculate payment request duration. e=%s' % e)
 
-                create_tx(tx_hash, user_id, public_address, False, amount, {'task_id': task_id, 'memo': memo})
-                increment_metric('payment-callback-success')
+def process_payment_callbacks(payloads):
+    """processes the given payment service callbacks in bulk. returns a list with 'ok' or 'error' for each callback.
+
+    the memos are read with a single MGET, the txs are written with a single insert, the pushes are
+    queued together and the payment locks are released in a single pipeline.
+    """
+    results = ['ok'] * len(payloads)
+    payments = []  # (index, memo, tx_hash, amount, public_address, payment_ts) of the successful payments
+    for i, payload in enumerate(payloads):
+        try:
+            action = payload.get('action', None)
+            obj = payload.get('object', None)
+            state = payload.get('state', None)
+            val = payload.get('value', None)
+
+            if None in (action, obj, state, val):
+                print('should never happen: cant process payment service callback: %s' % payload)
+                increment_metric('payment-callback-error')
+                results[i] = 'error'
+                continue
+
+            #  process payment:
+            if action == 'send' and obj == 'payment':
+                if state == 'success':
+                    memo = val.get('id', None)
+                    tx_hash = val.get('transaction_id', None)
+                    amount = val.get('amount', None)
+                    sender_address = val.get('sender_address', None)
+                    if None in (memo, tx_hash, amount, sender_address):
+                        print('should never happen: cant process successful payment callback: %s' % payload)
+                        increment_metric('payment-callback-error')
+                        results[i] = 'error'
+                        continue
+                    payments.append((i, memo, tx_hash, amount, sender_address, payload.get('timestamp', None)))
+                else:
+                    print('received failed tx from the payment service: %s' % payload)
+                    increment_metric('payment-callback-failed')
+                    memo = val.get('id', None)
+                    if memo is not None:
+                        retry_failed_payment(memo)
+            else:
+                print('should never happen: unhandled callback from the payment service: %s' % payload)
+        except Exception as e:
+            increment_metric('payment-callback-error')
+            log.error('failed processing the payment service callback %s. e: %s' % (payload, e))
+            results[i] = 'error'
+
+    if not payments:
+        return results
+
+    try:
+        # retrieve the user_id and task_id of all the payments from the cache
+        payment_data = read_payment_data_from_cache_many([memo for _, memo, _, _, _, _ in payments])
+        txs = []
+        for i, memo, tx_hash, amount, public_address, payment_ts in payments:
+            if memo not in payment_data:
+                log.error('cant find the payment data of memo %s in the cache' % memo)
+                increment_metric('payment-callback-error')
+                results[i] = 'error'
+                continue
+            user_id, task_id, request_timestamp, send_push = payment_data[memo]
+
+            # compare the timestamp from the callback with the one from the original request, and
+            # post as a gauge  metric for tracking
+            try:
+                request_duration_sec = arrow.get(payment_ts) - arrow.get(request_timestamp)
+                request_duration_sec = int(request_duration_sec.total_seconds())
+                gauge_metric('payment-req-dur', request_duration_sec)
+            except Exception as e:
+                log.error('failed to calculate payment request duration. e=%s' % e)
 
-                if tx_hash and send_push:
-                    send_push_tx_completed(user_id, tx_hash, amount, task_id, memo)
+            txs.append({'index': i, 'tx_hash': tx_hash, 'user_id': user_id, 'remote_address': public_address, 'incoming_tx': False,
+                        'amount': amount, 'tx_info': {'task_id': task_id, 'memo': memo}, 'task_id': task_id, 'memo': memo, 'send_push': send_push})
 
+        try:
+            inserted = create_txs(txs)
+        except Exception as e:
+            # a single bad row fails the whole insert - store the txs one by one, so it doesn't drop the others
+            log.error('failed to store %s txs in bulk - storing them one by one. e: %s' % (len(txs), e))
+            inserted = set()
+            stored_txs = []
+            for tx in txs:
                 try:
-                    redis_lock.Lock(app.redis, get_payment_lock_name(user_id, task_id)).release()
+                    inserted.update(create_txs([tx]))
+                    stored_txs.append(tx)
                 except Exception as e:
-                    log.error('failed to release payment lock for user_id %s and task_id %s' % (user_id, task_id))
+                    log.error('cant store tx %s of memo %s. e: %s' % (tx['tx_hash'], tx['memo'], e))
+                    increment_metric('payment-callback-error')
+                    results[tx['index']] = 'error'
+            txs = stored_txs
+        increment_metric('payment-callback-success', len(txs))
 
-            else:
-                print('received failed tx from the payment service: %s' % payload)
-                #TODO implement some retry mechanism here
-                increment_metric('payment-callback-failed')
-        else:
-            print('should never happen: unhandled callback from the payment service: %s' % payload)
+        # repeated callbacks for a tx that is already stored dont push again
+        send_pushes_tx_completed([tx for tx in txs if tx['send_push'] and tx['tx_hash'] in inserted])
 
+        for tx in txs:
+            redis_lock.Lock(app.redis, get_payment_lock_name(tx['user_id'], tx['task_id'])).reset()
     except Exception as e:
+        increment_metric('payment-callback-error', len(payments))
+        log.error('failed processing %s payment service callbacks. e: %s' % (len(payments), e))
+        for i, _, _, _, _, _ in payments:
+            results[i] = 'error'
 
-        increment_metric('payment-callback-error')
-        log.error('failed processing the payment service callback')
-        print(e)
-        return jsonify(status='error', reason='internal_error')
-
-    return jsonify(status='ok')
+    return results
 
 
 @app.route('/user/categories', methods=['GET'])